@@ -0,0 +1,94 @@
+"""
+Receive buffer microbenchmark
+
+Feeds a server to client byte stream through BoundBuffer and ZeroCopyBuffer
+the same way NetCore.read_packet does: the stream is appended in bufsize
+pieces and complete packets are framed off the front with save/revert.
+
+Usage:
+    python benchmarks/bench_bbuff.py [capture] [--size MB] [--bufsize N]
+
+A capture is the raw, decrypted and uncompressed stream as received from the
+server. Without one, a stream of small entity packets interleaved with Map
+Chunk Bulk sized packets is generated.
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import time
+
+from spockbot.mcp import datautils
+from spockbot.mcp.bbuff import BoundBuffer, BufferUnderflowException, \
+    ZeroCopyBuffer
+from spockbot.mcp.mcdata import MC_VARINT
+
+
+def frame(payload):
+    return datautils.pack(MC_VARINT, len(payload)) + payload
+
+
+def synthetic_stream(size, seed=1):
+    rand = random.Random(seed)
+    chunk = frame(os.urandom(180 * 1024))
+    small = [frame(os.urandom(n)) for n in (6, 10, 12, 19, 26, 40)]
+    parts, total = [], 0
+    while total < size:
+        if rand.random() < 0.002:
+            part = chunk
+        else:
+            part = rand.choice(small)
+        parts.append(part)
+        total += len(part)
+    return b''.join(parts)
+
+
+def drain(buff):
+    packets = 0
+    while buff:
+        buff.save()
+        try:
+            length = datautils.unpack(MC_VARINT, buff)
+            buff.recv(length)
+        except BufferUnderflowException:
+            buff.revert()
+            break
+        packets += 1
+    return packets
+
+
+def run(buff_type, stream, bufsize):
+    buff = buff_type()
+    packets = 0
+    start = time.time()
+    for i in range(0, len(stream), bufsize):
+        buff.append(stream[i:i + bufsize])
+        packets += drain(buff)
+    return time.time() - start, packets
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('capture', nargs='?')
+    parser.add_argument('--size', type=int, default=50,
+                        help='MB of synthetic traffic, default 50')
+    parser.add_argument('--bufsize', type=int, default=4096,
+                        help='bytes per recv, default 4096')
+    args = parser.parse_args()
+
+    if args.capture:
+        with open(args.capture, 'rb') as f:
+            stream = f.read()
+    else:
+        stream = synthetic_stream(args.size * 1024 * 1024)
+    mbytes = len(stream) / (1024.0 * 1024.0)
+    print('%.1f MB in %d byte reads' % (mbytes, args.bufsize))
+    for buff_type in (BoundBuffer, ZeroCopyBuffer):
+        elapsed, packets = run(buff_type, stream, args.bufsize)
+        print('%-15s %8.3fs %9.1f MB/s %9d packets' % (
+            buff_type.__name__, elapsed, mbytes / elapsed, packets))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Packet codec microbenchmark
+
+Compares decoding and encoding the base fields of common play state packets
+through datautils one field at a time against the compiled codecs from
+mcpacket_codec.
+
+Usage:
+    python benchmarks/bench_codec.py [--count N]
+"""
+from __future__ import print_function
+
+import argparse
+import timeit
+
+from spockbot.mcp import datautils, mcdata
+from spockbot.mcp.bbuff import BoundBuffer
+from spockbot.mcp.mcpacket_codec import get_codec
+
+packets = {
+    'PLAY<Entity Relative Move': {
+        'eid': 1234, 'dx': 0.25, 'dy': -0.5, 'dz': 1.0, 'on_ground': True,
+    },
+    'PLAY<Entity Look and Relative Move': {
+        'eid': 1234, 'dx': 0.25, 'dy': -0.5, 'dz': 1.0, 'yaw': 12,
+        'pitch': -3, 'on_ground': False,
+    },
+    'PLAY<Entity Teleport': {
+        'eid': 98765, 'x': 100.5, 'y': 64.0, 'z': -200.25, 'yaw': 1,
+        'pitch': 2, 'on_ground': True,
+    },
+    'PLAY<Entity Velocity': {
+        'eid': 98765, 'velocity_x': 100, 'velocity_y': -200,
+        'velocity_z': 300,
+    },
+    'PLAY<Block Change': {
+        'location': {'x': 100, 'y': 64, 'z': -200}, 'block_data': 16,
+    },
+}
+
+
+def reference_decode(structs, bbuff):
+    data = {}
+    for dtype, name in structs:
+        data[name] = datautils.unpack(dtype, bbuff)
+    return data
+
+
+def reference_encode(structs, data):
+    o = b''
+    for dtype, name in structs:
+        o += datautils.pack(dtype, data[name])
+    return o
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--count', type=int, default=100000)
+    args = parser.parse_args()
+
+    print('%-36s %10s %10s %10s %10s' % (
+        'packet', 'decode', 'compiled', 'encode', 'compiled'))
+    for str_ident, data in sorted(packets.items()):
+        ident = mcdata.packet_str2ident[str_ident]
+        structs = mcdata.hashed_structs[ident]
+        codec = get_codec(ident)
+        raw = codec.encode(data)
+        results = [
+            timeit.timeit(
+                lambda: reference_decode(structs, BoundBuffer(raw)),
+                number=args.count),
+            timeit.timeit(
+                lambda: codec.decode(BoundBuffer(raw)), number=args.count),
+            timeit.timeit(
+                lambda: reference_encode(structs, data), number=args.count),
+            timeit.timeit(lambda: codec.encode(data), number=args.count),
+        ]
+        print('%-36s' % str_ident + ''.join(
+            '%9.2fus' % (r * 1e6 / args.count) for r in results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Compressed packet decoding benchmark
+
+Decodes a compressed server to client play state stream with the old
+decompress, write and save path and with Packet.decode and an Inflater,
+which hands the compressed bytes to zlib without copying them and decodes
+the inflated body in place.
+
+Usage:
+    python benchmarks/bench_inflate.py [capture] [--columns N]
+
+A capture is the raw, decrypted stream as received from the server after
+compression has been enabled. Without one, a stream of full Chunk Data
+columns interleaved with small entity packets is generated.
+"""
+from __future__ import print_function
+
+import argparse
+import random
+import struct
+import time
+import zlib
+
+from spockbot.mcp import datautils, mcdata
+from spockbot.mcp.bbuff import BoundBuffer, BufferUnderflowException, \
+    ZeroCopyBuffer
+from spockbot.mcp.mcdata import MC_VARINT
+from spockbot.mcp.mcpacket import Inflater, Packet
+
+THRESHOLD = 256
+
+
+def column_data(rand):
+    # 16 sections of blocks and light, then biomes, mostly stone and air
+    ids = [1 << 4, 1 << 4, 1 << 4, 3 << 4, 0, 0, 0, 13 << 4]
+    blocks = struct.pack('<%dH' % (16 * 4096),
+                         *[rand.choice(ids) for _ in range(16 * 4096)])
+    light = bytes(bytearray(rand.choice((0, 0xFF)) for _ in range(2048)))
+    return blocks + light * 32 + b'\x01' * 256
+
+
+def synthetic_stream(columns, seed=1):
+    rand = random.Random(seed)
+    data = column_data(rand)
+    parts = []
+    for i in range(columns):
+        parts.append(Packet('PLAY<Chunk Data', {
+            'chunk_x': i, 'chunk_z': 0, 'continuous': True,
+            'primary_bitmap': 0xFFFF, 'data': data,
+        }).encode(mcdata.PROTO_COMP_ON, THRESHOLD))
+        for eid in range(50):
+            parts.append(Packet('PLAY<Entity Relative Move', {
+                'eid': eid, 'dx': 0.5, 'dy': 0, 'dz': -0.25,
+                'on_ground': True,
+            }).encode(mcdata.PROTO_COMP_ON, THRESHOLD))
+    return b''.join(parts)
+
+
+def reference_decode(bbuff):
+    packet = Packet((mcdata.PLAY_STATE, mcdata.SERVER_TO_CLIENT))
+    packet_length = datautils.unpack(MC_VARINT, bbuff)
+    pbuff = BoundBuffer(bbuff.recv(packet_length))
+    body_length = datautils.unpack(MC_VARINT, pbuff)
+    if body_length > 0:
+        body_data = zlib.decompress(pbuff.flush(), zlib.MAX_WBITS)
+        pbuff.write(body_data)
+        pbuff.save()
+    packet.decode_ident(pbuff)
+    return packet.decode_payload(pbuff)
+
+
+def inflater_decode(bbuff, inflater=Inflater()):
+    return Packet((mcdata.PLAY_STATE, mcdata.SERVER_TO_CLIENT)).decode(
+        bbuff, mcdata.PROTO_COMP_ON, inflater=inflater)
+
+
+def run(decode, stream):
+    bbuff = ZeroCopyBuffer(stream)
+    packets = 0
+    start = time.time()
+    while bbuff:
+        bbuff.save()
+        try:
+            decode(bbuff)
+        except BufferUnderflowException:
+            break
+        packets += 1
+    return time.time() - start, packets
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('capture', nargs='?')
+    parser.add_argument('--columns', type=int, default=200,
+                        help='chunk columns in the synthetic stream, '
+                             'default 200')
+    args = parser.parse_args()
+
+    if args.capture:
+        with open(args.capture, 'rb') as f:
+            stream = f.read()
+    else:
+        stream = synthetic_stream(args.columns)
+    mbytes = len(stream) / (1024.0 * 1024.0)
+    print('%.1f MB compressed' % mbytes)
+    for name, decode in (('decompress', reference_decode),
+                         ('inflater', inflater_decode)):
+        elapsed, packets = run(decode, stream)
+        print('%-12s %8.3fs %9.1f MB/s %9d packets' % (
+            name, elapsed, mbytes / elapsed, packets))
+
+
+if __name__ == '__main__':
+    main()
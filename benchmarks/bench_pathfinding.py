@@ -0,0 +1,289 @@
+"""
+Pathfinding benchmark
+
+Builds WorldData maps from synthetic terrain, with no server involved, and
+runs PathfindingPlugin.pathfind() between fixed start and goal positions on
+each of them. Every scenario reports the nodes expanded, the wall time, the
+length of the path found and its optimality gap: how much longer it is than
+the shortest path over the same walk, fall and jump moves, found with plain
+A*. Lazy Theta* cuts corners, so the gap can be negative.
+
+Terrains, all walled in and on a stone floor at y = 0:
+    flat        open ground
+    field       open ground with scattered pillars
+    maze        a maze with one block wide corridors
+    staircase   steps up one block at a time, with a landing every few
+    cave        winding tunnels under a ceiling
+
+Usage:
+    python benchmarks/bench_pathfinding.py [--size N] [--seed N]
+        [--json FILE] [--no-reference] [scenario ...]
+
+Run it with py.test to check that every scenario still finds a path:
+    py.test benchmarks/bench_pathfinding.py
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+
+from spockbot.plugins.helpers.pathfinding import FOUND_VALID_PATH, Path, \
+    PathNode, PathfindingPlugin
+from spockbot.plugins.helpers.world import WorldData
+
+STONE = 1
+WALL_HEIGHT = 3
+
+
+class Timers(object):
+    # No timers are ever due, so a search runs until it is done
+    def get_timeout(self):
+        return -1
+
+
+class PluginLoader(object):
+    def __init__(self, world):
+        self.provided = {'World': world, 'Timers': Timers()}
+
+    def requires(self, requirement):
+        return self.provided.get(requirement)
+
+    def provides(self, ident, obj):
+        self.provided[ident] = obj
+
+    def reg_event_handler(self, event, handler):
+        pass
+
+
+class Terrain(object):
+    """A size x size area with its floor at y = 0, walled in"""
+    def __init__(self, size, top=1):
+        self.size = size
+        self.world = WorldData()
+        for x in range(-1, size + 1):
+            for z in range(-1, size + 1):
+                self.world.set_block(x, 0, z, STONE, 0)
+                if not (0 <= x < size and 0 <= z < size):
+                    self.pillar(x, z, 1, top + WALL_HEIGHT)
+
+    def pillar(self, x, z, bottom=1, top=WALL_HEIGHT + 1):
+        for y in range(bottom, top):
+            self.world.set_block(x, y, z, STONE, 0)
+
+    def clear(self, x, z, bottom=1, top=WALL_HEIGHT + 1):
+        for y in range(bottom, top):
+            self.world.set_block(x, y, z, 0, 0)
+
+
+def flat(size, rand):
+    terrain = Terrain(size)
+    return terrain.world, (0, 1, 0), (size - 1, 1, size // 3)
+
+
+def field(size, rand):
+    terrain = Terrain(size)
+    start, goal = (0, 1, 0), (size - 1, 1, size - 1)
+    for x in range(size):
+        for z in range(size):
+            if rand.random() < 0.2 and (x, z) not in (
+                    (start[0], start[2]), (goal[0], goal[2])):
+                terrain.pillar(x, z)
+    return terrain.world, start, goal
+
+
+def maze(size, rand):
+    # Cells on even coordinates, walls on odd ones, carved depth first
+    cells = (size + 1) // 2
+    size = cells * 2 - 1
+    terrain = Terrain(size)
+    for x in range(size):
+        for z in range(size):
+            if x % 2 or z % 2:
+                terrain.pillar(x, z)
+    seen = {(0, 0)}
+    stack = [(0, 0)]
+    while stack:
+        x, z = stack[-1]
+        options = [(x + dx, z + dz) for dx, dz in
+                   ((1, 0), (-1, 0), (0, 1), (0, -1))
+                   if 0 <= x + dx < cells and 0 <= z + dz < cells and
+                   (x + dx, z + dz) not in seen]
+        if not options:
+            stack.pop()
+            continue
+        nx, nz = rand.choice(options)
+        terrain.clear(x + nx, z + nz)
+        seen.add((nx, nz))
+        stack.append((nx, nz))
+    return terrain.world, (0, 1, 0), (size - 1, 1, size - 1)
+
+
+def staircase(size, rand):
+    # Every step is a block higher than the one before, every fourth one is
+    # followed by a landing
+    top = size // 2
+    terrain = Terrain(size, top)
+    height = 0
+    for x in range(size):
+        if x % 5 != 4 and height < top:
+            height += 1
+        for z in range(size):
+            terrain.pillar(x, z, 1, height + 1)
+    return terrain.world, (0, 2, 0), (size - 1, height + 1, size - 1)
+
+
+def cave(size, rand):
+    # Solid rock under a ceiling, with a random walk from start to goal and
+    # some side pockets carved out of it
+    terrain = Terrain(size)
+    for x in range(size):
+        for z in range(size):
+            terrain.pillar(x, z)
+            terrain.world.set_block(x, WALL_HEIGHT + 1, z, STONE, 0)
+    goal = size - 1, size - 1
+
+    def walk(x, z, steps, target=None):
+        for _ in range(steps):
+            terrain.clear(x, z, 1, 3)
+            if target and (x, z) == target:
+                return
+            if target and rand.random() < 0.6:
+                dx = (target[0] > x) - (target[0] < x)
+                dz = (target[1] > z) - (target[1] < z)
+                if dx and dz:
+                    dx, dz = rand.choice(((dx, 0), (0, dz)))
+            else:
+                dx, dz = rand.choice(((1, 0), (-1, 0), (0, 1), (0, -1)))
+            x = min(max(x + dx, 0), size - 1)
+            z = min(max(z + dz, 0), size - 1)
+
+    walk(0, 0, size * size * 4, goal)
+    for _ in range(size // 4):
+        walk(rand.randrange(size), rand.randrange(size), size)
+    return terrain.world, (0, 1, 0), (goal[0], 1, goal[1])
+
+
+terrains = {
+    'flat': flat,
+    'field': field,
+    'maze': maze,
+    'staircase': staircase,
+    'cave': cave,
+}
+
+
+def node(x, y, z):
+    # Nodes stand in the middle of their block, like start_path() puts them
+    return PathNode(x + 0.5, y, z + 0.5)
+
+
+def path_length(nodes):
+    return sum(a.dist(b) for a, b in zip(nodes, list(nodes)[1:]))
+
+
+def reference(plugin, start, goal):
+    """Plain A* over the plugin's moves, the shortest path on the grid"""
+    path = Path(node(*start), node(*goal))
+    while True:
+        cur_node = path.pop()
+        if cur_node is None:
+            return None
+        if cur_node == path.end_node:
+            return cur_node.node_dist
+        path.close(cur_node)
+        for valid_node in plugin.find_valid_nodes(cur_node):
+            path.push(valid_node)
+
+
+def run_scenario(name, size=24, seed=1, with_reference=True):
+    world, start, goal = terrains[name](size, random.Random(seed))
+    plugin = PathfindingPlugin(PluginLoader(world), {})
+    path = Path(node(*start), node(*goal))
+    started = time.time()
+    found = plugin.pathfind(path) == FOUND_VALID_PATH
+    elapsed = time.time() - started
+    result = {
+        'scenario': name,
+        'size': size,
+        'seed': seed,
+        'start': start,
+        'goal': goal,
+        'found': found,
+        'expanded': len(path.closed_set),
+        'seconds': elapsed,
+        'waypoints': None,
+        'length': None,
+        'reference_length': None,
+        'gap': None,
+    }
+    if found:
+        nodes = plugin.build_list_from_node(path.result)
+        result['waypoints'] = len(nodes)
+        result['length'] = path_length(nodes)
+    if with_reference:
+        best = reference(plugin, start, goal)
+        result['reference_length'] = best
+        if found and best:
+            result['gap'] = result['length'] / best - 1
+    return result
+
+
+def test_scenarios():
+    for name in sorted(terrains):
+        result = run_scenario(name, size=12)
+        assert result['found'], name
+        assert result['gap'] is None or result['gap'] < 0.5, result
+
+
+def fmt(value, spec):
+    return '-' if value is None else spec % value
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help='terrains to run, default all of %s' %
+                             ', '.join(sorted(terrains)))
+    parser.add_argument('--size', type=int, default=24,
+                        help='width of every terrain in blocks, default 24')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', metavar='FILE',
+                        help='also write the results to FILE as JSON')
+    parser.add_argument('--no-reference', action='store_true',
+                        help="don't search for the shortest path to work "
+                             "out the optimality gap")
+    args = parser.parse_args()
+
+    names = args.scenarios or sorted(terrains)
+    unknown = [n for n in names if n not in terrains]
+    if unknown:
+        parser.error('unknown scenario %s' % ', '.join(unknown))
+    print('%-10s %6s %9s %10s %8s %8s %8s' % (
+        'scenario', 'found', 'expanded', 'time', 'length', 'best', 'gap'))
+    results = []
+    for name in names:
+        result = run_scenario(name, args.size, args.seed,
+                              not args.no_reference)
+        results.append(result)
+        gap = result['gap']
+        print('%-10s %6s %9d %9.3fs %8s %8s %8s' % (
+            name, result['found'], result['expanded'], result['seconds'],
+            fmt(result['length'], '%.1f'),
+            fmt(result['reference_length'], '%.1f'),
+            fmt(None if gap is None else gap * 100, '%+.1f%%')))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': sys.platform,
+                'time': time.time(),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+Chunk storage benchmark
+
+Loads synthetic chunk columns into a Dimension with each map backend and
+times decoding them, packing them with compact(), single block lookups,
+and a search for one block id over every loaded column, done with
+get_block() in a loop and with find_blocks(). On Python 3 it also reports
+the memory the loaded and compacted columns take up.
+
+Usage:
+    python benchmarks/bench_smpmap.py [--columns N] [--no-numpy]
+"""
+from __future__ import print_function
+
+import argparse
+import random
+import struct
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from spockbot.plugins.tools import smpmap
+
+DIAMOND_ORE = 56
+
+
+def column_packet(x, z, rand):
+    ids = [1, 1, 1, 1, 3, 13, 0, 0, DIAMOND_ORE if rand.random() < 0.1 else 1]
+    blocks = struct.pack('<%dH' % (16 * 4096),
+                         *[rand.choice(ids) << 4 for _ in range(16 * 4096)])
+    return {
+        'chunk_x': x, 'chunk_z': z, 'primary_bitmap': 0xFFFF,
+        'continuous': True,
+        'data': blocks + b'\x00' * (16 * 4096) + b'\x01' * 256,
+    }
+
+
+def memory(func):
+    if tracemalloc is None:
+        return float('nan')
+    tracemalloc.start()
+    func()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size / (1024.0 * 1024.0)
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+def scan(dimension, block_id):
+    found = []
+    for cx, cz in dimension.columns:
+        for y in range(256):
+            for z in range(cz * 16, cz * 16 + 16):
+                for x in range(cx * 16, cx * 16 + 16):
+                    if dimension.get_block(x, y, z)[0] == block_id:
+                        found.append((x, y, z))
+    return found
+
+
+def load(dimension, packets):
+    for packet in packets:
+        dimension.unpack_column(packet)
+    for column in dimension.columns.values():
+        column.compact()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--columns', type=int, default=16)
+    parser.add_argument('--no-numpy', action='store_true',
+                        help='run the array and palette backends without '
+                             'numpy')
+    args = parser.parse_args()
+    backends = [smpmap.BACKEND_ARRAY, smpmap.BACKEND_NUMPY,
+                smpmap.BACKEND_PALETTE]
+    if args.no_numpy or smpmap.numpy is None:
+        smpmap.numpy = None
+        backends.remove(smpmap.BACKEND_NUMPY)
+
+    rand = random.Random(1)
+    side = int(args.columns ** 0.5) or 1
+    packets = [column_packet(x, z, rand)
+               for x in range(side) for z in range(side)]
+    print('%d columns' % len(packets))
+    print('%-8s %10s %12s %12s %12s %10s %12s' % (
+        'backend', 'memory', 'decode', 'compact', 'get_block', 'scan',
+        'find_blocks'))
+    for backend in backends:
+        dimension = smpmap.Dimension(smpmap.DIMENSION_OVERWOLD, backend)
+        mbytes = memory(lambda: load(dimension, packets))
+        dimension = smpmap.Dimension(smpmap.DIMENSION_OVERWOLD, backend)
+        unpack, _ = timed(lambda: [dimension.unpack_column(p)
+                                   for p in packets])
+        compact, _ = timed(lambda: [c.compact()
+                                    for c in dimension.columns.values()])
+        lookups = 100000
+        get, _ = timed(lambda: [dimension.get_block(i % 16, i % 256, 0)
+                                for i in range(lookups)])
+        loop, slow = timed(scan, dimension, DIAMOND_ORE)
+        vectorized = float('nan')
+        if smpmap.numpy is not None:
+            vectorized, fast = timed(dimension.find_blocks, {DIAMOND_ORE})
+            assert len(slow) == len(fast)
+        print('%-8s %8.1fMB %7.2fms/col %7.2fms/col %10.2fus %9.3fs '
+              '%11.4fs' % (backend, mbytes, unpack * 1e3 / len(packets),
+                           compact * 1e3 / len(packets), get * 1e6 / lookups,
+                           loop, vectorized))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 import logging
 
+from spockbot.plugins.core.net import Reactor  # noqa
 from spockbot.plugins.loader import PluginLoader as Client  # noqa
 
 logger = logging.getLogger('spockbot')
@@ -18,6 +18,8 @@ class BoundBuffer(object):
         return out
 
     def write(self, data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
         self.buff += data
 
     def flush(self):
@@ -41,3 +43,108 @@ class BoundBuffer(object):
 
     recv = read
     append = write
+
+
+class ZeroCopyBuffer(object):
+    """
+    A drop-in replacement for BoundBuffer meant for long lived receive
+    buffers.
+
+    Data lives in a preallocated bytearray and read() hands out memoryview
+    slices of it instead of copies. save() and revert() only move offsets,
+    consumed data is dropped when a write runs out of room. At that point
+    the unread tail is moved to a new bytearray with room for at least as
+    much data again, which keeps compaction amortized O(1) per byte.
+
+    A bytearray is never written to below its end offset once data has been
+    read from it, so views returned by read() stay valid for as long as the
+    caller keeps them around.
+    """
+
+    def __init__(self, data=b'', size=4096):
+        self.size = size
+        self.buff = bytearray(size)
+        self.view = memoryview(self.buff)
+        self.mark = 0
+        self.cursor = 0
+        self.end = 0
+        self.write(data)
+
+    def read(self, length):
+        if length > self.end - self.cursor:
+            raise BufferUnderflowException()
+
+        start = self.cursor
+        self.cursor += length
+        return self.view[start:self.cursor]
+
+    def write(self, data):
+        length = len(data)
+        if self.end + length > len(self.buff):
+            self.compact(length)
+        self.view[self.end:self.end + length] = data
+        self.end += length
+
+    def compact(self, extra=0):
+        live = self.end - self.mark
+        buff = bytearray(max(self.size, 2 * (live + extra)))
+        view = memoryview(buff)
+        view[:live] = self.view[self.mark:self.end]
+        self.cursor -= self.mark
+        self.mark, self.end = 0, live
+        self.buff, self.view = buff, view
+
+    def flush(self):
+        return self.read(len(self))
+
+    def save(self):
+        self.mark = self.cursor
+
+    def revert(self):
+        self.cursor = self.mark
+
+    def tell(self):
+        return self.cursor - self.mark
+
+    def __len__(self):
+        return self.end - self.cursor
+
+    def __repr__(self):
+        return "<ZeroCopyBuffer '%s'>" % repr(
+            self.view[self.cursor:self.end].tobytes())
+
+    recv = read
+    append = write
+
+
+class ViewBuffer(object):
+    """
+    A read only buffer over existing data, read() hands out memoryview
+    slices of it instead of copies.
+    """
+
+    def __init__(self, data):
+        self.view = memoryview(data)
+        self.cursor = 0
+
+    def read(self, length):
+        if length > len(self):
+            raise BufferUnderflowException()
+
+        start = self.cursor
+        self.cursor += length
+        return self.view[start:self.cursor]
+
+    def flush(self):
+        return self.read(len(self))
+
+    def tell(self):
+        return self.cursor
+
+    def __len__(self):
+        return len(self.view) - self.cursor
+
+    def __repr__(self):
+        return "<ViewBuffer '%s'>" % repr(self.view[self.cursor:].tobytes())
+
+    recv = read
@@ -1,3 +1,4 @@
+import codecs
 import json
 import struct
 
@@ -222,7 +223,8 @@ def unpack(data_type, bbuff):
     elif data_type == MC_POSITION:
         return unpack_position(bbuff)
     elif data_type == MC_STRING:
-        return bbuff.recv(unpack(MC_VARINT, bbuff)).decode('utf-8', 'replace')
+        data = bbuff.recv(unpack(MC_VARINT, bbuff))
+        return codecs.decode(data, 'utf-8', 'replace')
     elif data_type == MC_CHAT:
         return json.loads(unpack(MC_STRING, bbuff))
     elif data_type == MC_SLOT:
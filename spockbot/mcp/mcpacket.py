@@ -8,14 +8,20 @@ import logging
 import zlib
 from time import gmtime, strftime
 
+import six
+
 from spockbot.mcp import datautils, mcdata
 from spockbot.mcp.bbuff import BoundBuffer, BufferUnderflowException
 from spockbot.mcp.mcdata import MC_VARINT
+from spockbot.mcp.mcpacket_codec import get_codec
 from spockbot.mcp.mcpacket_extensions import hashed_extensions
 
 
 logger = logging.getLogger('spockbot')
 
+# Largest uncompressed packet the vanilla server accepts
+MAX_DECOMPRESSED_SIZE = 2097152
+
 
 class PacketDecodeFailure(Exception):
     def __init__(self, packet, pbuff, underflow=False):
@@ -24,6 +30,60 @@ class PacketDecodeFailure(Exception):
         self.underflow = underflow
 
 
+class InflateError(Exception):
+    pass
+
+
+def zlib_input(data):
+    """zlib on Python 2 only takes strings and read-only buffers"""
+    if six.PY2 and isinstance(data, memoryview):
+        return data.tobytes()
+    return data
+
+
+class Inflater(object):
+    """
+    Decompresses packet bodies, normally one per connection.
+
+    Every packet is a separate zlib stream, so instead of building a new
+    decompressobj each time a pristine one is kept around and copied.
+    Bodies that claim to be larger than max_size, or that don't inflate to
+    exactly the size they claim, raise InflateError before more than
+    max_size bytes are ever allocated.
+    """
+
+    def __init__(self, max_size=MAX_DECOMPRESSED_SIZE):
+        self.max_size = max_size
+        self.template = zlib.decompressobj(zlib.MAX_WBITS)
+
+    def inflate(self, data, size):
+        if size > self.max_size:
+            raise InflateError('Packet body of %d bytes is larger than the '
+                               'maximum of %d' % (size, self.max_size))
+        try:
+            decompressor = self.template.copy()
+            # One byte more than expected is enough to spot lying headers
+            body = decompressor.decompress(zlib_input(data), size + 1)
+        except zlib.error as error:
+            raise InflateError(str(error))
+        if len(body) != size or decompressor.unconsumed_tail:
+            raise InflateError('Packet body inflated to %s bytes instead of '
+                               '%d' % ('over' if len(body) > size
+                                       else len(body), size))
+        return body
+
+    def peek(self, data, length):
+        """Inflates at most length bytes from the start of data"""
+        try:
+            return self.template.copy().decompress(zlib_input(data),
+                                                   length)
+        except zlib.error as error:
+            raise InflateError(str(error))
+
+
+default_inflater = Inflater()
+
+
 class Packet(object):
     def __init__(self,
                  ident=[mcdata.HANDSHAKE_STATE, mcdata.CLIENT_TO_SERVER, 0x00],
@@ -37,34 +97,113 @@ class Packet(object):
             self.__ident.append(0x00)
         self.ident = tuple(self.__ident)
         self.str_ident = mcdata.packet_ident2str[self.ident]
+        self.__payload = None
+        # (inflater, body length) of a compressed lazy payload
+        self.__compressed = None
         self.data = data if data else {}
 
+    @property
+    def data(self):
+        # Lazily decoded packets only parse their payload on first access
+        if self.__payload is not None:
+            payload, self.__payload = self.__payload, None
+            if self.__compressed:
+                inflater, body_length = self.__compressed
+                try:
+                    body = inflater.inflate(payload, body_length)
+                except InflateError:
+                    raise PacketDecodeFailure(self, BoundBuffer(payload))
+                pbuff = BoundBuffer(body)
+                datautils.unpack(MC_VARINT, pbuff)
+            else:
+                pbuff = BoundBuffer(payload)
+            self.decode_payload(pbuff)
+        return self.__data
+
+    @data.setter
+    def data(self, data):
+        self.__payload = None
+        self.__data = data
+
+    @property
+    def decoded(self):
+        return self.__payload is None
+
     def clone(self):
-        return Packet(self.ident, copy.deepcopy(self.data))
+        if self.__payload is None:
+            return Packet(self.ident, copy.deepcopy(self.__data))
+        # The raw payload is immutable, so clones can share it and decode
+        # their own copy if and when they need it
+        packet = Packet(self.ident)
+        packet.__payload = self.__payload
+        packet.__compressed = self.__compressed
+        return packet
 
     def new_ident(self, ident):
         self.__init__(ident, self.data)
 
-    def decode(self, bbuff, proto_comp_state):
+    def decode(self, bbuff, proto_comp_state, lazy=False, inflater=None):
+        """
+        Reads a packet from bbuff. If lazy is set only the ident is decoded,
+        the rest of the packet is kept as raw bytes and decoded when data is
+        first accessed. In that case a PacketDecodeFailure for the payload
+        is raised on that first access instead.
+
+        Compressed packets are inflated with inflater, default_inflater if
+        none is given.
+        """
         self.data = {}
         packet_length = datautils.unpack(MC_VARINT, bbuff)
-        packet_data = bbuff.recv(packet_length)
-        pbuff = BoundBuffer(packet_data)
         if proto_comp_state == mcdata.PROTO_COMP_ON:
-            body_length = datautils.unpack(MC_VARINT, pbuff)
+            if packet_length > len(bbuff):
+                raise BufferUnderflowException()
+            # Read the body length straight from bbuff, so the compressed
+            # data is handed to zlib without being copied first
+            start = bbuff.tell()
+            body_length = datautils.unpack(MC_VARINT, bbuff)
+            packet_data = bbuff.recv(packet_length - (bbuff.tell() - start))
             if body_length > 0:
-                body_data = zlib.decompress(pbuff.flush(), zlib.MAX_WBITS)
-                pbuff.write(body_data)
-                pbuff.save()
+                self.decode_compressed(packet_data, body_length, lazy,
+                                       inflater or default_inflater)
+                return self
+        else:
+            packet_data = bbuff.recv(packet_length)
+        pbuff = BoundBuffer(packet_data)
+        self.decode_ident(pbuff)
+        if lazy:
+            self.__payload = pbuff.flush()
+            return self
+        return self.decode_payload(pbuff)
+
+    def decode_compressed(self, data, body_length, lazy, inflater):
+        try:
+            if lazy:
+                # Only inflate as much as it takes to read the ident varint
+                self.decode_ident(BoundBuffer(inflater.peek(data, 5)))
+                # Copied, the receive buffer is reused for later packets
+                self.__payload = data.tobytes() \
+                    if isinstance(data, memoryview) else data
+                self.__compressed = inflater, body_length
+                return
+            pbuff = BoundBuffer(inflater.inflate(data, body_length))
+        except InflateError as error:
+            logger.warning('PACKET: %s', error)
+            raise PacketDecodeFailure(self, BoundBuffer(data))
+        self.decode_ident(pbuff)
+        self.decode_payload(pbuff)
 
+    def decode_ident(self, pbuff):
         try:
-            # Ident
             self.__ident[2] = datautils.unpack(MC_VARINT, pbuff)
             self.ident = tuple(self.__ident)
             self.str_ident = mcdata.packet_ident2str[self.ident]
+        except BufferUnderflowException:
+            raise PacketDecodeFailure(self, pbuff, True)
+
+    def decode_payload(self, pbuff):
+        try:
             # Payload
-            for dtype, name in mcdata.hashed_structs[self.ident]:
-                self.data[name] = datautils.unpack(dtype, pbuff)
+            self.__data = get_codec(self.ident).decode(pbuff)
             # Extension
             if self.ident in hashed_extensions:
                 hashed_extensions[self.ident].decode_extra(self, pbuff)
@@ -78,8 +217,7 @@ class Packet(object):
         # Ident
         o = datautils.pack(MC_VARINT, self.ident[2])
         # Payload
-        for dtype, name in mcdata.hashed_structs[self.ident]:
-            o += datautils.pack(dtype, self.data[name])
+        o += get_codec(self.ident).encode(self.data)
         # Extension
         if self.ident in hashed_extensions:
             o += hashed_extensions[self.ident].encode_extra(self)
@@ -0,0 +1,265 @@
+"""
+Compiles the field lists in mcdata.hashed_structs into specialized decode
+and encode functions, one pair per packet ident.
+
+The first time an ident is used its fields are turned into Python source.
+Runs of fixed width fields become a single precompiled struct.Struct,
+varints and strings are handled inline, and the remaining types (slots and
+entity metadata) are handed off to datautils. The compiled functions are
+cached in hashed_codecs.
+"""
+
+import json
+import struct
+
+import six
+
+from spockbot.mcp import datautils, mcdata
+from spockbot.mcp.bbuff import BufferUnderflowException
+from spockbot.mcp.mcdata import (MC_CHAT, MC_FP_BYTE, MC_FP_INT, MC_META,
+                                 MC_POSITION, MC_SLOT, MC_STRING, MC_UUID,
+                                 MC_VARINT, MC_VARLONG)
+
+hashed_codecs = {}
+
+# (decode suffix, encode suffix) for every type that fits in a struct
+fixed_formats = dict(
+    (data_type, (fmt[0], fmt[0]))
+    for data_type, fmt in enumerate(mcdata.data_structs)
+)
+fixed_formats.update({
+    MC_FP_INT: ('i', 'i'),
+    MC_FP_BYTE: ('b', 'b'),
+    MC_UUID: ('QQ', 'QQ'),
+    MC_POSITION: ('q', 'Q'),
+})
+
+# Python 2 indexes str to str, Python 3 indexes bytes to int
+if six.PY3:
+    byte_at = 'data[pos]'
+else:
+    byte_at = 'ord(data[pos])'
+
+
+def decode_fixed(data_type, names):
+    if data_type in (MC_FP_INT, MC_FP_BYTE):
+        return '%s / 32.0' % names[0]
+    elif data_type == MC_UUID:
+        return '(%s << 64) | %s' % tuple(names)
+    elif data_type == MC_POSITION:
+        return ("{'x': %(v)s >> 38, 'y': (%(v)s >> 26) & 0xFFF, "
+                "'z': ((%(v)s & 0x3FFFFFF) ^ 0x2000000) - 0x2000000}"
+                % {'v': names[0]})
+    return names[0]
+
+
+def encode_fixed(data_type, src):
+    if data_type in (MC_FP_INT, MC_FP_BYTE):
+        return ['int(%s * 32)' % src]
+    elif data_type == MC_UUID:
+        return ['(%s >> 64) & 0xFFFFFFFFFFFFFFFF' % src,
+                '%s & 0xFFFFFFFFFFFFFFFF' % src]
+    elif data_type == MC_POSITION:
+        return ["((int(%(p)s['x']) & 0x3FFFFFF) << 38) | "
+                "((int(%(p)s['y']) & 0xFFF) << 26) | "
+                "(int(%(p)s['z']) & 0x3FFFFFF)" % {'p': src}]
+    return [src]
+
+
+def decode_varint(target, bits=32):
+    # Single byte varints are by far the most common, so they skip the loop
+    lines = [
+        '_b = %s' % byte_at,
+        'pos += 1',
+        '%s = _b & 0x7F' % target,
+        'if _b & 0x80:',
+        '    _s = 7',
+        '    while True:',
+        '        _b = %s' % byte_at,
+        '        pos += 1',
+        '        %s |= (_b & 0x7F) << _s' % target,
+        '        if not _b & 0x80:',
+        '            break',
+        '        _s += 7',
+        'if %s >= 0x%X:' % (target, 1 << (bits - 1)),
+    ]
+    if bits == 32:
+        lines += [
+            '    %s = None if %s >= 0x%X else %s - 0x%X' % (
+                target, target, 1 << bits, target, 1 << bits),
+        ]
+    else:
+        # Matches datautils.unpack_varlong, which doesn't sign varlongs
+        lines += [
+            '    %s = None if %s >= 0x%X else %s' % (
+                target, target, 1 << bits, target),
+        ]
+    return lines
+
+
+def encode_varint(src, bits=32):
+    return [
+        '_v = %s' % src,
+        'if _v < 0:',
+        '    _v += 0x%X' % (1 << bits),
+        'while _v >= 0x80:',
+        '    o.append(0x80 | (_v & 0x7F))',
+        '    _v >>= 7',
+        'o.append(_v)',
+    ]
+
+
+def decode_string(target):
+    return decode_varint('_n') + [
+        'if pos + _n > end:',
+        '    raise BufferUnderflowException()',
+        "%s = data[pos:pos + _n].decode('utf-8', 'replace')" % target,
+        'pos += _n',
+    ]
+
+
+def encode_string(src):
+    return ["_e = %s.encode('utf-8', 'replace')" % src] + \
+        encode_varint('len(_e)') + ['o += _e']
+
+
+class PacketCodec(object):
+    """
+    Decoder and encoder for the base fields of one packet layout.
+
+    decode() reads the fields from a BoundBuffer and returns them as a dict,
+    leaving the buffer positioned at the start of any extension data.
+    encode() is the inverse, returning the packed fields as bytes.
+    """
+
+    def __init__(self, structs):
+        self.structs = structs
+        self.struct_count = 0
+        self.namespace = {
+            'BufferUnderflowException': BufferUnderflowException,
+            'json': json,
+            'struct': struct,
+            'unpack_slot': datautils.unpack_slot,
+            'unpack_metadata': datautils.unpack_metadata,
+            'pack_slot': datautils.pack_slot,
+            'pack_metadata': datautils.pack_metadata,
+        }
+        self.decode_source = self.gen_decode()
+        self.encode_source = self.gen_encode()
+        six.exec_(self.decode_source, self.namespace)
+        six.exec_(self.encode_source, self.namespace)
+        self.decode = self.namespace['decode']
+        self.encode = self.namespace['encode']
+
+    def add_struct(self, fmt):
+        name = '_S%d' % self.struct_count
+        self.struct_count += 1
+        self.namespace[name] = struct.Struct(datautils.endian + fmt)
+        return name
+
+    def fixed_runs(self):
+        """
+        Yields a list of (index, field) pairs for each run of fixed width
+        fields, and a single (index, field) pair for every other field
+        """
+        run = []
+        for i, field in enumerate(self.structs):
+            if field[0] in fixed_formats:
+                run.append((i, field))
+                continue
+            if run:
+                yield run
+                run = []
+            yield i, field
+        if run:
+            yield run
+
+    def gen_decode(self):
+        body = []
+        for item in self.fixed_runs():
+            if isinstance(item, list):
+                fmt = ''.join(fixed_formats[t][0] for _, (t, _) in item)
+                s = self.add_struct(fmt)
+                names, exprs = [], []
+                for i, (data_type, _) in item:
+                    count = len(fixed_formats[data_type][0])
+                    field_names = ['_v%d_%d' % (i, j) for j in range(count)]
+                    names.extend(field_names)
+                    exprs.append((i, decode_fixed(data_type, field_names)))
+                body.append('%s, = %s.unpack_from(data, pos)'
+                            % (', '.join(names), s))
+                body.append('pos += %s.size' % s)
+                body.extend('_f%d = %s' % e for e in exprs)
+                continue
+            i, (data_type, _) = item
+            target = '_f%d' % i
+            if data_type == MC_VARINT:
+                body.extend(decode_varint(target))
+            elif data_type == MC_VARLONG:
+                body.extend(decode_varint(target, 64))
+            elif data_type == MC_STRING:
+                body.extend(decode_string(target))
+            elif data_type == MC_CHAT:
+                body.extend(decode_string(target))
+                body.append('%s = json.loads(%s)' % (target, target))
+            else:
+                func = {MC_SLOT: 'unpack_slot', MC_META: 'unpack_metadata'}
+                body.extend([
+                    'bbuff.cursor = pos',
+                    '%s = %s(bbuff)' % (target, func[data_type]),
+                    'pos = bbuff.cursor',
+                ])
+        entries = ', '.join(
+            '%r: _f%d' % (name, i) for i, (_, name) in enumerate(self.structs)
+        )
+        lines = [
+            'def decode(bbuff):',
+            '    data = bbuff.buff',
+            '    pos = bbuff.cursor',
+            '    end = len(data)',
+        ]
+        if body:
+            lines.append('    try:')
+            lines.extend('        ' + line for line in body)
+            lines.append('    except (IndexError, struct.error):')
+            lines.append('        raise BufferUnderflowException()')
+        lines.append('    bbuff.cursor = pos')
+        lines.append('    return {%s}' % entries)
+        return '\n'.join(lines) + '\n'
+
+    def gen_encode(self):
+        body = []
+        for item in self.fixed_runs():
+            if isinstance(item, list):
+                fmt = ''.join(fixed_formats[t][1] for _, (t, _) in item)
+                s = self.add_struct(fmt)
+                args = []
+                for _, (data_type, name) in item:
+                    args.extend(encode_fixed(data_type, 'd[%r]' % name))
+                body.append('o += %s.pack(%s)' % (s, ', '.join(args)))
+                continue
+            _, (data_type, name) = item
+            src = 'd[%r]' % name
+            if data_type == MC_VARINT:
+                body.extend(encode_varint(src))
+            elif data_type == MC_VARLONG:
+                body.extend(encode_varint(src, 64))
+            elif data_type == MC_STRING:
+                body.extend(encode_string(src))
+            elif data_type == MC_CHAT:
+                body.extend(encode_string('json.dumps(%s)' % src))
+            else:
+                func = {MC_SLOT: 'pack_slot', MC_META: 'pack_metadata'}
+                body.append('o += %s(%s)' % (func[data_type], src))
+        lines = ['def encode(d):', '    o = bytearray()']
+        lines.extend('    ' + line for line in body)
+        lines.append('    return bytes(o)')
+        return '\n'.join(lines) + '\n'
+
+
+def get_codec(ident):
+    codec = hashed_codecs.get(ident)
+    if codec is None:
+        codec = PacketCodec(mcdata.hashed_structs[ident])
+        hashed_codecs[ident] = codec
+    return codec
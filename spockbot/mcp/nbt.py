@@ -9,6 +9,7 @@ except NameError:
     basestring = str  # compatibility for Python 3
     unicode = str  # compatibility for Python 3
 
+import codecs
 from collections import MutableMapping, MutableSequence, Sequence
 from struct import Struct, error as struct_error
 
@@ -292,7 +293,7 @@ class TagString(Tag, Sequence):
         read = buffer.read(length.value)
         if len(read) != length.value:
             raise struct_error()
-        self.value = read.decode("utf-8")
+        self.value = codecs.decode(read, "utf-8")
 
     def _render_buffer(self, buffer):
         save_val = self.value.encode("utf-8")
@@ -0,0 +1,253 @@
+"""
+Provides an asyncio backend for the event loop and the network.
+
+The AsyncioEventPlugin and AsyncioNetPlugin replace the default Event and Net
+plugins. Packets arrive through an asyncio Protocol, wall-clock timers wake
+the loop with call_at, and event_tick is emitted only after network activity
+or when a timer is due instead of in a busy loop, so idle bots cost next to
+nothing. All other plugins run unchanged.
+
+Requires Python 3.4 or newer. Use asyncio_plugins as the plugin list::
+
+    client = Client(plugins=asyncio_plugins,
+                    settings={'event': {'loop': loop}})
+
+client.start() blocks until the bot is killed if the loop isn't running yet.
+From inside a running loop it returns a future instead, which resolves once
+the bot has shut down.
+"""
+
+import asyncio
+import logging
+import signal
+
+from spockbot.mcp.mcpacket import MAX_DECOMPRESSED_SIZE
+from spockbot.plugins import default_plugins
+from spockbot.plugins.base import get_settings, pl_announce
+from spockbot.plugins.core.event import COPY_DEEPCOPY, EventCore
+from spockbot.plugins.core.net import NetCore, NetPlugin
+
+logger = logging.getLogger('spockbot')
+
+
+class AsyncioEventCore(EventCore):
+    """
+    EventCore driven by an asyncio loop.
+
+    event_tick is emitted once after every batch of received data and
+    whenever the nearest wall-clock timer or event_tick handler is due.
+    timers is set by the AsyncioNetPlugin, without it only network activity
+    and event_tick handlers cause ticks.
+    """
+    def __init__(self, loop=None, copy_policy=COPY_DEEPCOPY):
+        super(AsyncioEventCore, self).__init__(copy_policy)
+        self.loop = loop or asyncio.get_event_loop()
+        self.timers = None
+        self.done = None
+        self.tick_handle = None
+        self.wake_handle = None
+
+    def start(self):
+        """
+        Emits event_start and returns a future that resolves after
+        event_kill has been emitted
+        """
+        self.done = asyncio.Future(loop=self.loop)
+        self.emit('event_start')
+        self.tick_soon()
+        return self.done
+
+    def event_loop(self):
+        if self.loop.is_running():
+            return self.start()
+        signal.signal(signal.SIGINT, self.kill)
+        signal.signal(signal.SIGTERM, self.kill)
+        self.loop.run_until_complete(self.start())
+
+    def tick_soon(self):
+        if self.tick_handle is None:
+            self.tick_handle = self.loop.call_soon(self.wake)
+
+    def wake(self):
+        self.tick_handle = None
+        if self.wake_handle:
+            self.wake_handle.cancel()
+            self.wake_handle = None
+        if not self.kill_event:
+            self.tick()
+        if self.kill_event:
+            self.finish()
+            return
+        timeout = self.get_timeout(
+            self.timers.get_timeout() if self.timers else -1)
+        if timeout == 0:
+            self.tick_soon()
+        elif timeout > 0:
+            self.wake_handle = self.loop.call_at(
+                self.loop.time() + timeout, self.wake)
+
+    def finish(self):
+        if self.done is None or self.done.done():
+            return
+        logger.debug('EVENTCORE: Kill called, shutting down')
+        self.emit('event_kill')
+        self.done.set_result(None)
+
+    def kill(self, *args):
+        self.kill_event = True
+        if self.done is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.tick_soon)
+
+
+@pl_announce('Event')
+class AsyncioEventPlugin(object):
+    defaults = {
+        'copy_policy': COPY_DEEPCOPY,
+        'loop': None,
+    }
+
+    def __init__(self, ploader, settings):
+        settings = get_settings(self.defaults, settings)
+        ploader.provides('Event', AsyncioEventCore(settings['loop'],
+                                                   settings['copy_policy']))
+
+
+class NetProtocol(asyncio.Protocol):
+    def __init__(self, net):
+        self.net = net
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.net.connection_made(transport)
+
+    def data_received(self, data):
+        if self.net.transport is self.transport:
+            self.net.data_received(data)
+
+    def connection_lost(self, exc):
+        # Sockets closed by the NetPlugin itself have already been dealt with
+        if self.net.transport is self.transport:
+            self.net.connection_lost(exc)
+
+
+class AsyncioNetCore(NetCore):
+    """
+    NetCore that writes to an asyncio transport. Packets pushed before the
+    connection is up are sent as soon as it is.
+    """
+    def __init__(self, event, lazy_decode=False, coalesce=0,
+                 max_decompressed=MAX_DECOMPRESSED_SIZE):
+        super(AsyncioNetCore, self).__init__(
+            None, event, lazy_decode, coalesce=coalesce,
+            max_decompressed=max_decompressed)
+        self.transport = None
+
+    def connect(self, host='localhost', port=25565):
+        self.host = host
+        self.port = port
+        logger.debug("NETCORE: Attempting to connect to host: %s port: %s",
+                     host, port)
+        task = self.event.loop.create_task(self.event.loop.create_connection(
+            lambda: NetProtocol(self), host, port))
+        task.add_done_callback(self.connect_done)
+
+    def connect_done(self, task):
+        if not task.cancelled() and task.exception():
+            logger.error("NETCORE: Error on Connect")
+            self.event.emit('SOCKET_ERR', task.exception())
+            self.event.tick_soon()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.connected = True
+        if self.send_queue:
+            transport.write(self.send_queue.flush())
+        self.event.emit('net_connect', (self.host, self.port))
+        logger.debug("NETCORE: Connected to host: %s port: %s",
+                     self.host, self.port)
+        self.event.tick_soon()
+
+    def data_received(self, data):
+        self.read_packet(data)
+        self.event.tick_soon()
+
+    def connection_lost(self, exc):
+        if exc is None:
+            self.event.emit('SOCKET_HUP')
+        else:
+            self.event.emit('SOCKET_ERR', exc)
+        self.event.tick_soon()
+
+    def push(self, packet):
+        data = packet.encode(self.comp_state, self.comp_threshold)
+        if self.encrypted:
+            data = self.cipher.encrypt(data)
+        if self.transport is not None:
+            self.transport.write(data)
+        else:
+            self.send_queue.append(data)
+        self.event.emit(packet.ident, packet)
+        self.event.emit(packet.str_ident, packet)
+
+    def close(self):
+        transport, self.transport = self.transport, None
+        if transport is not None:
+            # Flushes anything still buffered before closing
+            transport.close()
+
+    def reset(self, sock=None):
+        self.__init__(self.event, self.lazy_decode, self.coalesce,
+                      self.max_decompressed)
+
+
+@pl_announce('Net')
+class AsyncioNetPlugin(NetPlugin):
+    events = dict(
+        (event, handler) for event, handler in NetPlugin.events.items()
+        if event not in ('event_tick', 'SOCKET_RECV', 'SOCKET_SEND')
+    )
+
+    def __init__(self, ploader, settings):
+        super(NetPlugin, self).__init__(ploader, settings)
+        self.sock_quit = self.settings['sock_quit']
+        self.net = AsyncioNetCore(self.event, self.settings['lazy_decode'],
+                                  self.settings['coalesce'],
+                                  self.settings['max_decompressed'])
+        self.sock_dead = False
+        self.event.timers = self.timers
+        ploader.provides('Net', self.net)
+
+    # SOCKET_ERR - Socket Error has occured
+    def handle_err(self, name, data):
+        self.net.close()
+        self.net.reset()
+        logger.error("NETPLUGIN: Socket Error: %s", data)
+        self.event.emit('net_disconnect', data)
+        if self.sock_quit and not self.event.kill_event:
+            self.sock_dead = True
+            self.event.kill()
+
+    # SOCKET_HUP - Socket has hung up
+    def handle_hup(self, name, data):
+        self.net.close()
+        self.net.reset()
+        logger.error("NETPLUGIN: Socket has hung up")
+        self.event.emit('net_disconnect', "Socket Hung Up")
+        if self.sock_quit and not self.event.kill_event:
+            self.sock_dead = True
+            self.event.kill()
+
+    # Kill event - Close the transport once it has sent everything
+    def handle_kill(self, name, data):
+        if self.net.connected:
+            logger.debug("NETPLUGIN: Kill event received, closing socket")
+            self.net.close()
+
+
+asyncio_plugins = [
+    (name, {
+        'event': AsyncioEventPlugin,
+        'net': AsyncioNetPlugin,
+    }.get(name, plugin)) for name, plugin in default_plugins
+]
@@ -1,46 +1,159 @@
 """
 Provides the core event loop
+
+Every handler gets its own copy of the event data by default. The
+copy_policy setting changes that:
+
+* ``deepcopy`` - deep copy the data for every handler (default)
+* ``copy-on-write`` - give handlers a proxy that only copies what they
+  access or modify, see spockbot.plugins.tools.cow
+* ``shared`` - every handler gets the same object, for trusted plugins
+
+Handlers registered with ``mutates=False``, or decorated with
+spockbot.plugins.tools.event.readonly, are given the original data. Under
+copy-on-write they get a read-only view of it instead, which raises
+TypeError when a handler modifies it by mistake.
+
+event_tick handlers can declare the cadence they need with ``interval`` or
+spockbot.plugins.tools.event.tick_interval. They only run when due, and
+get_timeout() tells the loop how long it may sleep before one is. Handlers
+without a cadence run on every iteration but never keep the loop awake.
+iterations and loop_rate count loop iterations.
 """
-import copy
 import logging
 import signal
+import time
 from collections import defaultdict
 
-from spockbot.plugins.base import pl_announce
+from spockbot.plugins.base import get_settings, pl_announce
+from spockbot.plugins.tools.cow import cow_copy, deep_copy, readonly_view
 from spockbot.plugins.tools.event import EVENT_UNREGISTER
 
 logger = logging.getLogger('spockbot')
 
+COPY_DEEPCOPY = 'deepcopy'
+COPY_ON_WRITE = 'copy-on-write'
+COPY_SHARED = 'shared'
+
+copy_policies = {
+    COPY_DEEPCOPY: deep_copy,
+    COPY_ON_WRITE: cow_copy,
+    COPY_SHARED: lambda data: data,
+}
+
+readonly_views = {
+    COPY_ON_WRITE: readonly_view,
+}
+
 
 class EventCore(object):
-    def __init__(self):
+    def __init__(self, copy_policy=COPY_DEEPCOPY):
+        if copy_policy not in copy_policies:
+            raise ValueError("Unknown event copy policy '%s'" % copy_policy)
         self.kill_event = False
         self.event_handlers = defaultdict(list)
-        signal.signal(signal.SIGINT, self.kill)
-        signal.signal(signal.SIGTERM, self.kill)
+        self.readonly_handlers = defaultdict(set)
+        self.copy_policy = copy_policy
+        self.copy_data = copy_policies[copy_policy]
+        self.view_data = readonly_views.get(copy_policy, lambda data: data)
+        # event_tick handler -> (interval, next due time)
+        self.tick_schedule = {}
+        self.iterations = 0
+        self.loop_rate = 0.0
+        self.rate_time = time.time()
+        self.rate_iterations = 0
 
     def event_loop(self):
+        signal.signal(signal.SIGINT, self.kill)
+        signal.signal(signal.SIGTERM, self.kill)
         self.emit('event_start')
         while not self.kill_event:
-            self.emit('event_tick')
+            self.tick()
         logger.debug('EVENTCORE: Kill called, shutting down')
         self.emit('event_kill')
 
-    def reg_event_handler(self, event, handler):
+    def reg_event_handler(self, event, handler, mutates=None, interval=None):
+        if mutates is None:
+            mutates = getattr(handler, 'mutates', True)
+        if interval is None:
+            interval = getattr(handler, 'tick_interval', None)
         self.event_handlers[event].append(handler)
+        if not mutates:
+            self.readonly_handlers[event].add(handler)
+        if event == 'event_tick' and interval is not None:
+            self.tick_schedule[handler] = (interval, 0)
+
+    def has_handlers(self, *events):
+        return any(self.event_handlers.get(event) for event in events)
+
+    def copies_data(self, *events):
+        """Whether any handler of events is given its own copy of the data"""
+        if self.copy_policy == COPY_SHARED:
+            return False
+        return any(handler not in self.readonly_handlers.get(event, ())
+                   for event in events
+                   for handler in self.event_handlers.get(event, ()))
 
     def emit(self, event, data=None):
+        self.dispatch(event, self.event_handlers[event], data)
+
+    def tick(self):
+        """
+        Runs one loop iteration, emitting event_tick to every handler
+        without a cadence and to the ones that are due
+        """
+        now = time.time()
+        self.iterations += 1
+        if now - self.rate_time >= 1:
+            self.loop_rate = ((self.iterations - self.rate_iterations) /
+                              (now - self.rate_time))
+            self.rate_time = now
+            self.rate_iterations = self.iterations
+        handlers = self.event_handlers['event_tick']
+        if self.tick_schedule:
+            due = []
+            for handler in handlers:
+                if handler in self.tick_schedule:
+                    interval, due_time = self.tick_schedule[handler]
+                    if due_time > now:
+                        continue
+                    self.tick_schedule[handler] = (interval, now + interval)
+                due.append(handler)
+            handlers = due
+        self.dispatch('event_tick', handlers)
+
+    def get_timeout(self, timeout=-1):
+        """
+        Returns how long the loop may sleep before an event_tick handler is
+        due, or timeout if that is sooner. -1 means no limit.
+        """
+        if self.tick_schedule:
+            due = min(d for _, d in self.tick_schedule.values())
+            due = max(0, due - time.time())
+            if timeout < 0 or due < timeout:
+                return due
+        return timeout
+
+    def dispatch(self, event, handlers, data=None):
         to_remove = []
+        readonly = self.readonly_handlers.get(event, ())
         # reversed, because handlers can register themselves
         # for the same event they handle, and the new handler
         # is appended to the end of the iterated handler list
         # and immediately run, so an infinite loop can be created
-        for handler in reversed(self.event_handlers[event]):
-            d = data.clone() if hasattr(data, 'clone') else copy.deepcopy(data)
+        for handler in reversed(handlers):
+            if handler in readonly:
+                d = self.view_data(data)
+            else:
+                d = self.copy_data(data)
             if handler(event, d) == EVENT_UNREGISTER:
                 to_remove.append(handler)
         for handler in to_remove:
             self.event_handlers[event].remove(handler)
+            if handler not in self.event_handlers[event]:
+                self.readonly_handlers[event].discard(handler)
+                if event == 'event_tick':
+                    self.tick_schedule.pop(handler, None)
 
     def kill(self, *args):
         self.kill_event = True
@@ -48,5 +161,10 @@ class EventCore(object):
 
 @pl_announce('Event')
 class EventPlugin(object):
+    defaults = {
+        'copy_policy': COPY_DEEPCOPY,
+    }
+
     def __init__(self, ploader, settings):
-        ploader.provides('Event', EventCore())
+        settings = get_settings(self.defaults, settings)
+        ploader.provides('Event', EventCore(settings['copy_policy']))
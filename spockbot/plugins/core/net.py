@@ -2,24 +2,53 @@
 Provides an asynchronous, crypto and compression aware socket for connecting to
 servers and processing incoming packet data.
 Coordinates with the Timers plugin to honor wall-clock timers
+
+By default every client polls its own socket on each event_tick. To run many
+clients in one process, create a Reactor, pass it to each client in the net
+plugin settings, and call Reactor.run() instead of starting the clients'
+event loops::
+
+    reactor = Reactor()
+    for name in names:
+        client = Client(settings={'net': {'reactor': reactor},
+                                  'start': {'username': name}})
+        client.start('localhost', 25565)
+    reactor.run()
 """
 
 import logging
+import os
 import select
+import signal
 import socket
 import time
+from collections import deque
+from itertools import islice
 
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import ciphers
 from cryptography.hazmat.primitives.ciphers import algorithms, modes
 
 from spockbot.mcp import mcdata, mcpacket
-from spockbot.mcp.bbuff import BoundBuffer, BufferUnderflowException
+from spockbot.mcp.bbuff import BufferUnderflowException, ZeroCopyBuffer
 from spockbot.plugins.base import PluginBase, pl_announce
 
+try:
+    import selectors
+except ImportError:  # Python 2 needs the selectors34 backport
+    try:
+        import selectors34 as selectors
+    except ImportError:
+        selectors = None
+
 logger = logging.getLogger('spockbot')
 backend = default_backend()
 
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
 
 class AESCipher(object):
     def __init__(self, shared_secret):
@@ -46,14 +75,15 @@ class SelectSocket(socket.socket):
         self.sending = False
         self.timer = timer
 
-    def poll(self):
+    def poll(self, timeout=None):
         flags = []
         if self.sending:
             self.sending = False
             slist = [(self,), (self,), (self,)]
         else:
             slist = [(self,), (), (self,)]
-        timeout = self.timer.get_timeout()
+        if timeout is None:
+            timeout = self.timer.get_timeout()
         if timeout >= 0:
             slist.append(timeout)
         try:
@@ -70,10 +100,203 @@ class SelectSocket(socket.socket):
         return flags
 
 
+class SendQueue(object):
+    """
+    Outgoing data waiting for the socket, kept as a deque of buffers so
+    partial sends never copy what is left.
+
+    send() hands as many buffers as the platform allows to a single
+    sendmsg() call, falling back to send() with the first buffer where
+    sendmsg() isn't available. Buffers shorter than coalesce bytes are
+    merged until the next send, so the small packets pushed during one tick
+    go out as one buffer. len() is the number of queued buffers and size the
+    number of bytes that haven't been handed to the socket yet.
+    """
+    def __init__(self, coalesce=0):
+        self.coalesce = coalesce
+        self.buffers = deque()
+        self.size = 0
+
+    def append(self, data):
+        if not data:
+            return
+        self.size += len(data)
+        if self.coalesce and len(data) < self.coalesce:
+            tail = self.buffers[-1] if self.buffers else None
+            # Only merge into buffers we own that haven't been sent from yet
+            if isinstance(tail, bytearray) and len(tail) < self.coalesce:
+                tail += data
+            else:
+                self.buffers.append(bytearray(data))
+        else:
+            self.buffers.append(data)
+
+    def send(self, sock):
+        if not self.buffers:
+            return 0
+        if hasattr(sock, 'sendmsg'):
+            sent = sock.sendmsg(list(islice(self.buffers, IOV_MAX)))
+        else:
+            sent = sock.send(self.buffers[0])
+        self.consume(sent)
+        return sent
+
+    def consume(self, count):
+        """Drops count bytes from the front of the queue"""
+        self.size -= count
+        while count:
+            head = self.buffers[0]
+            if count < len(head):
+                self.buffers[0] = memoryview(head)[count:]
+                break
+            count -= len(head)
+            self.buffers.popleft()
+
+    def flush(self):
+        """Removes and returns everything in the queue as one bytes object"""
+        data = b''.join(b.tobytes() if isinstance(b, memoryview) else bytes(b)
+                        for b in self.buffers)
+        self.buffers.clear()
+        self.size = 0
+        return data
+
+    def __len__(self):
+        return len(self.buffers)
+
+
+class Reactor(object):
+    """
+    Drives the event loops of many clients from a single selectors based
+    poll, epoll on Linux.
+
+    Clients join by passing the reactor in their net plugin settings. Each
+    iteration waits for socket activity or the nearest wall-clock timer of
+    any client, emits SOCKET_RECV and SOCKET_SEND on the clients whose
+    sockets are ready, then emits event_tick on every client. Killed clients
+    are dropped, and run() returns once no clients are left.
+    """
+    def __init__(self):
+        if selectors is None:
+            raise ImportError("Reactor needs the selectors module, install "
+                              "selectors34 on Python 2")
+        self.selector = selectors.DefaultSelector()
+        self.clients = []
+        self.started = False
+
+    def add_client(self, client):
+        """
+        Adds a client to the reactor, normally called by the NetPlugin.
+        client needs event, net and timers attributes.
+        """
+        client.reactor_sock = None
+        client.reactor_mask = 0
+        self.clients.append(client)
+        if self.started:
+            client.event.emit('event_start')
+
+    def remove_client(self, client):
+        self.unwatch(client)
+        self.clients.remove(client)
+
+    def watch(self, client):
+        """
+        Keeps the selector registration of a client in line with the state
+        of its NetCore, which replaces its socket after every error or hang up
+        """
+        net = client.net
+        sock = net.sock if net.connected else None
+        if sock is not client.reactor_sock:
+            self.unwatch(client)
+        if sock is None:
+            return
+        mask = selectors.EVENT_READ
+        if sock.sending:
+            mask |= selectors.EVENT_WRITE
+        if mask == client.reactor_mask:
+            return
+        try:
+            if client.reactor_sock is None:
+                self.selector.register(sock, mask, client)
+            else:
+                self.selector.modify(sock, mask, client)
+        except (ValueError, OSError, socket.error) as error:
+            logger.error("REACTOR: Socket Error: %s", str(error))
+            client.event.emit('SOCKET_ERR', error)
+            return
+        client.reactor_sock = sock
+        client.reactor_mask = mask
+
+    def unwatch(self, client):
+        if client.reactor_sock is not None:
+            try:
+                self.selector.unregister(client.reactor_sock)
+            except (KeyError, ValueError):
+                pass
+        client.reactor_sock = None
+        client.reactor_mask = 0
+
+    def get_timeout(self):
+        timeouts = []
+        for client in self.clients:
+            timeout = client.event.get_timeout(client.timers.get_timeout())
+            # Disconnected clients nap like a lone NetPlugin would
+            if not client.net.connected:
+                timeout = 1 if timeout < 0 else min(timeout, 1)
+            if timeout >= 0:
+                timeouts.append(timeout)
+        return min(timeouts) if timeouts else None
+
+    def poll(self):
+        for client in self.clients:
+            self.watch(client)
+        try:
+            ready = self.selector.select(self.get_timeout())
+        except (select.error, OSError) as e:
+            logger.error("REACTOR: Socket Error: %s", str(e))
+            ready = []
+        for key, mask in ready:
+            client = key.data
+            if key.fileobj is not client.reactor_sock:
+                continue
+            if mask & selectors.EVENT_READ:
+                client.event.emit('SOCKET_RECV')
+            if mask & selectors.EVENT_WRITE:
+                key.fileobj.sending = False
+                client.event.emit('SOCKET_SEND')
+
+    def run(self):
+        signal.signal(signal.SIGINT, self.kill)
+        signal.signal(signal.SIGTERM, self.kill)
+        self.started = True
+        for client in list(self.clients):
+            client.event.emit('event_start')
+        while self.clients:
+            self.poll()
+            for client in list(self.clients):
+                if not client.event.kill_event:
+                    client.event.tick()
+            for client in list(self.clients):
+                if client.event.kill_event:
+                    logger.debug('REACTOR: Kill called, dropping client')
+                    self.remove_client(client)
+                    client.event.emit('event_kill')
+        self.started = False
+
+    def kill(self, *args):
+        for client in self.clients:
+            client.event.kill()
+
+
 class NetCore(object):
-    def __init__(self, sock, event):
+    def __init__(self, sock, event, lazy_decode=False, reactor=None,
+                 coalesce=0, max_decompressed=mcpacket.MAX_DECOMPRESSED_SIZE):
         self.sock = sock
         self.event = event
+        self.lazy_decode = lazy_decode
+        self.reactor = reactor
+        self.coalesce = coalesce
+        self.max_decompressed = max_decompressed
+        self.inflater = mcpacket.Inflater(max_decompressed)
         self.host = None
         self.port = None
         self.connected = False
@@ -81,8 +304,8 @@ class NetCore(object):
         self.proto_state = mcdata.HANDSHAKE_STATE
         self.comp_state = mcdata.PROTO_COMP_OFF
         self.comp_threshold = -1
-        self.sbuff = b''
-        self.rbuff = BoundBuffer()
+        self.send_queue = SendQueue(coalesce)
+        self.rbuff = ZeroCopyBuffer()
 
     def connect(self, host='localhost', port=25565):
         self.host = host
@@ -112,7 +335,8 @@ class NetCore(object):
 
     def push(self, packet):
         data = packet.encode(self.comp_state, self.comp_threshold)
-        self.sbuff += (self.cipher.encrypt(data) if self.encrypted else data)
+        self.send_queue.append(
+            self.cipher.encrypt(data) if self.encrypted else data)
         self.event.emit(packet.ident, packet)
         self.event.emit(packet.str_ident, packet)
         self.sock.sending = True
@@ -129,20 +353,38 @@ class NetCore(object):
                 packet = mcpacket.Packet(ident=(
                     self.proto_state,
                     mcdata.SERVER_TO_CLIENT
-                )).decode(self.rbuff, self.comp_state)
+                )).decode(self.rbuff, self.comp_state, self.lazy_decode,
+                          self.inflater)
             except BufferUnderflowException:
                 self.rbuff.revert()
                 break
             except mcpacket.PacketDecodeFailure as err:
-                logger.warning('NETCORE: Packet decode failed')
-                logger.warning(
-                    'NETCORE: Failed packet ident is probably: %s',
-                    err.packet.str_ident
-                )
-                self.event.emit('PACKET_ERR', err)
+                self.decode_failed(err)
                 break
-            self.event.emit(packet.ident, packet)
-            self.event.emit(packet.str_ident, packet)
+            if self.lazy_decode:
+                events = packet.ident, packet.str_ident
+                # Nobody would ever look at the payload, skip it entirely
+                if not self.event.has_handlers(*events):
+                    continue
+            try:
+                # Handlers given copies would each decode the payload again,
+                # decode it once up front for them to copy instead
+                if self.lazy_decode and self.event.copies_data(*events):
+                    packet.data
+                self.event.emit(packet.ident, packet)
+                self.event.emit(packet.str_ident, packet)
+            except mcpacket.PacketDecodeFailure as err:
+                # A lazy payload fails in the first handler that reads it
+                self.decode_failed(err)
+                break
+
+    def decode_failed(self, err):
+        logger.warning('NETCORE: Packet decode failed')
+        logger.warning(
+            'NETCORE: Failed packet ident is probably: %s',
+            err.packet.str_ident
+        )
+        self.event.emit('PACKET_ERR', err)
 
     def enable_crypto(self, secret_key):
         self.cipher = AESCipher(secret_key)
@@ -153,7 +395,8 @@ class NetCore(object):
         self.encrypted = False
 
     def reset(self, sock):
-        self.__init__(sock, self.event)
+        self.__init__(sock, self.event, self.lazy_decode, self.reactor,
+                      self.coalesce, self.max_decompressed)
 
 
 @pl_announce('Net')
@@ -162,6 +405,10 @@ class NetPlugin(PluginBase):
     defaults = {
         'bufsize': 4096,
         'sock_quit': True,
+        'lazy_decode': False,
+        'reactor': None,
+        'coalesce': 0,
+        'max_decompressed': mcpacket.MAX_DECOMPRESSED_SIZE,
     }
     events = {
         'event_tick': 'tick',
@@ -182,16 +429,25 @@ class NetPlugin(PluginBase):
         self.bufsize = self.settings['bufsize']
         self.sock_quit = self.settings['sock_quit']
         self.sock = SelectSocket(self.timers)
-        self.net = NetCore(self.sock, self.event)
+        self.reactor = self.settings['reactor']
+        self.net = NetCore(self.sock, self.event,
+                           self.settings['lazy_decode'], self.reactor,
+                           self.settings['coalesce'],
+                           self.settings['max_decompressed'])
         self.sock_dead = False
         ploader.provides('Net', self.net)
+        if self.reactor:
+            self.reactor.add_client(self)
 
     def tick(self, name, data):
+        if self.reactor:
+            # The reactor polls every client's socket at once
+            return
+        timeout = self.event.get_timeout(self.timers.get_timeout())
         if self.net.connected:
-            for flag in self.sock.poll():
+            for flag in self.sock.poll(timeout):
                 self.event.emit(flag)
         else:
-            timeout = self.timers.get_timeout()
             if timeout == -1:
                 time.sleep(1)
             else:
@@ -214,9 +470,8 @@ class NetPlugin(PluginBase):
     def handle_send(self, name, data):
         if self.net.connected:
             try:
-                sent = self.sock.send(self.net.sbuff)
-                self.net.sbuff = self.net.sbuff[sent:]
-                if self.net.sbuff:
+                self.net.send_queue.send(self.sock)
+                if self.net.send_queue:
                     self.sock.sending = True
             except socket.error as error:
                 self.event.emit('SOCKET_ERR', error)
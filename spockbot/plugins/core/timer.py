@@ -4,6 +4,8 @@ registering them. Clock-time timers are as precise as the underlying OS
 makes them, server tick-timers are based on time updates from the server
 """
 
+import heapq
+import itertools
 import time
 
 from spockbot.plugins.base import PluginBase, pl_announce
@@ -79,30 +81,105 @@ class TickTimer(BaseTimer):
 
 
 class TimerCore(object):
+    """
+    Keeps EventTimers and TickTimers in two separate min-heaps ordered by
+    deadline, with a sequence number to keep timers due at the same time in
+    registration order. Any other BaseTimer is polled every tick.
+
+    Stopped timers are removed lazily once they reach the top of a heap, or
+    in one pass once enough of them have been cancelled.
+    """
+
     def __init__(self, world):
-        self.timers = []
-        self.persist_timers = []
         self.world = world
+        self.event_timers = []
+        self.tick_timers = []
+        self.polled_timers = []
+        self.cancelled = 0
+        self.counter = itertools.count()
 
     def reg_timer(self, timer, persist=False):
-        if not persist:
-            self.timers.append(timer)
+        entry = [0, next(self.counter), timer, persist]
+        if isinstance(timer, EventTimer):
+            entry[0] = timer.end_time
+            heapq.heappush(self.event_timers, entry)
+        elif isinstance(timer, TickTimer):
+            entry[0] = timer.end_tick
+            heapq.heappush(self.tick_timers, entry)
         else:
-            self.persist_timers.append(timer)
+            self.polled_timers.append(entry)
+        return timer
+
+    def cancel(self, timer):
+        timer.stop()
+        self.cancelled += 1
+        if self.cancelled > max(64, len(self) // 2):
+            self.compact()
+
+    def compact(self):
+        self.filter_timers(lambda entry: entry[2].get_runs())
+
+    def clear(self):
+        """Drops every timer that wasn't registered with persist"""
+        self.filter_timers(lambda entry: entry[3])
+
+    def filter_timers(self, keep):
+        self.event_timers = [e for e in self.event_timers if keep(e)]
+        self.tick_timers = [e for e in self.tick_timers if keep(e)]
+        self.polled_timers = [e for e in self.polled_timers if keep(e)]
+        heapq.heapify(self.event_timers)
+        heapq.heapify(self.tick_timers)
+        self.cancelled = 0
 
     def get_timeout(self):
-        timeout = -1
-        for timer in self.timers + self.persist_timers:
-            if timeout > timer.countdown() or timeout == -1:
-                timeout = timer.countdown()
-        return timeout
+        heap = self.event_timers
+        while heap and not heap[0][2].get_runs():
+            heapq.heappop(heap)
+        if not heap:
+            return -1
+        count = heap[0][0] - time.time()
+        return count if count > 0 else 0
+
+    def update(self):
+        self.fire_due(self.event_timers, time.time(), 'end_time')
+        self.fire_due(self.tick_timers, self.world.age, 'end_tick')
+        for entry in list(self.polled_timers):
+            timer = entry[2]
+            timer.update()
+            if not timer.get_runs():
+                self.polled_timers.remove(entry)
+
+    def fire_due(self, heap, now, deadline):
+        # Pop everything first so each timer fires at most once per update,
+        # even if it has no wait at all
+        due = []
+        while heap and heap[0][0] <= now:
+            due.append(heapq.heappop(heap))
+        for entry in due:
+            timer = entry[2]
+            if not timer.get_runs():
+                continue
+            # The timer was reset since it was queued
+            if getattr(timer, deadline) > now:
+                entry[0] = getattr(timer, deadline)
+                heapq.heappush(heap, entry)
+                continue
+            timer.fire()
+            if timer.get_runs():
+                entry[0] = getattr(timer, deadline)
+                entry[1] = next(self.counter)
+                heapq.heappush(heap, entry)
 
     def reg_event_timer(self, wait_time, callback, runs=-1, persist=False):
-        self.reg_timer(EventTimer(wait_time, callback, runs), persist)
+        return self.reg_timer(EventTimer(wait_time, callback, runs), persist)
 
     def reg_tick_timer(self, wait_ticks, callback, runs=-1, persist=False):
-        self.reg_timer(TickTimer(self.world, wait_ticks, callback, runs),
-                       persist)
+        return self.reg_timer(
+            TickTimer(self.world, wait_ticks, callback, runs), persist)
+
+    def __len__(self):
+        return len(self.event_timers) + len(self.tick_timers) + \
+            len(self.polled_timers)
 
 
 class WorldTick(object):
@@ -128,18 +205,11 @@ class TimerPlugin(PluginBase):
         ploader.provides('Timers', self.timer_core)
 
     def tick(self, name, data):
-        for timer in self.timer_core.timers:
-            timer.update()
-            if not timer.get_runs():
-                self.timer_core.timers.remove(timer)
-        for timer in self.timer_core.persist_timers:
-            timer.update()
-            if not timer.get_runs():
-                self.timer_core.persist_timers.remove(timer)
+        self.timer_core.update()
 
     # Time Update - We grab world age if the world plugin isn't available
     def handle_time_update(self, name, packet):
         self.world.age = packet.data['world_age']
 
     def handle_disconnect(self, name, data):
-        self.timer_core.timers = []
+        self.timer_core.clear()
@@ -2,8 +2,17 @@
 MovementPlugin provides a centralized plugin for controlling client
 movement so the client doesn't try to pull itself in a dozen
 directions.
+
+When a world_blocks_update changes a block next to the rest of the current
+path, the path is planned again from the bot's position with the
+pathfinding plugin's incremental replan() on the next action tick. The bot
+holds still until the new path is in, then current_path is updated in
+place. movement_path_failed is emitted and the bot stops if there is no way
+around.
 """
 
+import math
+
 from spockbot.plugins.base import PluginBase, pl_announce
 from spockbot.plugins.tools.event import EVENT_UNREGISTER
 from spockbot.vector import Vector3
@@ -43,12 +52,16 @@ class MovementPlugin(PluginBase):
         'client_tick': 'client_tick',
         'client_position_update': 'handle_position_update',
         'client_join_game': 'handle_join_game',
+        'world_blocks_update': 'handle_blocks_update',
     }
 
     def __init__(self, ploader, settings):
         super(MovementPlugin, self).__init__(ploader, settings)
 
         self.flag_pos_reset = False
+        self.flag_replan = False
+        # The path_nodes being planned again
+        self.replanning = None
         self.movement = MovementCore(self)
         self.connected_to_server = False
         ploader.provides('Movement', self.movement)
@@ -69,6 +82,48 @@ class MovementPlugin(PluginBase):
     def handle_position_update(self, name, data):
         self.flag_pos_reset = True
 
+    def handle_blocks_update(self, name, data):
+        if self.path_nodes and self.path_affected(data['positions']):
+            self.flag_replan = True
+
+    def path_affected(self, positions):
+        """Whether any of the blocks at positions, a flat sequence of x, y, z
+        triples, is in the way of the rest of the path"""
+        legs = []
+        start = self.clientinfo.position
+        for node in self.path_nodes:
+            legs.append((start, node))
+            start = node
+        for i in range(0, len(positions), 3):
+            x, y, z = positions[i:i + 3]
+            for a, b in legs:
+                # The floor under the bot up to the block above its head
+                if not min(a.y, b.y) - 2 < y < max(a.y, b.y) + 2:
+                    continue
+                if leg_distance(a, b, x + 0.5, z + 0.5) < 1.2:
+                    return True
+        return False
+
+    def replan(self):
+        self.flag_replan = False
+        self.replanning = self.path_nodes
+        self.pathfinding.replan(self.clientinfo.position,
+                                self.movement.final_target,
+                                self.replan_cb, self.replan_failed)
+
+    def replan_cb(self, nodes):
+        replanned, self.replanning = self.replanning, None
+        # Unless the bot stopped or got a new path in the meantime
+        if replanned is self.path_nodes:
+            self.path_nodes.clear()
+            self.path_nodes.extend(nodes)
+
+    def replan_failed(self, _):
+        replanned, self.replanning = self.replanning, None
+        if replanned is self.path_nodes:
+            self.movement.stop()
+            self.event.emit('movement_path_failed')
+
     def new_path(self, *xyz):
         target = Vector3(*xyz)
         self.pathfinding.pathfind(
@@ -77,13 +132,19 @@ class MovementPlugin(PluginBase):
 
     def path_cb(self, result):
         self.path_nodes = result
+        self.flag_replan = False
         self.event.emit('movement_path_done')
         self.event.reg_event_handler('action_tick', self.follow_path)
 
     def follow_path(self, _, __):
+        if self.flag_replan and self.path_nodes and self.replanning is None:
+            self.replan()
         if not self.path_nodes:
             self.movement.stop()
             return EVENT_UNREGISTER
+        if self.replanning is self.path_nodes:
+            # Hold still until the new path is in
+            return
         target = self.path_nodes[0]
         jumped = False
         if target.is_jump and self.clientinfo.position.on_ground:
@@ -93,3 +154,13 @@ class MovementPlugin(PluginBase):
             self.path_nodes.popleft()
             if not self.path_nodes:
                 self.movement.stop()
+
+
+def leg_distance(a, b, x, z):
+    """Horizontal distance from x, z to the leg from a to b"""
+    dx, dz = b.x - a.x, b.z - a.z
+    length = dx * dx + dz * dz
+    t = 0
+    if length:
+        t = max(0, min(1, ((x - a.x) * dx + (z - a.z) * dz) / float(length)))
+    return math.hypot(a.x + t * dx - x, a.z + t * dz - z)
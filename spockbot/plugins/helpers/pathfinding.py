@@ -1,13 +1,44 @@
 """
 Very rough asychronous pathfinding plugin
 Implements the Lazy Theta* pathfinding algorithm
+
+The open list is a binary heap of (f value, counter, node) entries, with a
+dict from position to the best node found so far for open membership and g
+score updates and a set of closed positions. An entry whose node has since
+been improved or closed is skipped when it comes off the heap.
+
+Node expansion reads which blocks are solid from a Walkability cache that
+holds a flag per block for every chunk section it has seen, computed in one
+go from the section's block data. The cache follows world_blocks_update,
+world_chunk_loaded and world_chunk_unload, and is emptied on world_reset and
+world_new_dimension. It is kept across searches unless the keep_walkability
+setting is False, then every search starts empty.
+
+Targets at least hierarchical_distance blocks away, 64 by default, are
+planned over chunk sections first (see spockbot.plugins.tools.hpa). The
+route found there is then refined with Lazy Theta* one leg at a time, each
+leg starting from the last node of the one before. When the coarse search
+finds no route, or a leg can't be refined, the search falls back to Lazy
+Theta* for the rest of the way. Set hierarchical_distance to 0 to always
+search the block grid directly.
+
+replan() plans again from the bot's position to a target with D* Lite (see
+spockbot.plugins.tools.dstar), for paths that world changes have blocked.
+The planner is kept for the target and follows block changes, so replanning
+to the same target again only repairs what changed. It runs in time slices
+like the other searches, and hands over to them after expanding
+replan_limit positions without finishing. The planner is dropped when
+chunks are loaded or unloaded or the world is reset.
 """
 
 import collections
+import heapq
+import itertools
 
 from spockbot.mcdata import blocks, constants as const
 from spockbot.mcdata.utils import BoundingBox
 from spockbot.plugins.base import PluginBase, pl_announce
+from spockbot.plugins.tools import dstar, hpa, smpmap
 from spockbot.plugins.tools.collision import(
     MTVTest, center_position, uncenter_position  # noqa
 )
@@ -21,21 +52,155 @@ PATH_LIMIT_REACHED = 0x03
 NO_VALID_PATH = 0x04
 
 
+_solid_table = []
+
+
+def solid_table():
+    """
+    Returns a bytearray holding a 1 for all block data, id << 4 | meta,
+    of blocks with a bounding box
+    """
+    if not _solid_table:
+        table = bytearray(1 << 16)
+        for block_id in blocks.blocks:
+            for meta in range(16):
+                if blocks.get_block(block_id, meta).bounding_box:
+                    table[block_id << 4 | meta] = 1
+        _solid_table.append(table)
+    return _solid_table[0]
+
+
+class Walkability(object):
+    """
+    Whether blocks are solid, one bytearray of flags per chunk section,
+    indexed like the section's block data
+    """
+    empty = bytes(bytearray(4096))
+
+    def __init__(self, world):
+        self.world = world
+        # (chunk_x, section_y, chunk_z) -> flags
+        self.sections = {}
+
+    def solid(self, x, y, z):
+        key = x >> 4, y >> 4, z >> 4
+        flags = self.sections.get(key)
+        if flags is None:
+            flags = self.sections[key] = self.load(*key)
+        return flags[(x & 0x0F) + ((z & 0x0F) << 4) + ((y & 0x0F) << 8)]
+
+    def near_solid(self, x, y, z):
+        """Whether any block collision.gen_block_set() checks is solid"""
+        solid = self.solid
+        return any(solid(x + dx, y + dy, z + dz) for dx in (-1, 0, 1)
+                   for dy in (0, 1, 2) for dz in (-1, 0, 1))
+
+    def load(self, cx, cy, cz):
+        if not 0 <= cy < 16:
+            return self.empty
+        if hasattr(self.world, 'load_missing'):
+            self.world.load_missing(cx, cz)
+        column = self.world.columns.get((cx, cz))
+        chunk = column.chunks[cy] if column is not None else None
+        if chunk is None:
+            return self.empty
+        table = solid_table()
+        if smpmap.numpy is not None:
+            lookup = smpmap.numpy.frombuffer(table, 'uint8')
+            return bytearray(lookup[chunk.block_data.blocks()].tobytes())
+        return bytearray(map(table.__getitem__, chunk.block_data.values()))
+
+    def update_blocks(self, positions, block_data):
+        """Updates the flags of changed blocks in sections already seen"""
+        table = solid_table()
+        for i, data in enumerate(block_data):
+            x, y, z = positions[i * 3:i * 3 + 3]
+            flags = self.sections.get((x >> 4, y >> 4, z >> 4))
+            if flags is not None and flags is not self.empty:
+                flags[(x & 0x0F) + ((z & 0x0F) << 4) +
+                      ((y & 0x0F) << 8)] = table[data]
+            elif flags is not None:
+                # Was an empty section, work it out again
+                del self.sections[x >> 4, y >> 4, z >> 4]
+
+    def drop_column(self, cx, cz):
+        for cy in range(16):
+            self.sections.pop((cx, cy, cz), None)
+
+    def clear(self):
+        self.sections = {}
+
+
 class PathfindingCore(object):
-    def __init__(self, start_path):
+    def __init__(self, start_path, replan):
         self.pathfind = start_path
+        self.replan = replan
 
 
 class Path(object):
     def __init__(self, start_node, end_node):
         self.end_node = end_node
-        self.open_list = [start_node]
-        self.closed_list = []
+        self.counter = itertools.count()
+        self.open_list = []
+        # position -> best open node, position of every closed node
+        self.open_nodes = {}
+        self.closed_set = set()
         self.result = None
+        self.push(start_node)
 
     def calc_f_val(self, node):
         return node.node_dist + self.end_node.dist(node)
 
+    def push(self, node):
+        """Opens node unless its position is closed or already open with a
+        g score that is as good"""
+        key = node.key()
+        if key in self.closed_set:
+            return
+        old = self.open_nodes.get(key)
+        if old is not None and old.node_dist <= node.node_dist:
+            return
+        self.open_nodes[key] = node
+        heapq.heappush(self.open_list,
+                       (self.calc_f_val(node), next(self.counter), node))
+
+    def pop(self):
+        """Returns the open node with the lowest f value, or None"""
+        while self.open_list:
+            _, _, node = heapq.heappop(self.open_list)
+            key = node.key()
+            if self.open_nodes.get(key) is node:
+                del self.open_nodes[key]
+                return node
+        return None
+
+    def close(self, node):
+        self.closed_set.add(node.key())
+
+
+class HierarchicalPath(object):
+    """
+    A coarse route over chunk sections, and the leg of it being refined
+    """
+    def __init__(self, start_node, end_node, graph):
+        self.end_node = end_node
+        self.abstract = hpa.AbstractSearch(
+            graph, tuple(start_node.floor()), tuple(end_node.floor()))
+        # Node the current leg starts from, centered nodes still to reach
+        self.last = start_node
+        self.waypoints = None
+        self.segment = None
+        self.fell_back = False
+        self.result = None
+
+    def next_segment(self):
+        self.segment = Path(self.last, self.waypoints.popleft())
+
+    def fall_back(self):
+        self.fell_back = True
+        self.waypoints = collections.deque([self.end_node])
+        self.next_segment()
+
 
 class PathNode(Vector3):
     def __init__(self, *xyz):
@@ -55,10 +220,25 @@ class PathNode(Vector3):
         self.is_jump = is_jump
         return self
 
+    def key(self):
+        return tuple(self.vector)
+
 
 @pl_announce('Pathfinding')
 class PathfindingPlugin(PluginBase):
     requires = ('Event', 'World', 'Physics', 'ClientInfo', 'Timers')
+    defaults = {
+        'keep_walkability': True,
+        'hierarchical_distance': 64,
+        'replan_limit': 20000,
+    }
+    events = {
+        'world_blocks_update': 'handle_blocks_update',
+        'world_chunk_loaded': 'handle_chunk_change',
+        'world_chunk_unload': 'handle_chunk_change',
+        'world_reset': 'handle_world_reset',
+        'world_new_dimension': 'handle_world_reset',
+    }
 
     def __init__(self, ploader, settings):
         super(PathfindingPlugin, self).__init__(ploader, settings)
@@ -68,7 +248,12 @@ class PathfindingPlugin(PluginBase):
         self.col = MTVTest(
             self.world, BoundingBox(const.PLAYER_WIDTH, const.PLAYER_HEIGHT)
         )
-        ploader.provides('Pathfinding', PathfindingCore(self.start_path))
+        self.walkability = Walkability(self.world)
+        self.clusters = hpa.ClusterGraph(self.walkability.solid)
+        self.planner = None
+        self.replan_job = None
+        ploader.provides('Pathfinding', PathfindingCore(self.start_path,
+                                                        self.replan))
 
     def build_list_from_node(self, node):
         ret = collections.deque()
@@ -80,28 +265,149 @@ class PathfindingPlugin(PluginBase):
     def start_path(self, pos, target, scb, fcb=None):
         pos = center_position(pos.floor(), BoundingBox(1, 1))
         target = center_position(target.floor(), BoundingBox(1, 1))
-        new_job = Path(PathNode(pos), PathNode(target)), scb, fcb
+        distance = self.settings['hierarchical_distance']
+        if distance and pos.dist(target) >= distance:
+            path = HierarchicalPath(PathNode(pos), PathNode(target),
+                                    self.clusters)
+        else:
+            path = Path(PathNode(pos), PathNode(target))
+        new_job = path, scb, fcb
+        if not self.settings['keep_walkability']:
+            self.walkability.clear()
         if self.path_job:
             self.path_job = new_job
             return
         self.path_job = new_job
         if not self.do_job():
-            self.event.reg_event_handler('event_tick', self.do_job)
+            self.event.reg_event_handler('event_tick', self.do_job,
+                                         interval=0)
 
     def do_job(self, _=None, __=None):
         path, scb, fcb = self.path_job
-        ret = self.pathfind(path)
+        if isinstance(path, HierarchicalPath):
+            ret = self.pathfind_hierarchical(path)
+        else:
+            ret = self.pathfind(path)
         if ret == FOUND_VALID_PATH:
             self.path_job = None
             scb(self.build_list_from_node(path.result))
             return EVENT_UNREGISTER
-        elif ret == NO_VALID_PATH and fcb:
+        elif ret == NO_VALID_PATH:
             self.path_job = None
-            fcb(None)
+            if fcb:
+                fcb(None)
+            return EVENT_UNREGISTER
+
+    def handle_blocks_update(self, _, data):
+        positions = data['positions']
+        self.walkability.update_blocks(positions, data['block_data'])
+        for i in range(0, len(positions), 3):
+            self.clusters.invalidate(*positions[i:i + 3])
+        if self.planner is not None:
+            self.planner.blocks_changed(positions)
+
+    def handle_chunk_change(self, _, data):
+        self.walkability.drop_column(data['chunk_x'], data['chunk_z'])
+        self.clusters.invalidate_column(data['chunk_x'], data['chunk_z'])
+        self.planner = None
+
+    def handle_world_reset(self, _, __):
+        # The world drops its columns without a world_chunk_unload for each
+        self.walkability.clear()
+        self.clusters.clear()
+        self.planner = None
+
+    def replan(self, pos, target, scb, fcb=None):
+        """
+        Plans from pos to target with the incremental planner and passes the
+        nodes of the path to scb like start_path(), or None to fcb if there
+        is no route. Runs in time slices like start_path(), and hands over
+        to start_path() after replan_limit expansions.
+        """
+        start = tuple(pos.floor())
+        if not self.clusters.standable(*start):
+            # In the air, plan from where the bot lands
+            below = start[0], start[1] - 1, start[2]
+            if self.clusters.standable(*below):
+                start = below
+        new_job = start, tuple(target.floor()), scb, fcb, 0
+        if self.replan_job:
+            self.replan_job = new_job
+            return
+        self.replan_job = new_job
+        if not self.do_replan():
+            self.event.reg_event_handler('event_tick', self.do_replan,
+                                         interval=0)
+
+    def do_replan(self, _=None, __=None):
+        start, goal, scb, fcb, expanded = self.replan_job
+        # Block and chunk changes since the last slice may have dropped or
+        # replaced the planner
+        if self.planner is None or self.planner.goal != goal:
+            self.planner = dstar.DStarLite(self.clusters, start, goal)
+        else:
+            self.planner.move_start(start)
+        planner = self.planner
+        before = planner.expanded
+        done = planner.compute(self.settings['replan_limit'] - expanded,
+                               self.timers.get_timeout)
+        expanded += planner.expanded - before
+        if not done:
+            if expanded < self.settings['replan_limit']:
+                self.replan_job = start, goal, scb, fcb, expanded
+                return
+            # Too much to repair, the regular search copes better with that
+            self.replan_job = None
+            self.start_path(Vector3(*start), Vector3(*goal), scb, fcb)
+            return EVENT_UNREGISTER
+        self.replan_job = None
+        route = planner.route()
+        if route is None:
+            if fcb:
+                fcb(None)
+            return EVENT_UNREGISTER
+        nodes = collections.deque()
+        parent = None
+        for x, y, z in route:
+            node = PathNode(x + 0.5, y, z + 0.5).set(
+                parent, parent is not None and y < parent.y,
+                parent is not None and y > parent.y)
+            nodes.append(node)
+            parent = node
+        scb(nodes)
+        return EVENT_UNREGISTER
+
+    def pathfind_hierarchical(self, path):
+        if path.waypoints is None:
+            if not path.abstract.run(self.timers.get_timeout):
+                return TIMEOUT_REACHED
+            if path.abstract.route is None:
+                path.fall_back()
+            else:
+                path.waypoints = collections.deque(
+                    PathNode(center_position(Vector3(*pos), BoundingBox(1, 1)))
+                    for pos in path.abstract.route[1:])
+                path.next_segment()
+        while True:
+            ret = self.pathfind(path.segment)
+            if ret == TIMEOUT_REACHED:
+                return ret
+            if ret == NO_VALID_PATH:
+                if path.fell_back:
+                    return ret
+                path.fall_back()
+                continue
+            path.last = path.segment.result
+            if not path.waypoints:
+                path.result = path.last
+                return FOUND_VALID_PATH
+            path.next_segment()
 
     def pathfind(self, path):
-        while path.open_list and self.timers.get_timeout():
-            cur_node = path.open_list.pop(0)
+        while path.open_nodes and self.timers.get_timeout():
+            cur_node = path.pop()
+            if cur_node is None:
+                break
             p = cur_node.parent
             if p is not None and not (p.is_fall or p.is_jump):
                 p = cur_node.parent.parent
@@ -112,12 +418,10 @@ class PathfindingPlugin(PluginBase):
             if cur_node == path.end_node:
                 path.result = cur_node
                 return FOUND_VALID_PATH
+            path.close(cur_node)
             for valid_node in self.find_valid_nodes(cur_node):
-                if valid_node not in (path.open_list + path.closed_list):
-                    path.open_list.append(valid_node)
-            path.open_list.sort(key=path.calc_f_val)
-            path.closed_list.append(cur_node)
-        if not path.open_list and cur_node != path.end_node:
+                path.push(valid_node)
+        if not path.open_nodes:
             return NO_VALID_PATH
         return TIMEOUT_REACHED
 
@@ -132,9 +436,12 @@ class PathfindingPlugin(PluginBase):
         i, r = divmod(path.dist(), depth.dist())
         for j in range(int(i)):
             pos += depth
-            if not self.get_block(pos.floor() - Vector3(0, 1, 0)).bounding_box:
+            x, y, z = pos.floor()
+            if not self.walkability.solid(x, y - 1, z):
                 return False
-            if any(self.col.block_collision(pos)):
+            # Only run the full collision test next to solid blocks
+            if self.walkability.near_solid(x, y, z) \
+                    and any(self.col.block_collision(pos)):
                 return False
         return True
 
@@ -143,14 +450,9 @@ class PathfindingPlugin(PluginBase):
         return blocks.get_block(block_id, meta)
 
     def check_for_bbox(self, pos):
-        pos = pos.floor()
-        block = self.get_block(pos)
-        if block.bounding_box:
-            return True
-        block = self.get_block(pos + Vector3(0, 1, 0))
-        if block.bounding_box:
-            return True
-        return False
+        x, y, z = pos.floor()
+        solid = self.walkability.solid
+        return bool(solid(x, y, z) or solid(x, y + 1, z))
 
     def check_node(self, node, offset, node_list, walk_fall=True, jump=True):
         w_node = PathNode(node + offset).set(node)
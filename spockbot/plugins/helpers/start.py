@@ -5,6 +5,9 @@ initialization plugin, so StartPlugin stays out of the way unless you
 call the start() method. However, the start() method is very convenient
 for demos and tutorials, and illustrates the basic steps for initializing
 a bot.
+
+Clients driven by a shared Reactor only remember the address in start(), the
+session begins when Reactor.run() is called.
 """
 
 from spockbot.mcp import mcdata
@@ -31,7 +34,8 @@ class StartPlugin(PluginBase):
     def start(self, host=None, port=None):
         self.host = host if host else self.settings['host']
         self.port = port if port else self.settings['port']
-        self.event.event_loop()
+        if not self.net.reactor:
+            return self.event.event_loop()
 
     def start_session(self, _, __):
         if 'error' not in self.auth.start_session(
@@ -3,33 +3,328 @@ Provides a very raw (but very fast) world map for use by plugins. Plugins
 interested in a more comprehensive world map view can use mcp.mapdata to
 interpret blocks and their metadata more comprehensively. Planned to provide
 light level interpretation based on sky light and time of day
+
+Chunk sections are stored with the palette backend by default, which keeps
+uniform sections and sections made of a few block types several times
+smaller than plain arrays. Sections are decoded into plain arrays and
+packed afterwards, one column every compact_rate seconds, so decoding
+chunks stays fast. Set the backend setting to 'array' for plain
+arrays, or to 'numpy' to store chunk sections in NumPy arrays, which makes
+get_blocks() and find_blocks() scans much faster
+
+nearest_blocks() and blocks_within() answer "where is the closest X" queries
+from an index of block positions per chunk section. A block id is indexed the
+first time it is searched for, after that the index follows chunk loads and
+block changes, so repeated searches don't rescan the world
+
+Columns the server unloads are dropped. To cap memory on long trips, set
+max_columns and an eviction policy: 'distance' drops the columns farthest
+from the player first, and also any column more than max_distance chunks
+away when that is set, 'lru' drops the columns that were least recently
+loaded, changed, read with get_blocks() or entered by the player. Single
+block reads and writes don't count as uses, so they stay as cheap as without
+eviction. world_chunk_unload is emitted for every column that goes away,
+with its chunk_x and chunk_z
+
+Set cache_path to a directory to keep explored terrain across sessions.
+Columns are written to region files there when they are unloaded or the bot
+disconnects, and get_block() loads columns the server hasn't sent from the
+cache, so pathfinding can plan over terrain explored in earlier sessions.
+Writes happen on a background thread, see spockbot.plugins.tools.region
+
+Block changes are applied in batches and announced with a single
+world_blocks_update event per packet, carrying 'positions', an
+array.array('i') of x, y, z triples, and 'block_data', an array.array('H')
+with the new data of each block. The Block Change packet also emits
+world_block_update. Set the block_update_events setting to emit
+world_block_update for every block of a Multi Block Change as well
+
+get_height() and get_heights() look up the highest solid, non-air or
+motion blocking block of a column from heightmaps kept with every column,
+instead of probing blocks one by one
+
+world_chunk_loaded is emitted with the chunk_x and chunk_z of every column
+that was loaded. Set decode_workers to decode chunks on that many threads
+instead of the event loop. Together with the net plugin's lazy_decode, that
+includes inflating them. Decoded columns are committed on the event loop, in
+the order the packets arrived, so readers never see a column half written,
+and block changes and the like wait for the chunks that came before them.
+poll_rate is how often the event loop checks for decoded chunks
+
+Bots that never look at light can set light to 'lazy', which keeps the raw
+light of every section and decodes it on the first get_light() or
+set_light(), or to 'none', which drops light when chunks are decoded so
+get_light() always returns 0. Columns cached to disk with 'none' are
+cached without light
 """
 
+import array
+import itertools
+import logging
+import os
+import struct
+from collections import deque
+
 from spockbot.mcp import mcdata
+from spockbot.mcp.bbuff import ViewBuffer
 from spockbot.plugins.base import PluginBase, pl_announce
-from spockbot.plugins.tools import smpmap
+from spockbot.plugins.tools import region, smpmap, workers
+from spockbot.plugins.tools.event import EVENT_UNREGISTER, readonly
+
+logger = logging.getLogger('spockbot')
+
+EVICT_DISTANCE = 'distance'
+EVICT_LRU = 'lru'
 
 
 class WorldData(smpmap.Dimension):
-    def __init__(self, dimension=mcdata.SMP_OVERWORLD):
-        super(WorldData, self).__init__(dimension)
+    def __init__(self, dimension=mcdata.SMP_OVERWORLD,
+                 backend=smpmap.BACKEND_PALETTE, eviction=None,
+                 max_columns=0, max_distance=0, cache_path=None,
+                 light=smpmap.LIGHT_FULL):
+        if eviction not in (None, EVICT_DISTANCE, EVICT_LRU):
+            raise ValueError("Unknown eviction policy '%s'" % eviction)
+        super(WorldData, self).__init__(dimension, backend, light)
+        self.block_index = smpmap.BlockIndex(self)
+        self.eviction = eviction
+        self.max_columns = max_columns
+        self.max_distance = max_distance
+        # (chunk_x, chunk_z) -> tick of the last use, for EVICT_LRU
+        self.column_used = {}
+        self.clock = itertools.count()
+        self.cache_path = cache_path
+        self.cache = self.open_cache(dimension)
+        # Columns loaded from the cache and not changed since
+        self.cached = set()
+        # Columns that aren't loaded and aren't in the cache either
+        self.cache_misses = set()
+        # Columns whose sections compact() hasn't packed yet
+        self.uncompacted = deque()
         self.age = 0
         self.time_of_day = 0
 
+    def open_cache(self, dimension):
+        if not self.cache_path:
+            return None
+        return region.RegionCache(
+            os.path.join(self.cache_path, 'DIM%d' % dimension))
+
+    def save_column(self, x, z):
+        """Queues column x, z to be written to the cache, if it changed"""
+        column = self.columns.get((x, z))
+        if self.cache is None or column is None or (x, z) in self.cached:
+            return
+        skylight = self.dimension == smpmap.DIMENSION_OVERWOLD
+        mask, data = column.pack(skylight)
+        self.cache.write(x, z, struct.pack('>H?', mask, skylight) + data)
+
+    def save_all(self):
+        for x, z in self.columns:
+            self.save_column(x, z)
+
+    def load_column(self, x, z):
+        """Loads column x, z from the cache, returns whether it was cached"""
+        data = self.cache.read(x, z) if self.cache is not None else None
+        if data is None:
+            return False
+        mask, skylight = struct.unpack_from('>H?', data)
+        column = self.column_type()
+        column.unpack(ViewBuffer(memoryview(data)[3:]), mask, skylight,
+                      light=self.light)
+        self.columns[x, z] = column
+        self.queue_compact(x, z)
+        self.cached.add((x, z))
+        self.block_index.update_column(x, z)
+        self.touch(x, z)
+        return True
+
+    def load_missing(self, x, z):
+        key = x, z
+        if self.cache is None or key in self.columns or \
+                key in self.cache_misses:
+            return
+        if not self.load_column(x, z):
+            self.cache_misses.add(key)
+
+    def close(self):
+        """Writes all loaded columns to the cache and closes it"""
+        if self.cache is not None:
+            self.save_all()
+            self.cache.close()
+            self.cache = None
+
+    def touch(self, x, z):
+        if self.eviction == EVICT_LRU and (x, z) in self.columns:
+            self.column_used[x, z] = next(self.clock)
+
+    def unload_column(self, x, z):
+        self.save_column(x, z)
+        self.cached.discard((x, z))
+        self.cache_misses.discard((x, z))
+        self.column_used.pop((x, z), None)
+        if not super(WorldData, self).unload_column(x, z):
+            return False
+        self.block_index.update_column(x, z)
+        return True
+
+    def evict(self, center=None):
+        """
+        Drops columns according to the eviction policy and returns the
+        (chunk_x, chunk_z) of every dropped column. center is the player's
+        (chunk_x, chunk_z), needed by the distance policy
+        """
+        if self.eviction is None:
+            return []
+        if self.eviction == EVICT_LRU:
+            ranked = sorted(self.columns,
+                            key=lambda k: self.column_used.get(k, -1))
+            evicted = []
+        elif center is None:
+            return []
+        else:
+            cx, cz = center
+            dist = dict((k, max(abs(k[0] - cx), abs(k[1] - cz)))
+                        for k in self.columns)
+            ranked = sorted(self.columns, key=dist.get, reverse=True)
+            evicted = [k for k in ranked
+                       if self.max_distance and dist[k] > self.max_distance]
+            ranked = ranked[len(evicted):]
+        if self.max_columns:
+            over = len(self.columns) - len(evicted) - self.max_columns
+            evicted.extend(ranked[:max(0, over)])
+        for key in evicted:
+            self.unload_column(*key)
+        return evicted
+
+    def drop_cached(self, x, z):
+        # The server's copy replaces the cached one entirely
+        if (x, z) in self.cached:
+            self.cached.discard((x, z))
+            del self.columns[x, z]
+
+    def queue_compact(self, x, z):
+        if self.backend == smpmap.BACKEND_PALETTE:
+            self.uncompacted.append((x, z))
+
+    def compact(self, count=1):
+        """
+        Packs the sections of up to count columns loaded since the last
+        call, returns whether there are more left
+        """
+        while count and self.uncompacted:
+            column = self.columns.get(self.uncompacted.popleft())
+            if column is not None:
+                column.compact()
+                count -= 1
+        return bool(self.uncompacted)
+
+    def commit_column(self, x, z, column, mask, continuous=True):
+        self.drop_cached(x, z)
+        super(WorldData, self).commit_column(x, z, column, mask, continuous)
+        self.queue_compact(x, z)
+        self.block_index.update_column(x, z, 0xFFFF if continuous else mask)
+        self.touch(x, z)
+
+    def get_block(self, x, y, z):
+        if self.cache is not None:
+            self.load_missing(int(x) // 16, int(z) // 16)
+        return super(WorldData, self).get_block(x, y, z)
+
+    def get_blocks(self, start, end):
+        for cx in range(int(start[0]) // 16, (int(end[0]) + 15) // 16):
+            for cz in range(int(start[2]) // 16, (int(end[2]) + 15) // 16):
+                self.touch(cx, cz)
+        return super(WorldData, self).get_blocks(start, end)
+
+    def get_height(self, x, z, kind=smpmap.HEIGHT_SOLID):
+        if self.cache is not None:
+            self.load_missing(int(x) // 16, int(z) // 16)
+        return super(WorldData, self).get_height(x, z, kind)
+
+    def set_block(self, x, y, z, block_id=None, meta=None, data=None):
+        self.load_missing(x // 16, z // 16)
+        old_id = self.get_block(x, y, z)[0] if self.block_index.index else 0
+        super(WorldData, self).set_block(x, y, z, block_id, meta, data)
+        self.cached.discard((x // 16, z // 16))
+        self.cache_misses.discard((x // 16, z // 16))
+        if data is not None:
+            block_id = data >> 4
+        self.block_index.update_block(x, y, z, old_id, block_id)
+
+    def set_blocks(self, positions, data):
+        keys = set((positions[i] // 16, positions[i + 2] // 16)
+                   for i in range(0, len(data) * 3, 3))
+        for x, z in keys:
+            self.load_missing(x, z)
+        if self.block_index.index:
+            old_ids = [self.get_block(*positions[i * 3:i * 3 + 3])[0]
+                       for i in range(len(data))]
+        super(WorldData, self).set_blocks(positions, data)
+        for x, z in keys:
+            self.cached.discard((x, z))
+            self.cache_misses.discard((x, z))
+            self.touch(x, z)
+        if self.block_index.index:
+            for i, d in enumerate(data):
+                x, y, z = positions[i * 3:i * 3 + 3]
+                self.block_index.update_block(x, y, z, old_ids[i], d >> 4)
+
+    def nearest_blocks(self, pos, block_ids, count=1, max_distance=None):
+        """
+        Returns the positions of the count loaded blocks with one of the
+        given ids nearest to pos, nearest first
+        """
+        return self.block_index.nearest(pos, block_ids, count, max_distance)
+
+    def blocks_within(self, pos, radius, block_ids):
+        """
+        Returns the positions of all loaded blocks with one of the given
+        ids within radius of pos, nearest first
+        """
+        return self.block_index.within(pos, radius, block_ids)
+
     def update_time(self, data):
         self.age = data['world_age']
         self.time_of_day = data['time_of_day']
 
     def new_dimension(self, dimension):
-        super(WorldData, self).__init__(dimension)
+        self.save_all()
+        if self.cache is not None and dimension != self.dimension:
+            self.cache.close()
+            self.cache = self.open_cache(dimension)
+        super(WorldData, self).__init__(dimension, self.backend, self.light)
+        self.column_used = {}
+        self.cached = set()
+        self.cache_misses = set()
+        self.uncompacted = deque()
+        tracked = list(self.block_index.index)
+        self.block_index = smpmap.BlockIndex(self)
+        self.block_index.track(tracked)
 
     def reset(self):
-        self.__init__(self.dimension)
+        tracked = list(self.block_index.index)
+        self.close()
+        self.__init__(self.dimension, self.backend, self.eviction,
+                      self.max_columns, self.max_distance, self.cache_path,
+                      self.light)
+        self.block_index.track(tracked)
 
 
 @pl_announce('World')
 class WorldPlugin(PluginBase):
     requires = 'Event'
+    defaults = {
+        'backend': smpmap.BACKEND_PALETTE,
+        'eviction': None,
+        'max_columns': 0,
+        'max_distance': 0,
+        'cache_path': None,
+        'block_update_events': False,
+        'decode_workers': 0,
+        'poll_rate': 0.005,
+        'compact_rate': 0.05,
+        'light': smpmap.LIGHT_FULL,
+    }
     events = {
         'PLAY<Join Game': 'handle_new_dimension',
         'PLAY<Respawn': 'handle_new_dimension',
@@ -39,13 +334,51 @@ class WorldPlugin(PluginBase):
         'PLAY<Block Change': 'handle_block_change',
         'PLAY<Map Chunk Bulk': 'handle_map_chunk_bulk',
         'net_disconnect': 'handle_disconnect',
+        'client_position_update': 'handle_position_update',
+        'event_kill': 'handle_kill',
     }
 
     def __init__(self, ploader, settings):
         super(WorldPlugin, self).__init__(ploader, settings)
-        self.world = WorldData()
+        self.world = WorldData(backend=self.settings['backend'],
+                               eviction=self.settings['eviction'],
+                               max_columns=self.settings['max_columns'],
+                               max_distance=self.settings['max_distance'],
+                               cache_path=self.settings['cache_path'],
+                               light=self.settings['light'])
+        self.center = None
+        # The dimension of the packets coming in, which chunks still being
+        # decoded from before a Respawn don't belong to
+        self.dimension = self.world.dimension
+        self.pool = None
+        if self.settings['decode_workers']:
+            self.pool = workers.WorkerPool(self.settings['decode_workers'])
+        # (job, commit) in the order the packets arrived, job is None for
+        # changes that waited for earlier chunks to be committed
+        self.pending = deque()
+        self.compacting = False
         ploader.provides('World', self.world)
 
+    def emit_unload(self, keys):
+        for chunk_x, chunk_z in keys:
+            self.event.emit('world_chunk_unload', {
+                'chunk_x': chunk_x,
+                'chunk_z': chunk_z,
+            })
+
+    def evict(self):
+        self.emit_unload(self.world.evict(self.center))
+
+    # Position Update - Drop columns that are now too far away
+    @readonly
+    def handle_position_update(self, name, position):
+        center = int(position.x) // 16, int(position.z) // 16
+        if center != self.center:
+            self.center = center
+            self.world.touch(*center)
+            if self.world.eviction == EVICT_DISTANCE:
+                self.evict()
+
     # Time Update - Update World Time
     def handle_time_update(self, name, packet):
         self.world.update_time(packet.data)
@@ -53,42 +386,152 @@ class WorldPlugin(PluginBase):
 
     # Join Game/Respawn - New Dimension
     def handle_new_dimension(self, name, packet):
-        self.world.new_dimension(packet.data['dimension'])
-        self.event.emit('world_new_dimension', packet.data['dimension'])
+        self.dimension = packet.data['dimension']
+        self.defer(self.new_dimension, self.dimension)
+
+    def new_dimension(self, dimension):
+        self.world.new_dimension(dimension)
+        self.event.emit('world_new_dimension', dimension)
+
+    def run(self, decode, commit, packet, *args):
+        """
+        Runs decode(packet, *args) and passes the result to commit(), right
+        away or, with decode workers, on the pool and then back on the event
+        loop
+        """
+        if self.pool is None:
+            commit(decode(packet, *args))
+            return
+        # Lazily decoded packets are inflated by the worker, a clone shares
+        # the raw payload without sharing the decoding
+        job = self.pool.submit(decode, packet.clone(), *args)
+        self.pending.append((job, commit))
+        if len(self.pending) == 1:
+            self.event.reg_event_handler('event_tick', self.commit_ready,
+                                         interval=self.settings['poll_rate'])
+
+    def defer(self, func, *args):
+        """Runs func once every chunk received before it is committed"""
+        if self.pending:
+            self.pending.append((None, lambda: func(*args)))
+        else:
+            func(*args)
+
+    def commit_ready(self, name=None, data=None):
+        while self.pending:
+            job, commit = self.pending[0]
+            if job is not None and not job.done:
+                return
+            self.pending.popleft()
+            if job is None:
+                commit()
+            elif job.error is None:
+                commit(job.result)
+            else:
+                # The worker logged the traceback, the data is lost
+                logger.error('WORLD: Dropped %s that failed to decode: %r',
+                             job.args[0].str_ident, job.error)
+        return EVENT_UNREGISTER
+
+    def decode_chunk_data(self, packet, skylight):
+        data = packet.data
+        return [(data['chunk_x'], data['chunk_z'], data['primary_bitmap'],
+                 data['continuous'], self.world.decode_column(data, skylight))]
+
+    def decode_bulk(self, packet):
+        return [(meta['chunk_x'], meta['chunk_z'], meta['primary_bitmap'],
+                 True, column)
+                for meta, column in self.world.decode_bulk(packet.data)]
+
+    def commit_columns(self, columns):
+        for chunk_x, chunk_z, mask, continuous, column in columns:
+            if column is None:
+                if self.world.unload_column(chunk_x, chunk_z):
+                    self.emit_unload([(chunk_x, chunk_z)])
+                continue
+            self.world.commit_column(chunk_x, chunk_z, column, mask,
+                                     continuous)
+            self.event.emit('world_chunk_loaded', {
+                'chunk_x': chunk_x,
+                'chunk_z': chunk_z,
+            })
+        self.evict()
+        if self.world.uncompacted and not self.compacting:
+            self.compacting = True
+            self.event.reg_event_handler(
+                'event_tick', self.compact_columns,
+                interval=self.settings['compact_rate'])
+
+    def compact_columns(self, name=None, data=None):
+        # One column per call, so compacting never holds up the event loop
+        if not self.world.compact():
+            self.compacting = False
+            return EVENT_UNREGISTER
 
     # Chunk Data - Update World state
+    @readonly
     def handle_chunk_data(self, name, packet):
-        self.world.unpack_column(packet.data)
+        self.run(self.decode_chunk_data, self.commit_columns, packet,
+                 self.dimension == smpmap.DIMENSION_OVERWOLD)
+
+    # Map Chunk Bulk - Update World state
+    @readonly
+    def handle_map_chunk_bulk(self, name, packet):
+        self.run(self.decode_bulk, self.commit_columns, packet)
 
     # Multi Block Change - Update multiple blocks
+    @readonly
     def handle_multi_block_change(self, name, packet):
+        self.defer(self.multi_block_change, packet)
+
+    def multi_block_change(self, packet):
         chunk_x = packet.data['chunk_x'] * 16
         chunk_z = packet.data['chunk_z'] * 16
-        for block in packet.data['blocks']:
-            x = block['x'] + chunk_x
-            z = block['z'] + chunk_z
-            y = block['y']
-            self.world.set_block(x, y, z, data=block['block_data'])
-            self.event.emit('world_block_update', {
-                'location': {
-                    'x': x,
-                    'y': y,
-                    'z': z,
-                },
-                'block_data': block['block_data'],
-            })
+        blocks = packet.data['blocks']
+        positions = array.array('i', [0]) * (len(blocks) * 3)
+        positions[0::3] = array.array('i', [b['x'] + chunk_x for b in blocks])
+        positions[1::3] = array.array('i', [b['y'] for b in blocks])
+        positions[2::3] = array.array('i', [b['z'] + chunk_z for b in blocks])
+        block_data = array.array('H', [b['block_data'] for b in blocks])
+        self.world.set_blocks(positions, block_data)
+        self.event.emit('world_blocks_update', {
+            'positions': positions,
+            'block_data': block_data,
+        })
+        if self.settings['block_update_events']:
+            for i, d in enumerate(block_data):
+                self.event.emit('world_block_update', {
+                    'location': {
+                        'x': positions[i * 3],
+                        'y': positions[i * 3 + 1],
+                        'z': positions[i * 3 + 2],
+                    },
+                    'block_data': d,
+                })
 
     # Block Change - Update a single block
     def handle_block_change(self, name, packet):
+        self.defer(self.block_change, packet)
+
+    def block_change(self, packet):
         p = packet.data['location']
         block_data = packet.data['block_data']
         self.world.set_block(p['x'], p['y'], p['z'], data=block_data)
+        self.event.emit('world_blocks_update', {
+            'positions': array.array('i', [p['x'], p['y'], p['z']]),
+            'block_data': array.array('H', [block_data]),
+        })
         self.event.emit('world_block_update', packet.data)
 
-    # Map Chunk Bulk - Update World state
-    def handle_map_chunk_bulk(self, name, packet):
-        self.world.unpack_bulk(packet.data)
-
     def handle_disconnect(self, name, data):
+        self.defer(self.reset)
+
+    def reset(self):
         self.world.reset()
         self.event.emit('world_reset')
+
+    # Kill - Write the cache before shutting down
+    def handle_kill(self, name, data):
+        if self.pool is not None:
+            self.pool.close()
+        self.world.close()
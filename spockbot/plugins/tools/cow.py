@@ -0,0 +1,178 @@
+"""
+Copy-on-write proxies used by the event system to hand out event data
+without deep copying it for every handler, and read-only views for the
+handlers that promise not to modify it
+"""
+
+import copy
+
+try:
+    from collections.abc import Mapping, MutableMapping, Sequence
+except ImportError:
+    from collections import Mapping, MutableMapping, Sequence
+
+import six
+
+from spockbot.mcp.mcpacket import Packet
+
+immutable_types = six.string_types + six.integer_types + (
+    six.binary_type, float, bool, type(None))
+
+
+def deep_copy(data):
+    return data.clone() if hasattr(data, 'clone') else copy.deepcopy(data)
+
+
+class CowDict(MutableMapping):
+    """
+    A mapping that reads through to a shared base mapping.
+
+    Writes and deletes only touch this proxy. Mutable values are deep copied
+    the first time they are read, so nested changes never reach the base
+    either. Immutable values, like the byte strings holding chunk data, are
+    never copied at all.
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self.local = {}
+        self.deleted = set()
+
+    def __getitem__(self, key):
+        if key in self.local:
+            return self.local[key]
+        if key in self.deleted:
+            raise KeyError(key)
+        value = self.base[key]
+        if not isinstance(value, immutable_types):
+            value = self.local[key] = deep_copy(value)
+        return value
+
+    def __setitem__(self, key, value):
+        self.local[key] = value
+        self.deleted.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.local.pop(key, None)
+        self.deleted.add(key)
+
+    def __contains__(self, key):
+        if key in self.local:
+            return True
+        return key not in self.deleted and key in self.base
+
+    def __iter__(self):
+        for key in self.base:
+            if key not in self.deleted:
+                yield key
+        for key in self.local:
+            if key not in self.base:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class ReadOnlyDict(Mapping):
+    """
+    A view of a mapping that raises TypeError on writes. Nested mappings and
+    lists are handed out as read-only views as well.
+    """
+
+    def __init__(self, base):
+        self.base = base
+
+    def __getitem__(self, key):
+        return readonly_view(self.base[key])
+
+    def __setitem__(self, key, value):
+        raise TypeError('Event data is read-only')
+
+    def __delitem__(self, key):
+        raise TypeError('Event data is read-only')
+
+    def __contains__(self, key):
+        return key in self.base
+
+    def __iter__(self):
+        return iter(self.base)
+
+    def __len__(self):
+        return len(self.base)
+
+    def __eq__(self, other):
+        if isinstance(other, (ReadOnlyDict, ReadOnlyList)):
+            other = other.base
+        return self.base == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self.base)
+
+
+class ReadOnlyList(Sequence):
+    """A view of a list that raises TypeError on writes"""
+
+    def __init__(self, base):
+        self.base = base
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return ReadOnlyList(self.base[index])
+        return readonly_view(self.base[index])
+
+    def __setitem__(self, index, value):
+        raise TypeError('Event data is read-only')
+
+    def __delitem__(self, index):
+        raise TypeError('Event data is read-only')
+
+    def __len__(self):
+        return len(self.base)
+
+    def __eq__(self, other):
+        if isinstance(other, (ReadOnlyDict, ReadOnlyList)):
+            other = other.base
+        return self.base == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self.base)
+
+
+def readonly_view(data):
+    """
+    Returns a view of data that can't be modified, without copying it.
+    Packets that haven't been decoded yet are returned as they are.
+    """
+    if isinstance(data, Packet):
+        if not data.decoded:
+            return data
+        return Packet(data.ident, ReadOnlyDict(data.data))
+    if isinstance(data, Mapping):
+        return ReadOnlyDict(data)
+    if isinstance(data, list):
+        return ReadOnlyList(data)
+    return data
+
+
+def cow_copy(data):
+    if isinstance(data, immutable_types):
+        return data
+    if isinstance(data, Packet):
+        # Packets that haven't been decoded yet are cheap to clone
+        if not data.decoded:
+            return data.clone()
+        return Packet(data.ident, CowDict(data.data))
+    if isinstance(data, Mapping):
+        return CowDict(data)
+    return deep_copy(data)
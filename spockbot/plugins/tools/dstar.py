@@ -0,0 +1,169 @@
+"""
+Incremental replanning with D* Lite
+
+DStarLite plans over the moves of an hpa.ClusterGraph, backwards from the
+goal, and keeps its search state between plans. After blocks_changed() it
+only repairs the costs the changed blocks affect, and move_start() lets the
+start follow the bot without invalidating anything, so replanning around a
+block placed on the path touches a small part of the graph instead of
+searching again from scratch.
+
+See S. Koenig and M. Likhachev, D* Lite, AAAI 2002. This is the optimized
+version, with stale queue entries left in the heap and skipped when popped.
+"""
+
+import heapq
+import itertools
+import math
+
+from spockbot.plugins.tools.hpa import MAX_DROP
+
+INF = float('inf')
+
+
+def distance(a, b):
+    return math.sqrt(sum((i - j) ** 2 for i, j in zip(a, b)))
+
+
+class DStarLite(object):
+    """
+    Plans from position start to position goal over graph. compute()
+    brings the plan up to date, route() returns it.
+    """
+    def __init__(self, graph, start, goal):
+        self.graph = graph
+        self.start = self.last = start
+        self.goal = goal
+        self.km = 0
+        self.g = {}
+        self.rhs = {goal: 0}
+        self.queue = []
+        # position -> key of its live entry in queue
+        self.keys = {}
+        self.counter = itertools.count()
+        # Cached (position, cost) of the moves from and to a position
+        self.succs = {}
+        self.preds = {}
+        self.expanded = 0
+        self.push(goal)
+
+    def key(self, pos):
+        best = min(self.g.get(pos, INF), self.rhs.get(pos, INF))
+        return best + distance(self.start, pos) + self.km, best
+
+    def push(self, pos):
+        key = self.keys[pos] = self.key(pos)
+        heapq.heappush(self.queue, (key, next(self.counter), pos))
+
+    def successors(self, pos):
+        succs = self.succs.get(pos)
+        if succs is None:
+            succs = self.succs[pos] = self.graph.moves(*pos) \
+                if self.graph.standable(*pos) else []
+        return succs
+
+    def predecessors(self, pos):
+        preds = self.preds.get(pos)
+        if preds is None:
+            preds = self.preds[pos] = []
+            x, y, z = pos
+            for dx in (-1, 0, 1):
+                for dz in (-1, 0, 1):
+                    if not dx and not dz:
+                        continue
+                    for other_y in range(y - 1, y + MAX_DROP + 1):
+                        other = x + dx, other_y, z + dz
+                        for succ, cost in self.successors(other):
+                            if succ == pos:
+                                preds.append((other, cost))
+        return preds
+
+    def update_vertex(self, pos):
+        if pos != self.goal:
+            best = INF
+            for succ, cost in self.successors(pos):
+                best = min(best, cost + self.g.get(succ, INF))
+            self.rhs[pos] = best
+        self.keys.pop(pos, None)
+        if self.g.get(pos, INF) != self.rhs.get(pos, INF):
+            self.push(pos)
+
+    def compute(self, limit=None, keep_going=None):
+        """
+        Repairs the plan, expanding at most limit positions and only while
+        keep_going() is true. Returns whether the plan is done, call again
+        to go on if it isn't.
+        """
+        expanded = 0
+        while self.queue:
+            key, _, pos = self.queue[0]
+            if self.keys.get(pos) != key:
+                heapq.heappop(self.queue)
+                continue
+            start_g = self.g.get(self.start, INF)
+            if key >= self.key(self.start) and \
+                    self.rhs.get(self.start, INF) == start_g:
+                break
+            if limit is not None and expanded >= limit or \
+                    keep_going is not None and not keep_going():
+                self.expanded += expanded
+                return False
+            expanded += 1
+            heapq.heappop(self.queue)
+            del self.keys[pos]
+            new_key = self.key(pos)
+            if key < new_key:
+                self.push(pos)
+            elif self.g.get(pos, INF) > self.rhs[pos]:
+                self.g[pos] = self.rhs[pos]
+                for pred, _ in self.predecessors(pos):
+                    self.update_vertex(pred)
+            else:
+                self.g[pos] = INF
+                self.update_vertex(pos)
+                for pred, _ in self.predecessors(pos):
+                    self.update_vertex(pred)
+        self.expanded += expanded
+        return True
+
+    def move_start(self, start):
+        if start != self.start:
+            self.km += distance(self.last, start)
+            self.start = self.last = start
+
+    def blocks_changed(self, positions):
+        """Updates the positions whose moves the changed blocks affect,
+        positions is a flat sequence of x, y, z triples"""
+        affected = set()
+        for i in range(0, len(positions), 3):
+            x, y, z = positions[i:i + 3]
+            affected.update(
+                (ax, ay, az) for ax in range(x - 1, x + 2)
+                for ay in range(y - 2, y + MAX_DROP + 2)
+                for az in range(z - 1, z + 2))
+        if not affected:
+            return
+        for pos in affected:
+            self.succs.pop(pos, None)
+        self.preds = {}
+        for pos in affected:
+            self.update_vertex(pos)
+
+    def route(self):
+        """Returns the positions from start to goal, or None"""
+        if self.g.get(self.start, INF) == INF:
+            return None
+        pos = self.start
+        route = [pos]
+        seen = {pos}
+        while pos != self.goal:
+            best, best_cost = None, INF
+            for succ, cost in self.successors(pos):
+                if cost + self.g.get(succ, INF) < best_cost:
+                    best, best_cost = succ, cost + self.g.get(succ, INF)
+            if best is None or best in seen:
+                return None
+            route.append(best)
+            seen.add(best)
+            pos = best
+        return route
@@ -1,2 +1,24 @@
 """Used for unregistering event handlers"""
 EVENT_UNREGISTER = 0x1
+
+
+def readonly(handler):
+    """
+    Marks an event handler as never modifying the event data it is passed,
+    so the event system can hand it the original instead of a copy
+    """
+    handler.mutates = False
+    return handler
+
+
+def tick_interval(seconds):
+    """
+    Declares how often an event_tick handler needs to run. The handler is
+    skipped on loop iterations before it is due, and the loop won't sleep
+    past the moment it is. An interval of 0 runs it every iteration and
+    keeps the loop from sleeping while it is registered.
+    """
+    def inner(handler):
+        handler.tick_interval = seconds
+        return handler
+    return inner
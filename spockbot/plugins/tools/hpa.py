@@ -0,0 +1,250 @@
+"""
+Hierarchical pathfinding over chunk sections (HPA*)
+
+Every chunk section is a cluster. Positions a bot can stand on, with free
+blocks for its feet and head above a solid one, are linked by the moves the
+pathfinding plugin makes: a step to one of the eight neighbours, which may
+fall up to MAX_DROP blocks, or a jump one block up. Diagonal moves need
+both of the straight moves next to them, like in the plugin. A move that
+ends in another cluster is a transition. Transitions into the same cluster
+are grouped into runs of neighbouring positions, and only the middle one of
+every run is kept, so a cluster has a few entrances per side.
+
+The abstract graph has the transitions as edges between entrances, and the
+cost of walking between two positions of the same cluster, found with
+Dijkstra's algorithm inside the cluster the first time a search needs it.
+Both are cached per cluster. invalidate() drops the clusters a block change
+can affect and invalidate_column() the ones around a loaded or unloaded
+column, which are rebuilt the next time a search gets there.
+
+AbstractSearch runs A* over the graph in slices like the grid search and
+ends with the route, the positions it passes through from start to goal.
+The model is slightly more permissive than the grid search, which e.g.
+doesn't jump right after falling, so every leg of the route still has to be
+refined on the block grid.
+"""
+
+import heapq
+import itertools
+import math
+
+MAX_DROP = 3
+
+CARDINALS = (1, 0), (0, 1), (-1, 0), (0, -1)
+# Pairs of CARDINALS a diagonal move goes between
+DIAGONALS = (0, 1), (2, 3), (0, 3), (2, 1)
+
+
+def cluster_of(pos):
+    return pos[0] >> 4, pos[1] >> 4, pos[2] >> 4
+
+
+class Cluster(object):
+    def __init__(self, transitions):
+        # (position, position in another cluster, cost) of every entrance
+        self.transitions = transitions
+        # position -> {position: cost} of the positions it can reach
+        self.distances = {}
+        # position -> (position, cost) of the moves that stay inside
+        self.moves = {}
+
+
+class ClusterGraph(object):
+    """
+    The abstract graph over the world described by solid(x, y, z), which
+    tells whether the block at x, y, z is solid
+    """
+    def __init__(self, solid):
+        self.solid = solid
+        # (chunk_x, section_y, chunk_z) -> Cluster
+        self.clusters = {}
+
+    def standable(self, x, y, z):
+        solid = self.solid
+        return bool(solid(x, y - 1, z) and not solid(x, y, z) and
+                    not solid(x, y + 1, z))
+
+    def step(self, x, y, z, dx, dz, walk, jump, moves):
+        """
+        Adds the move from x, y, z by dx, dz to moves, returns whether it
+        could walk or fall and whether it could jump that way
+        """
+        solid = self.solid
+        nx, nz = x + dx, z + dz
+        walked = jumped = False
+        if walk and not solid(nx, y, nz) and not solid(nx, y + 1, nz):
+            walked = True
+            for ny in range(y, y - MAX_DROP - 1, -1):
+                if solid(nx, ny - 1, nz):
+                    moves.append(((nx, ny, nz), math.sqrt(
+                        dx * dx + dz * dz + (y - ny) * (y - ny))))
+                    break
+        if jump and not walked and not solid(nx, y + 1, nz) and \
+                not solid(nx, y + 2, nz):
+            jumped = True
+            moves.append(((nx, y + 1, nz), math.sqrt(dx * dx + dz * dz + 1)))
+        return walked, jumped
+
+    def moves(self, x, y, z):
+        """Returns (position, cost) of every move from x, y, z"""
+        moves = []
+        walks, jumps = [], []
+        for dx, dz in CARDINALS:
+            walked, jumped = self.step(x, y, z, dx, dz, True, True, moves)
+            walks.append(walked)
+            jumps.append(jumped)
+        for a, b in DIAGONALS:
+            self.step(x, y, z, CARDINALS[a][0] + CARDINALS[b][0],
+                      CARDINALS[a][1] + CARDINALS[b][1],
+                      walks[a] and walks[b], jumps[a] and jumps[b], moves)
+        return moves
+
+    def cluster(self, key):
+        cluster = self.clusters.get(key)
+        if cluster is None:
+            cluster = self.clusters[key] = Cluster(self.transitions(key))
+        return cluster
+
+    def transitions(self, key):
+        """Finds the entrances out of cluster key"""
+        cx, cy, cz = key
+        found = {}
+        for y in range(cy * 16, cy * 16 + 16):
+            # Jumps and falls only cross the top and bottom from here
+            edge_y = y % 16 <= MAX_DROP or y % 16 == 15
+            for z in range(cz * 16, cz * 16 + 16):
+                edge_z = z % 16 in (0, 15)
+                for x in range(cx * 16, cx * 16 + 16):
+                    if not (edge_y or edge_z or x % 16 in (0, 15)):
+                        continue
+                    if not self.standable(x, y, z):
+                        continue
+                    for pos, cost in self.moves(x, y, z):
+                        other = cluster_of(pos)
+                        if other != key:
+                            found.setdefault(other, []).append(
+                                ((x, y, z), pos, cost))
+        transitions = []
+        for group in found.values():
+            for run in runs(group):
+                transitions.append(run[len(run) // 2])
+        return transitions
+
+    def distances(self, key, start):
+        """Returns the costs from start to every position it can reach
+        without leaving cluster key"""
+        cluster = self.cluster(key)
+        dist = cluster.distances.get(start)
+        if dist is not None:
+            return dist
+        dist = {start: 0}
+        heap = [(0, start)]
+        while heap:
+            d, pos = heapq.heappop(heap)
+            if d > dist[pos]:
+                continue
+            moves = cluster.moves.get(pos)
+            if moves is None:
+                moves = cluster.moves[pos] = [
+                    (other, cost) for other, cost in self.moves(*pos)
+                    if cluster_of(other) == key]
+            for other, cost in moves:
+                if d + cost < dist.get(other, float('inf')):
+                    dist[other] = d + cost
+                    heapq.heappush(heap, (d + cost, other))
+        cluster.distances[start] = dist
+        return dist
+
+    def edges(self, pos, goal):
+        """Returns (position, cost) of every abstract edge from pos"""
+        key = cluster_of(pos)
+        cluster = self.cluster(key)
+        dist = self.distances(key, pos)
+        edges = []
+        for start, end, cost in cluster.transitions:
+            if start == pos:
+                edges.append((end, cost))
+            elif start in dist:
+                edges.append((start, dist[start]))
+        if cluster_of(goal) == key and goal in dist:
+            edges.append((goal, dist[goal]))
+        return edges
+
+    def invalidate(self, x, y, z):
+        """Drops the clusters a change of block x, y, z can affect"""
+        for cx in {(x - 1) >> 4, (x + 1) >> 4}:
+            for cy in {(y - 2) >> 4, (y + MAX_DROP + 1) >> 4}:
+                for cz in {(z - 1) >> 4, (z + 1) >> 4}:
+                    self.clusters.pop((cx, cy, cz), None)
+
+    def invalidate_column(self, chunk_x, chunk_z):
+        """Drops the clusters in and next to column chunk_x, chunk_z"""
+        for key in list(self.clusters):
+            if abs(key[0] - chunk_x) <= 1 and abs(key[2] - chunk_z) <= 1:
+                del self.clusters[key]
+
+    def clear(self):
+        self.clusters = {}
+
+
+def runs(transitions):
+    """Splits transitions into runs whose start positions touch"""
+    transitions = sorted(transitions)
+    result = []
+    for transition in transitions:
+        x, y, z = transition[0]
+        for run in result:
+            if any(abs(x - a) <= 1 and abs(y - b) <= 1 and abs(z - c) <= 1
+                   for (a, b, c), _, _ in run):
+                run.append(transition)
+                break
+        else:
+            result.append([transition])
+    return result
+
+
+class AbstractSearch(object):
+    """
+    A* from position start to position goal over graph. run() searches
+    while keep_going() is true and returns whether the search is over,
+    route is then the list of positions from start to goal, or None if
+    the graph doesn't connect them.
+    """
+    def __init__(self, graph, start, goal):
+        self.graph = graph
+        self.start = start
+        self.goal = goal
+        self.counter = itertools.count()
+        self.open_list = [(self.estimate(start), next(self.counter), start)]
+        self.g_score = {start: 0}
+        self.parents = {start: None}
+        self.closed_set = set()
+        self.route = None
+
+    def estimate(self, pos):
+        return math.sqrt(sum((a - b) ** 2 for a, b in zip(pos, self.goal)))
+
+    def run(self, keep_going):
+        while self.open_list and keep_going():
+            _, _, pos = heapq.heappop(self.open_list)
+            if pos in self.closed_set:
+                continue
+            if pos == self.goal:
+                self.route = []
+                while pos is not None:
+                    self.route.append(pos)
+                    pos = self.parents[pos]
+                self.route.reverse()
+                return True
+            self.closed_set.add(pos)
+            g = self.g_score[pos]
+            for other, cost in self.graph.edges(pos, self.goal):
+                if other in self.closed_set:
+                    continue
+                if g + cost < self.g_score.get(other, float('inf')):
+                    self.g_score[other] = g + cost
+                    self.parents[other] = pos
+                    heapq.heappush(self.open_list, (
+                        g + cost + self.estimate(other), next(self.counter),
+                        other))
+        return not self.open_list
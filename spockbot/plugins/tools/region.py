@@ -0,0 +1,193 @@
+"""
+Region files for caching chunk columns on disk
+
+Every region file holds the 32x32 columns whose chunk coordinates share
+x >> 5 and z >> 5, in the layout of vanilla's region files: a 4 KiB table of
+locations, a 4 KiB table of timestamps, then the columns, each in a run of
+4 KiB sectors starting with its length and compression type. Column data is
+opaque to this module, WorldData stores sections packed as in Chunk Data.
+
+Reads go through a read-only memory map of the file. RegionCache queues
+writes and compresses and writes them from a background thread, reads of a
+column that is still queued are served from the queue.
+"""
+
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+logger = logging.getLogger('spockbot')
+
+SECTOR_SIZE = 4096
+HEADER_SECTORS = 2
+COMPRESSION_ZLIB = 2
+
+
+class RegionFile(object):
+    """ One region file, opened or created at path. """
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(b'\0' * SECTOR_SIZE * HEADER_SECTORS)
+        self.file = open(path, 'r+b')
+        self.map = None
+        self.remap()
+        self.locations = list(struct.unpack('>1024I', self.map[:4096]))
+        self.lock = threading.Lock()
+
+    def remap(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.flush()
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read(self, x, z):
+        """Returns the compressed data of column x, z, or None"""
+        location = self.locations[(x & 31) + (z & 31) * 32]
+        if not location:
+            return None
+        start = (location >> 8) * SECTOR_SIZE
+        with self.lock:
+            if start + 5 > len(self.map):
+                self.remap()
+            length, compression = struct.unpack_from('>IB', self.map, start)
+            if compression != COMPRESSION_ZLIB:
+                logger.warning('REGION: Unknown compression %d in %s',
+                               compression, self.path)
+                return None
+            if start + 4 + length > len(self.map):
+                self.remap()
+            return self.map[start + 5:start + 4 + length]
+
+    def write(self, x, z, data):
+        """Writes the compressed data of column x, z"""
+        i = (x & 31) + (z & 31) * 32
+        sectors = (len(data) + 5 + SECTOR_SIZE - 1) // SECTOR_SIZE
+        if sectors > 0xFF:
+            logger.warning('REGION: Column %d, %d is too large to cache',
+                           x, z)
+            return
+        with self.lock:
+            offset, count = self.locations[i] >> 8, self.locations[i] & 0xFF
+            if not offset or count < sectors:
+                # Doesn't fit where it was, append it
+                self.file.seek(0, os.SEEK_END)
+                offset = max(HEADER_SECTORS, self.file.tell() // SECTOR_SIZE)
+            padding = sectors * SECTOR_SIZE - len(data) - 5
+            self.file.seek(offset * SECTOR_SIZE)
+            self.file.write(struct.pack('>IB', len(data) + 1,
+                                        COMPRESSION_ZLIB))
+            self.file.write(data)
+            self.file.write(b'\0' * padding)
+            self.locations[i] = (offset << 8) | sectors
+            self.file.seek(i * 4)
+            self.file.write(struct.pack('>I', self.locations[i]))
+            self.file.seek(SECTOR_SIZE + i * 4)
+            self.file.write(struct.pack('>I', int(time.time())))
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.map.close()
+            self.file.close()
+
+
+class RegionCache(object):
+    """
+    Column data cached in the region files in directory path, which is
+    created if needed. write() returns right away, the data is compressed
+    and written by a daemon thread. Call close() to write everything that
+    is still queued.
+    """
+    def __init__(self, path, level=6):
+        self.path = path
+        self.level = level
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        # (region_x, region_z) -> RegionFile, or None if there is no file
+        self.regions = {}
+        self.pending = {}
+        self.busy = False
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run,
+                                       name='RegionCache writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def region(self, x, z, create=False):
+        key = x >> 5, z >> 5
+        region = self.regions.get(key)
+        if region is None and (create or key not in self.regions):
+            path = os.path.join(self.path, 'r.%d.%d.smp' % key)
+            if create or os.path.exists(path):
+                region = RegionFile(path)
+            self.regions[key] = region
+        return region
+
+    def read(self, x, z):
+        """Returns the data of column x, z, or None if it isn't cached"""
+        with self.cond:
+            if (x, z) in self.pending:
+                return self.pending[x, z]
+            region = self.region(x, z)
+        data = region.read(x, z) if region is not None else None
+        if data is None:
+            return None
+        try:
+            return zlib.decompress(data)
+        except zlib.error:
+            logger.warning('REGION: Column %d, %d is corrupt', x, z)
+            return None
+
+    def write(self, x, z, data):
+        """Queues the data of column x, z to be written"""
+        with self.cond:
+            self.pending[x, z] = data
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+                key = next(iter(self.pending))
+                data = self.pending[key]
+                self.busy = True
+            try:
+                compressed = zlib.compress(data, self.level)
+                with self.cond:
+                    region = self.region(*key, create=True)
+                region.write(key[0], key[1], compressed)
+            except (IOError, OSError) as e:
+                logger.error('REGION: Failed to write column %d, %d: %s',
+                             key[0], key[1], e)
+            with self.cond:
+                # Leave it queued if it was written again in the meantime
+                if self.pending.get(key) is data:
+                    del self.pending[key]
+                self.busy = False
+                self.cond.notify_all()
+
+    def flush(self):
+        """Blocks until everything queued has been written"""
+        with self.cond:
+            while self.pending or self.busy:
+                self.cond.wait()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        for region in self.regions.values():
+            if region is not None:
+                region.close()
+        self.regions = {}
@@ -14,21 +14,124 @@ ex.
 [256]-[511] are X = 0-15, Z = 0-15, Y = 1
 and so on
 
+Light and metadata nibbles follow the same order, two to a byte, with the
+lower index in the low nibble.
+
+Sections are stored in array.array objects by default. With the numpy
+backend every section is a (16, 16, 16) uint16 array of block data and two
+uint8 arrays of light, indexed [y, z, x], with the light nibbles expanded
+once when the section is unpacked. The palette backend stores every
+section's block data as indices into a palette of the values it contains,
+with no indices at all when a section holds a single value, 4 bits per
+block for up to 16 values and 8 bits for up to 256. Sections with more
+values than that fall back to plain 16 bit storage. Unpacking only spots
+sections of a single value, everything else starts out in 16 bit storage
+until compact() packs the column, which keeps decoding as fast as with
+plain arrays. Light nibbles take a single value until a section's light
+varies. get_blocks() and find_blocks()
+need NumPy, but work with any backend.
+
+Light is decoded with the blocks by default. With LIGHT_LAZY every section
+keeps its raw light bytes and only decodes them the first time they're read
+or written, with LIGHT_NONE light isn't stored at all and reads as 0.
+
+Every column keeps heightmaps of its highest non-air block, its highest
+solid block and its highest block that blocks motion, solid or liquid.
+They are computed section by section the first time get_height() needs
+them after a column is unpacked, then kept up to date by set_block(), so
+get_height() never has to probe blocks.
 """
 
 import array
+import heapq
+
+import six
 
-from spockbot.mcp.bbuff import BoundBuffer
+from spockbot.mcdata import blocks as mcblocks
+from spockbot.mcp.bbuff import ViewBuffer
+from spockbot.vector import Vector3
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 DIMENSION_NETHER = -0x01
 DIMENSION_OVERWOLD = 0x00
 DIMENSION_END = 0x01
 
+BACKEND_ARRAY = 'array'
+BACKEND_NUMPY = 'numpy'
+BACKEND_PALETTE = 'palette'
+
+LIGHT_FULL = 'full'
+LIGHT_LAZY = 'lazy'
+LIGHT_NONE = 'none'
+
+HEIGHT_SURFACE = 0
+HEIGHT_SOLID = 1
+HEIGHT_MOTION_BLOCKING = 2
+
+LIQUIDS = 'water', 'flowing_water', 'lava', 'flowing_lava'
+
 
 def mapshort2id(data):
     return data >> 4, data & 0x0F
 
 
+if six.PY2:
+    def array_from(ty, data):
+        """Copies any buffer, like a memoryview slice, into a new array"""
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        out = array.array(ty)
+        out.fromstring(data)
+        return out
+else:
+    def array_from(ty, data):
+        """Copies any buffer, like a memoryview slice, into a new array"""
+        out = array.array(ty)
+        out.frombytes(data)
+        return out
+
+
+def buffer_bytes(data):
+    """Returns the contents of a memoryview slice, bytes as they are"""
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return data
+
+
+_height_tables = []
+
+
+def height_tables():
+    """
+    Returns a lookup table per heightmap, bytearrays holding a 1 for every
+    block id that counts for it
+    """
+    if not _height_tables:
+        surface = bytearray(b'\x01') * 4096
+        surface[0] = 0
+        solid = bytearray(4096)
+        motion = bytearray(4096)
+        for block_id, block in mcblocks.blocks.items():
+            if block.bounding_box is not None:
+                solid[block_id] = motion[block_id] = 1
+            elif block.name in LIQUIDS:
+                motion[block_id] = 1
+        _height_tables[:] = surface, solid, motion
+    return _height_tables
+
+
+# A layer of a section's block data with nothing but air
+empty_layer = array.array('H', [0]) * 256
+
+# Light nibble sections where every nibble has the same value
+uniform_nibbles = dict(
+    (v * 0x11, bytes(bytearray([v * 0x11])) * 2048) for v in range(16))
+
+
 class ChunkData(object):
     length = 16 * 16 * 16
     ty = 'B'
@@ -36,10 +139,12 @@ class ChunkData(object):
 
     def fill(self):
         if not self.data:
-            self.data = array.array(self.ty, [0] * self.length)
+            # length is in bytes
+            self.data = array.array(self.ty, [0]) * (
+                self.length // array.array(self.ty).itemsize)
 
     def unpack(self, buff):
-        self.data = array.array(self.ty, buff.read(self.length))
+        self.data = array_from(self.ty, buff.read(self.length))
 
     def pack(self):
         self.fill()
@@ -53,6 +158,15 @@ class ChunkData(object):
         self.fill()
         self.data[x + ((y * 16) + z) * 16] = data
 
+    def values(self):
+        self.fill()
+        return self.data
+
+    def blocks(self):
+        """Returns the data as a (16, 16, 16) NumPy view indexed [y, z, x]"""
+        self.fill()
+        return numpy.frombuffer(self.data, self.ty).reshape(16, 16, 16)
+
 
 class BiomeData(ChunkData):
     """ A 16x16 array stored in each ChunkColumn. """
@@ -81,74 +195,657 @@ class ChunkDataNibble(ChunkData):
 
     def get(self, x, y, z):
         self.fill()
-        x, r = divmod(x, 2)
-        i = x + ((y * 16) + z) * 16
-        return self.data[i] & 0x0F if r else self.data[i] >> 4
+        i, r = divmod(x + ((y * 16) + z) * 16, 2)
+        return self.data[i] >> 4 if r else self.data[i] & 0x0F
 
     def set(self, x, y, z, data):
         self.fill()
-        x, r = divmod(x, 2)
-        i = x + ((y * 16) + z) * 16
+        i, r = divmod(x + ((y * 16) + z) * 16, 2)
         if r:
+            self.data[i] = (self.data[i] & 0x0F) | ((data & 0x0F) << 4)
+        else:
             self.data[i] = (self.data[i] & 0xF0) | (data & 0x0F)
+
+
+class NumpyChunkData(object):
+    """ A 16x16x16 NumPy array indexed [y, z, x]. """
+    dtype = 'uint16'
+    length = 16 * 16 * 16 * 2
+
+    def __init__(self):
+        self.data = numpy.zeros((16, 16, 16), self.dtype)
+
+    def unpack(self, buff):
+        self.data = numpy.frombuffer(buff.read(self.length), '<u2') \
+            .astype(self.dtype).reshape(16, 16, 16)
+
+    def pack(self):
+        return self.data.astype('<u2').tobytes()
+
+    def get(self, x, y, z):
+        return int(self.data[y, z, x])
+
+    def set(self, x, y, z, data):
+        self.data[y, z, x] = data
+
+    def blocks(self):
+        return self.data
+
+
+class NumpyChunkDataNibble(NumpyChunkData):
+    """ Light or metadata nibbles, expanded to one uint8 per block. """
+    dtype = 'uint8'
+    length = 16 * 16 * 8
+
+    def unpack(self, buff):
+        packed = numpy.frombuffer(buff.read(self.length), 'uint8')
+        data = numpy.empty(self.length * 2, 'uint8')
+        data[0::2] = packed & 0x0F
+        data[1::2] = packed >> 4
+        self.data = data.reshape(16, 16, 16)
+
+    def pack(self):
+        data = self.data.reshape(-1)
+        return (data[0::2] | (data[1::2] << 4)).tobytes()
+
+    def set(self, x, y, z, data):
+        self.data[y, z, x] = data & 0x0F
+
+
+class PaletteChunkData(ChunkDataShort):
+    """
+    Block IDs/Metadata stored as indices into the palette of values used in
+    the section. bits is 0, 4 or 8 while the palette fits, and 16 once the
+    section holds more than 256 values and data is a plain ChunkDataShort
+    array without a palette.
+    """
+
+    def __init__(self):
+        self.palette = [0]
+        self.ids = {0: 0}
+        self.bits = 0
+        self.data = None
+
+    def load(self, values):
+        """
+        Replaces the section with 4096 values, from an 'H' array or any
+        buffer holding them. A section of a single value is stored as
+        such, anything else as a plain array until compact() packs it, so
+        loading never does work per value in Python.
+        """
+        # Comparing bytes is a memcmp, comparing a memoryview is not
+        if isinstance(values, array.array):
+            raw = values.tobytes()
         else:
-            self.data[i] = (self.data[i] & 0x0F) | ((data & 0x0F) << 4)
+            raw = values = buffer_bytes(values)
+        if raw == raw[:2] * (self.length // 2):
+            first = array_from(self.ty, raw[:2])[0]
+            self.palette = [first]
+            self.ids = {first: 0}
+            self.bits = 0
+            self.data = None
+            return
+        if not isinstance(values, array.array):
+            values = array_from(self.ty, values)
+        self.palette = self.ids = None
+        self.bits = 16
+        self.data = values
+
+    def compact(self):
+        """Packs a section stored as a plain array into a palette, if the
+        section holds no more than 256 values"""
+        if self.bits != 16:
+            return
+        values = self.data
+        if numpy is not None:
+            data = numpy.frombuffer(values, 'uint16')
+            palette = numpy.flatnonzero(numpy.bincount(data)).tolist()
+        else:
+            palette = sorted(set(values))
+        if len(palette) > 256:
+            return
+        self.palette = palette
+        self.ids = dict((v, i) for i, v in enumerate(palette))
+        self.bits = 8 if len(palette) > 16 else 4
+        if numpy is not None:
+            lookup = numpy.zeros(palette[-1] + 1, 'uint8')
+            lookup[palette] = numpy.arange(len(palette))
+            indices = lookup.take(data)
+            if self.bits == 4:
+                indices = indices[0::2] | (indices[1::2] << 4)
+            self.data = array_from('B', indices)
+        else:
+            indices = array.array('B', map(self.ids.__getitem__, values))
+            if self.bits == 4:
+                indices = array.array('B', [
+                    a | (b << 4)
+                    for a, b in zip(indices[0::2], indices[1::2])])
+            self.data = indices
+
+    def unpack(self, buff):
+        self.load(buff.read(self.length))
+
+    def pack(self):
+        return self.values().tobytes()
+
+    def get(self, x, y, z):
+        i = x + ((y * 16) + z) * 16
+        if self.bits == 0:
+            return self.palette[0]
+        if self.bits == 4:
+            b = self.data[i >> 1]
+            return self.palette[b >> 4 if i & 1 else b & 0x0F]
+        if self.bits == 8:
+            return self.palette[self.data[i]]
+        return self.data[i]
+
+    def set(self, x, y, z, data):
+        i = x + ((y * 16) + z) * 16
+        if self.bits == 16:
+            self.data[i] = data
+            return
+        index = self.ids.get(data)
+        if index is None:
+            if len(self.palette) >= 1 << self.bits:
+                # Full palette, repack with more bits per block
+                values = self.values()
+                values[i] = data
+                self.load(values)
+                self.compact()
+                return
+            index = len(self.palette)
+            self.palette.append(data)
+            self.ids[data] = index
+        if self.bits == 0:
+            return
+        if self.bits == 4:
+            j, r = divmod(i, 2)
+            if r:
+                self.data[j] = (self.data[j] & 0x0F) | (index << 4)
+            else:
+                self.data[j] = (self.data[j] & 0xF0) | index
+        else:
+            self.data[i] = index
+
+    def values(self):
+        """Returns a new 'H' array of all 4096 values"""
+        if self.bits == 16:
+            return self.data
+        if numpy is not None:
+            return array.array(self.ty, self.blocks().tobytes())
+        palette = self.palette
+        if self.bits == 0:
+            return array.array(self.ty, palette) * 4096
+        if self.bits == 8:
+            return array.array(self.ty, [palette[i] for i in self.data])
+        values = array.array(self.ty, [0]) * 4096
+        values[0::2] = array.array(self.ty, [palette[b & 0x0F]
+                                             for b in self.data])
+        values[1::2] = array.array(self.ty, [palette[b >> 4]
+                                             for b in self.data])
+        return values
+
+    def blocks(self):
+        """
+        Returns the data as a (16, 16, 16) NumPy array indexed [y, z, x],
+        a copy unless the section is stored without a palette
+        """
+        if self.bits == 16:
+            return numpy.frombuffer(self.data, self.ty).reshape(16, 16, 16)
+        palette = numpy.array(self.palette, 'uint16')
+        if self.bits == 0:
+            return numpy.full((16, 16, 16), self.palette[0], 'uint16')
+        packed = numpy.frombuffer(self.data, 'uint8')
+        if self.bits == 8:
+            return palette[packed].reshape(16, 16, 16)
+        indices = numpy.empty(4096, 'uint8')
+        indices[0::2] = packed & 0x0F
+        indices[1::2] = packed >> 4
+        return palette[indices].reshape(16, 16, 16)
+
+
+class PaletteChunkDataNibble(ChunkDataNibble):
+    """
+    Light nibbles stored as a single value until the section's light
+    varies, then as a plain ChunkDataNibble array.
+    """
+
+    def __init__(self):
+        self.value = 0
+        self.data = None
+
+    def fill(self):
+        if self.data is None:
+            self.data = array.array(
+                self.ty, [self.value | (self.value << 4)]) * self.length
+
+    def unpack(self, buff):
+        data = buffer_bytes(buff.read(self.length))
+        uniform = uniform_nibbles.get(bytearray(data[:1])[0])
+        if uniform is not None and data == uniform:
+            self.value = bytearray(data[:1])[0] & 0x0F
+            self.data = None
+        else:
+            self.data = array_from(self.ty, data)
+
+    def pack(self):
+        if self.data is None:
+            return bytes(bytearray([self.value | (self.value << 4)])) * \
+                self.length
+        return self.data.tobytes()
+
+    def get(self, x, y, z):
+        if self.data is None:
+            return self.value
+        return super(PaletteChunkDataNibble, self).get(x, y, z)
+
+    def set(self, x, y, z, data):
+        if self.data is None and data & 0x0F == self.value:
+            return
+        super(PaletteChunkDataNibble, self).set(x, y, z, data)
+
+
+class LazyNibble(object):
+    """ Raw light nibbles of a section, decoded on first use. """
+    length = ChunkDataNibble.length
+
+    def __init__(self, nibble_type, raw):
+        self.nibble_type = nibble_type
+        self.raw = raw
+        self.nibble = None
+
+    def decode(self):
+        if self.nibble is None:
+            self.nibble = self.nibble_type()
+            self.nibble.unpack(ViewBuffer(self.raw))
+            self.raw = None
+        return self.nibble
+
+    def pack(self):
+        if self.nibble is None:
+            return self.raw
+        return self.nibble.pack()
+
+    def get(self, x, y, z):
+        return self.decode().get(x, y, z)
+
+    def set(self, x, y, z, data):
+        self.decode().set(x, y, z, data)
+
+
+class NoNibble(object):
+    """ Light that isn't stored, reads as 0 and ignores writes. """
+    length = ChunkDataNibble.length
+
+    def pack(self):
+        return b'\x00' * self.length
+
+    def get(self, x, y, z):
+        return 0
+
+    def set(self, x, y, z, data):
+        pass
+
+
+no_nibble = NoNibble()
 
 
 class Chunk(object):
+    nibble_type = ChunkDataNibble
+
     def __init__(self):
         self.block_data = ChunkDataShort()
-        self.light_block = ChunkDataNibble()
-        self.light_sky = ChunkDataNibble()
+        self.light_block = self.nibble_type()
+        self.light_sky = self.nibble_type()
+
+
+class NumpyChunk(object):
+    nibble_type = NumpyChunkDataNibble
+
+    def __init__(self):
+        self.block_data = NumpyChunkData()
+        self.light_block = self.nibble_type()
+        self.light_sky = self.nibble_type()
+
+
+class PaletteChunk(object):
+    nibble_type = PaletteChunkDataNibble
+
+    def __init__(self):
+        self.block_data = PaletteChunkData()
+        self.light_block = self.nibble_type()
+        self.light_sky = self.nibble_type()
+
+
+def block_lookup(block_ids):
+    lookup = numpy.zeros(4096, bool)
+    lookup[list(block_ids)] = True
+    return lookup
+
+
+def may_contain(chunk, block_ids):
+    """False if the section's palette rules out all of the given ids"""
+    palette = getattr(chunk.block_data, 'palette', None)
+    return palette is None or any(d >> 4 in block_ids for d in palette)
 
 
 class ChunkColumn(object):
+    chunk_type = Chunk
+
     def __init__(self):
         self.chunks = [None] * 16
         self.biome = BiomeData()
+        self._heightmaps = None
 
-    def unpack(self, buff, mask, skylight=True, continuous=True):
+    def unpack(self, buff, mask, skylight=True, continuous=True,
+               light=LIGHT_FULL):
         # In the protocol, each section is packed sequentially (i.e. attributes
         # pertaining to the same chunk are *not* grouped)
         chunk_idx = [i for i in range(16) if mask & (1 << i)]
         for i in chunk_idx:
             if self.chunks[i] is None:
-                self.chunks[i] = Chunk()
+                self.chunks[i] = self.chunk_type()
             self.chunks[i].block_data.unpack(buff)
-        for i in chunk_idx:
-            self.chunks[i].light_block.unpack(buff)
+        self.unpack_light(buff, chunk_idx, 'light_block', light)
         if skylight:
+            self.unpack_light(buff, chunk_idx, 'light_sky', light)
+        if continuous:
+            self.biome.unpack(buff)
+        self.compute_heights()
+
+    def unpack_light(self, buff, chunk_idx, attr, light):
+        """Unpacks one kind of light of the sections in chunk_idx"""
+        if light == LIGHT_NONE:
+            buff.read(len(chunk_idx) * ChunkDataNibble.length)
+            for i in chunk_idx:
+                setattr(self.chunks[i], attr, no_nibble)
+        elif light == LIGHT_LAZY:
+            nibble_type = self.chunk_type.nibble_type
+            for i in chunk_idx:
+                raw = buffer_bytes(buff.read(ChunkDataNibble.length))
+                setattr(self.chunks[i], attr, LazyNibble(nibble_type, raw))
+        else:
             for i in chunk_idx:
-                self.chunks[i].light_sky.unpack(buff)
+                nibble = getattr(self.chunks[i], attr)
+                if not isinstance(nibble, self.chunk_type.nibble_type):
+                    nibble = self.chunk_type.nibble_type()
+                    setattr(self.chunks[i], attr, nibble)
+                nibble.unpack(buff)
+
+    @property
+    def heightmaps(self):
+        """
+        One 16x16 map per HEIGHT_* kind, index x + z * 16, holding the y
+        above the highest block of that kind, 0 if there is none. Computed
+        on first use after the column's sections were unpacked.
+        """
+        if self._heightmaps is None:
+            self._heightmaps = [self.compute_height(table)
+                                for table in height_tables()]
+        return self._heightmaps
+
+    def compact(self):
+        """Packs sections that are stored loosely, see PaletteChunkData"""
+
+    def compute_heights(self):
+        """Drops the heightmaps, they are computed again when needed"""
+        self._heightmaps = None
+
+    def compute_height(self, table):
+        """Returns the heightmap of the block ids in table"""
+        if numpy is not None:
+            lookup = numpy.frombuffer(table, 'uint8').astype(bool)
+            heights = numpy.zeros(256, 'uint16')
+            left = numpy.ones(256, bool)
+        else:
+            heights = array.array('H', [0]) * 256
+            # Indices of the x, z columns without a block in table yet
+            left = list(range(256))
+        for i in range(15, -1, -1):
+            chunk = self.chunks[i]
+            if chunk is None:
+                continue
+            block_data = chunk.block_data
+            palette = getattr(block_data, 'palette', None)
+            if palette is not None:
+                # Whole sections are ruled out or filled by their palette
+                if not any(table[v >> 4] for v in palette):
+                    continue
+                if len(palette) == 1:
+                    if numpy is not None:
+                        heights[left] = i * 16 + 16
+                    else:
+                        for c in left:
+                            heights[c] = i * 16 + 16
+                    break
+            if numpy is not None:
+                found = lookup[block_data.blocks() >> 4].reshape(16, 256)
+                top = 16 - found[::-1].argmax(axis=0)
+                new = found.any(axis=0) & left
+                heights[new] = top[new] + i * 16
+                left &= ~new
+                if not left.any():
+                    break
+                continue
+            # Layer y of the section has the same indices as heights
+            values = block_data.values()
+            for y in range(15, -1, -1):
+                layer = values[y * 256:y * 256 + 256]
+                if layer == empty_layer:
+                    continue
+                rest = []
+                for c in left:
+                    if table[layer[c] >> 4]:
+                        heights[c] = i * 16 + y + 1
+                    else:
+                        rest.append(c)
+                left = rest
+                if not left:
+                    break
+            if not left:
+                break
+        if numpy is not None:
+            return array.array('H', heights.tobytes())
+        return heights
+
+    def update_height(self, x, y, z, block_id):
+        """Updates the heightmaps after block x, y, z became block_id"""
+        if self._heightmaps is None:
+            return
+        i = x + z * 16
+        for kind, table in enumerate(height_tables()):
+            heights = self.heightmaps[kind]
+            if table[block_id]:
+                if y >= heights[i]:
+                    heights[i] = y + 1
+            elif y + 1 == heights[i]:
+                heights[i] = self.scan_height(x, y - 1, z, table)
+
+    def scan_height(self, x, y, z, table):
+        """Returns the y above the highest block in table, from y down"""
+        while y >= 0:
+            chunk = self.chunks[y >> 4]
+            if chunk is None:
+                y = (y & ~0x0F) - 1
+                continue
+            if table[chunk.block_data.get(x, y & 0x0F, z) >> 4]:
+                return y + 1
+            y -= 1
+        return 0
+
+    def pack(self, skylight=True):
+        """
+        Returns the primary bitmap and the sections and biomes packed like
+        unpack() reads them
+        """
+        chunks = [(i, c) for i, c in enumerate(self.chunks) if c is not None]
+        mask = sum(1 << i for i, _ in chunks)
+        data = [c.block_data.pack() for _, c in chunks]
+        data.extend(c.light_block.pack() for _, c in chunks)
+        if skylight:
+            data.extend(c.light_sky.pack() for _, c in chunks)
+        data.append(self.biome.pack())
+        return mask, b''.join(data)
+
+    def find_blocks(self, block_ids, lookup=None):
+        """
+        Returns the column relative (x, y, z) coordinates of every block with
+        one of the given ids as an (n, 3) NumPy array
+        """
+        if lookup is None:
+            lookup = block_lookup(block_ids)
+        found = []
+        for i, chunk in enumerate(self.chunks):
+            if chunk is None or not may_contain(chunk, block_ids):
+                continue
+            ys, zs, xs = numpy.nonzero(lookup[chunk.block_data.blocks() >> 4])
+            if len(xs):
+                found.append(numpy.column_stack((xs, ys + i * 16, zs)))
+        if not found:
+            return numpy.empty((0, 3), int)
+        return numpy.concatenate(found)
+
+
+class NumpyChunkColumn(ChunkColumn):
+    chunk_type = NumpyChunk
+
+    def unpack(self, buff, mask, skylight=True, continuous=True,
+               light=LIGHT_FULL):
+        # Converts every section of a kind in one go, the sections are views
+        # of the arrays for the whole column
+        chunk_idx = [i for i in range(16) if mask & (1 << i)]
+        count = len(chunk_idx)
+        for i in chunk_idx:
+            if self.chunks[i] is None:
+                self.chunks[i] = self.chunk_type()
+        blocks = numpy.frombuffer(
+            buff.read(count * NumpyChunkData.length), '<u2'
+        ).astype(NumpyChunkData.dtype).reshape(count, 16, 16, 16)
+        for n, i in enumerate(chunk_idx):
+            self.chunks[i].block_data.data = blocks[n]
+        self.unpack_light(buff, chunk_idx, 'light_block', light)
+        if skylight:
+            self.unpack_light(buff, chunk_idx, 'light_sky', light)
         if continuous:
             self.biome.unpack(buff)
+        self.compute_heights()
+
+    def unpack_light(self, buff, chunk_idx, attr, light):
+        if light != LIGHT_FULL:
+            return super(NumpyChunkColumn, self).unpack_light(
+                buff, chunk_idx, attr, light)
+        count = len(chunk_idx)
+        packed = numpy.frombuffer(
+            buff.read(count * NumpyChunkDataNibble.length), 'uint8'
+        ).reshape(count, -1)
+        data = numpy.empty((count, 4096), 'uint8')
+        data[:, 0::2] = packed & 0x0F
+        data[:, 1::2] = packed >> 4
+        data = data.reshape(count, 16, 16, 16)
+        for n, i in enumerate(chunk_idx):
+            nibble = NumpyChunkDataNibble()
+            nibble.data = data[n]
+            setattr(self.chunks[i], attr, nibble)
+
+
+class PaletteChunkColumn(ChunkColumn):
+    chunk_type = PaletteChunk
+
+    def compact(self):
+        for chunk in self.chunks:
+            if chunk is not None:
+                chunk.block_data.compact()
+
+
+column_types = {
+    BACKEND_ARRAY: ChunkColumn,
+    BACKEND_NUMPY: NumpyChunkColumn,
+    BACKEND_PALETTE: PaletteChunkColumn,
+}
 
 
 class Dimension(object):
     """ A bunch of ChunkColumns. """
 
-    def __init__(self, dimension):
+    def __init__(self, dimension, backend=BACKEND_ARRAY, light=LIGHT_FULL):
+        if backend == BACKEND_NUMPY and numpy is None:
+            raise ImportError('The numpy map backend needs NumPy installed')
+        if light not in (LIGHT_FULL, LIGHT_LAZY, LIGHT_NONE):
+            raise ValueError("Unknown light mode '%s'" % light)
         self.dimension = dimension
+        self.backend = backend
+        self.light = light
+        self.column_type = column_types[backend]
         self.columns = {}  # chunk columns are address by a tuple (x, z)
 
-    def unpack_bulk(self, data):
-        bbuff = BoundBuffer(data['data'])
-        skylight = data['sky_light']
+    def decode_column(self, data, skylight=None):
+        """
+        Decodes Chunk Data into a new column without touching the dimension,
+        so it can run on another thread. Returns None for an unload.
+        skylight is whether the column has sky light, by default whether
+        the dimension is the overworld.
+        """
+        if data['continuous'] and not data['primary_bitmap']:
+            return None
+        if skylight is None:
+            skylight = self.dimension == DIMENSION_OVERWOLD
+        column = self.column_type()
+        column.unpack(ViewBuffer(data['data']), data['primary_bitmap'],
+                      skylight, data['continuous'], self.light)
+        return column
+
+    def decode_bulk(self, data):
+        """
+        Decodes Map Chunk Bulk like decode_column(), returns a list of
+        (metadata, column) pairs
+        """
+        bbuff = ViewBuffer(data['data'])
+        columns = []
         for meta in data['metadata']:
-            key = meta['chunk_x'], meta['chunk_z']
-            if key not in self.columns:
-                self.columns[key] = ChunkColumn()
-            self.columns[key].unpack(bbuff, meta['primary_bitmap'], skylight)
+            if not meta['primary_bitmap']:
+                # No sections means unload, skip the biome data
+                bbuff.read(BiomeData.length)
+                columns.append((meta, None))
+                continue
+            column = self.column_type()
+            column.unpack(bbuff, meta['primary_bitmap'], data['sky_light'],
+                          light=self.light)
+            columns.append((meta, column))
+        return columns
+
+    def commit_column(self, x, z, column, mask, continuous=True):
+        """
+        Stores a decoded column. A continuous column replaces the one at x, z,
+        otherwise only the sections in mask do.
+        """
+        old = self.columns.get((x, z))
+        if continuous or old is None:
+            self.columns[x, z] = column
+            return
+        for i in range(16):
+            if mask & (1 << i):
+                old.chunks[i] = column.chunks[i]
+        old.compute_heights()
+
+    def unpack_bulk(self, data):
+        for meta, column in self.decode_bulk(data):
+            if column is None:
+                self.unload_column(meta['chunk_x'], meta['chunk_z'])
+            else:
+                self.commit_column(meta['chunk_x'], meta['chunk_z'], column,
+                                   meta['primary_bitmap'])
 
     def unpack_column(self, data):
-        bbuff = BoundBuffer(data['data'])
-        skylight = True if self.dimension == DIMENSION_OVERWOLD else False
-        key = data['chunk_x'], data['chunk_z']
-        if key not in self.columns:
-            self.columns[key] = ChunkColumn()
-        self.columns[key].unpack(
-            bbuff, data['primary_bitmap'], skylight, data['continuous']
-        )
+        column = self.decode_column(data)
+        if column is None:
+            self.unload_column(data['chunk_x'], data['chunk_z'])
+        else:
+            self.commit_column(data['chunk_x'], data['chunk_z'], column,
+                               data['primary_bitmap'], data['continuous'])
+
+    def unload_column(self, x, z):
+        """Drops the column at chunk coordinates x, z, if it is loaded"""
+        return self.columns.pop((x, z), None) is not None
 
     def get_block(self, x, y, z):
         x, y, z = int(x), int(y), int(z)  # Damn you python2
@@ -174,16 +871,41 @@ class Dimension(object):
         if (x, z) in self.columns:
             column = self.columns[(x, z)]
         else:
-            column = ChunkColumn()
+            column = self.column_type()
             self.columns[(x, z)] = column
         chunk = column.chunks[y]
         if chunk is None:
-            chunk = Chunk()
+            chunk = column.chunk_type()
             column.chunks[y] = chunk
 
         if data is None:
             data = (block_id << 4) | (meta & 0x0F)
         chunk.block_data.set(rx, ry, rz, data)
+        column.update_height(rx, y * 16 + ry, rz, data >> 4)
+
+    def set_blocks(self, positions, data):
+        """
+        Sets many blocks at once. positions is a flat sequence of x, y, z
+        triples, like an array.array('i'), and data holds the block data
+        of each position.
+        """
+        key = chunk = None
+        for i, d in enumerate(data):
+            x, rx = divmod(positions[i * 3], 16)
+            y, ry = divmod(positions[i * 3 + 1], 16)
+            z, rz = divmod(positions[i * 3 + 2], 16)
+            if y > 0x0F:
+                continue
+            if key != (x, y, z):
+                key = x, y, z
+                column = self.columns.get((x, z))
+                if column is None:
+                    column = self.columns[(x, z)] = self.column_type()
+                chunk = column.chunks[y]
+                if chunk is None:
+                    chunk = column.chunks[y] = column.chunk_type()
+            chunk.block_data.set(rx, ry, rz, d)
+            column.update_height(rx, y * 16 + ry, rz, d >> 4)
 
     def get_light(self, x, y, z):
         x, rx = divmod(x, 16)
@@ -208,11 +930,11 @@ class Dimension(object):
         if (x, z) in self.columns:
             column = self.columns[(x, z)]
         else:
-            column = ChunkColumn()
+            column = self.column_type()
             self.columns[(x, z)] = column
         chunk = column.chunks[y]
         if chunk is None:
-            chunk = Chunk()
+            chunk = column.chunk_type()
             column.chunks[y] = chunk
 
         if light_block is not None:
@@ -236,7 +958,237 @@ class Dimension(object):
         if (x, z) in self.columns:
             column = self.columns[(x, z)]
         else:
-            column = ChunkColumn()
+            column = self.column_type()
             self.columns[(x, z)] = column
 
         return column.biome.set(rx, rz, data)
+
+    def get_height(self, x, z, kind=HEIGHT_SOLID):
+        """
+        Returns the y just above the highest block of the given HEIGHT_*
+        kind at x, z, where a player would stand on it for HEIGHT_SOLID.
+        0 if there is no such block, None if the column isn't loaded.
+        """
+        x, rx = divmod(int(x), 16)
+        z, rz = divmod(int(z), 16)
+        column = self.columns.get((x, z))
+        if column is None:
+            return None
+        return column.heightmaps[kind][rx + rz * 16]
+
+    def get_heights(self, start, end, kind=HEIGHT_SOLID):
+        """
+        Returns get_height() for the area between the (x, z) corners start
+        and end, end exclusive, as a list of rows indexed [z][x] relative
+        to start
+        """
+        x0, z0 = (int(c) for c in start)
+        x1, z1 = (int(c) for c in end)
+        rows = [[None] * max(0, x1 - x0) for _ in range(max(0, z1 - z0))]
+        for cx in range(x0 // 16, (x1 + 15) // 16):
+            for cz in range(z0 // 16, (z1 + 15) // 16):
+                column = self.columns.get((cx, cz))
+                if column is None:
+                    continue
+                heights = column.heightmaps[kind]
+                ax, bx = max(x0, cx * 16), min(x1, cx * 16 + 16)
+                for z in range(max(z0, cz * 16), min(z1, cz * 16 + 16)):
+                    i = (z - cz * 16) * 16 - cx * 16
+                    rows[z - z0][ax - x0:bx - x0] = heights[ax + i:bx + i]
+        return rows
+
+    def get_blocks(self, start, end):
+        """
+        Returns the block data between the start and end corners, end
+        exclusive, as a NumPy uint16 array indexed [y, z, x] relative to
+        start. Blocks in unloaded sections are 0.
+        """
+        x0, y0, z0 = (int(c) for c in start)
+        x1, y1, z1 = (int(c) for c in end)
+        out = numpy.zeros((max(0, y1 - y0), max(0, z1 - z0),
+                           max(0, x1 - x0)), 'uint16')
+        for cx in range(x0 // 16, (x1 + 15) // 16):
+            for cz in range(z0 // 16, (z1 + 15) // 16):
+                column = self.columns.get((cx, cz))
+                if column is None:
+                    continue
+                ax, bx = max(x0, cx * 16), min(x1, cx * 16 + 16)
+                az, bz = max(z0, cz * 16), min(z1, cz * 16 + 16)
+                for cy in range(max(y0, 0) // 16, (min(y1, 256) + 15) // 16):
+                    chunk = column.chunks[cy]
+                    if chunk is None:
+                        continue
+                    ay, by = max(y0, cy * 16), min(y1, cy * 16 + 16)
+                    out[ay - y0:by - y0, az - z0:bz - z0, ax - x0:bx - x0] = \
+                        chunk.block_data.blocks()[
+                            ay - cy * 16:by - cy * 16,
+                            az - cz * 16:bz - cz * 16,
+                            ax - cx * 16:bx - cx * 16]
+        return out
+
+    def find_blocks(self, block_ids):
+        """
+        Returns the (x, y, z) world coordinates of every loaded block with one
+        of the given ids as an (n, 3) NumPy array
+        """
+        lookup = block_lookup(block_ids)
+        found = []
+        for (cx, cz), column in self.columns.items():
+            blocks = column.find_blocks(block_ids, lookup)
+            if len(blocks):
+                found.append(blocks + (cx * 16, 0, cz * 16))
+        if not found:
+            return numpy.empty((0, 3), int)
+        return numpy.concatenate(found)
+
+
+def section_dist_sq(key, pos):
+    """Squared distance from pos to the nearest block of a section"""
+    dist = 0
+    for c, p in zip(key, pos):
+        low = c * 16
+        if p < low:
+            dist += (low - p) ** 2
+        elif p > low + 15:
+            dist += (p - low - 15) ** 2
+    return dist
+
+
+class BlockIndex(object):
+    """
+    Inverted index from block id to the positions of those blocks, kept per
+    section so that reloading a section only touches that section's entries.
+
+    Only tracked block ids are indexed. Querying an id that isn't tracked
+    yet starts tracking it, which scans the loaded sections once, after that
+    the index is kept up to date by the owning dimension.
+
+    index maps block ids to {(chunk_x, chunk_y, chunk_z): set of indices},
+    where an index is x + (z + y * 16) * 16 within the section.
+    """
+
+    def __init__(self, dimension):
+        self.dimension = dimension
+        self.index = {}
+
+    def track(self, block_ids):
+        new = set(block_ids).difference(self.index)
+        if not new:
+            return
+        for block_id in new:
+            self.index[block_id] = {}
+        for (cx, cz), column in self.dimension.columns.items():
+            for cy, chunk in enumerate(column.chunks):
+                if chunk is not None:
+                    self.add_section((cx, cy, cz), chunk, new)
+
+    def untrack(self, block_ids):
+        for block_id in block_ids:
+            self.index.pop(block_id, None)
+
+    def scan(self, chunk, block_ids):
+        found = {}
+        if not may_contain(chunk, block_ids):
+            return found
+        if numpy is not None:
+            blocks = chunk.block_data.blocks().reshape(-1) >> 4
+            indices = numpy.flatnonzero(block_lookup(block_ids)[blocks])
+            for i, block_id in zip(indices.tolist(),
+                                   blocks[indices].tolist()):
+                found.setdefault(block_id, set()).add(i)
+        else:
+            for i, data in enumerate(chunk.block_data.values()):
+                if data >> 4 in block_ids:
+                    found.setdefault(data >> 4, set()).add(i)
+        return found
+
+    def add_section(self, key, chunk, block_ids):
+        for block_id, indices in self.scan(chunk, block_ids).items():
+            self.index[block_id][key] = indices
+
+    def update_column(self, cx, cz, mask=0xFFFF):
+        """Reindexes the sections of a column that are set in mask"""
+        if not self.index:
+            return
+        column = self.dimension.columns.get((cx, cz))
+        for cy in range(16):
+            if mask & (1 << cy):
+                key = cx, cy, cz
+                for sections in self.index.values():
+                    sections.pop(key, None)
+                if column is not None and column.chunks[cy] is not None:
+                    self.add_section(key, column.chunks[cy], self.index)
+
+    def update_block(self, x, y, z, old_id, new_id):
+        if old_id == new_id or not self.index or not 0 <= y < 256:
+            return
+        x, rx = divmod(x, 16)
+        y, ry = divmod(y, 16)
+        z, rz = divmod(z, 16)
+        key = x, y, z
+        i = rx + (rz + ry * 16) * 16
+        if old_id in self.index:
+            indices = self.index[old_id].get(key)
+            if indices is not None:
+                indices.discard(i)
+                if not indices:
+                    del self.index[old_id][key]
+        if new_id in self.index:
+            self.index[new_id].setdefault(key, set()).add(i)
+
+    def sections(self, pos, block_ids, max_dist_sq=None):
+        """Yields (distance squared, key, indices), nearest sections first"""
+        self.track(block_ids)
+        found = []
+        for block_id in set(block_ids):
+            for key, indices in self.index[block_id].items():
+                dist = section_dist_sq(key, pos)
+                if max_dist_sq is None or dist <= max_dist_sq:
+                    found.append((dist, key, indices))
+        found.sort(key=lambda f: f[0])
+        return found
+
+    def nearest(self, pos, block_ids, count=1, max_distance=None):
+        """
+        Returns the positions of the count blocks with one of the given ids
+        nearest to pos, nearest first
+        """
+        px, py, pz = pos
+        max_dist_sq = None if max_distance is None else max_distance ** 2
+        best = []  # Max heap of (-distance squared, x, y, z)
+        for dist, (cx, cy, cz), indices in self.sections(
+                pos, block_ids, max_dist_sq):
+            if len(best) == count and dist > -best[0][0]:
+                break
+            for i in indices:
+                x = cx * 16 + (i & 0xF)
+                y = cy * 16 + (i >> 8)
+                z = cz * 16 + ((i >> 4) & 0xF)
+                d = (x - px) ** 2 + (y - py) ** 2 + (z - pz) ** 2
+                if max_dist_sq is not None and d > max_dist_sq:
+                    continue
+                if len(best) < count:
+                    heapq.heappush(best, (-d, x, y, z))
+                elif d < -best[0][0]:
+                    heapq.heapreplace(best, (-d, x, y, z))
+        return [Vector3(x, y, z) for _, x, y, z in sorted(best, reverse=True)]
+
+    def within(self, pos, radius, block_ids):
+        """
+        Returns the positions of all blocks with one of the given ids within
+        radius of pos, nearest first
+        """
+        px, py, pz = pos
+        max_dist_sq = radius ** 2
+        found = []
+        for _, (cx, cy, cz), indices in self.sections(
+                pos, block_ids, max_dist_sq):
+            for i in indices:
+                x = cx * 16 + (i & 0xF)
+                y = cy * 16 + (i >> 8)
+                z = cz * 16 + ((i >> 4) & 0xF)
+                d = (x - px) ** 2 + (y - py) ** 2 + (z - pz) ** 2
+                if d <= max_dist_sq:
+                    found.append((d, x, y, z))
+        found.sort()
+        return [Vector3(x, y, z) for _, x, y, z in found]
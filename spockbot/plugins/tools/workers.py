@@ -0,0 +1,64 @@
+"""
+A small pool of daemon threads for work that mostly runs outside the GIL,
+like inflating packets and converting chunk sections with NumPy.
+
+Jobs are polled rather than awaited, so the event loop can pick up results
+on its own thread whenever it gets around to it.
+"""
+
+import logging
+import threading
+
+from six.moves import queue
+
+logger = logging.getLogger('spockbot')
+
+
+class Job(object):
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.done = False
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except Exception as error:
+            logger.exception('WORKERS: Job %s failed', self.func)
+            self.error = error
+        # Set last, readers check done before looking at the result
+        self.done = True
+
+
+class WorkerPool(object):
+    def __init__(self, workers=2):
+        self.queue = queue.Queue()
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.work,
+                                      name='WorkerPool %d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, func, *args):
+        job = Job(func, args)
+        self.queue.put(job)
+        return job
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            job.run()
+
+    def close(self):
+        """Lets queued jobs finish, then stops the threads"""
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
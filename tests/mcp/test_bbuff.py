@@ -0,0 +1,66 @@
+import pytest
+
+from spockbot.mcp import datautils
+from spockbot.mcp.bbuff import BufferUnderflowException, ViewBuffer, \
+    ZeroCopyBuffer
+from spockbot.mcp.mcdata import MC_STRING, MC_VARINT
+
+
+def test_read_returns_views():
+    buff = ZeroCopyBuffer(b'abcdef')
+    out = buff.read(3)
+    assert isinstance(out, memoryview)
+    assert out.tobytes() == b'abc'
+    assert len(buff) == 3
+    assert buff.flush().tobytes() == b'def'
+    assert not buff
+
+
+def test_underflow():
+    buff = ZeroCopyBuffer(b'ab')
+    with pytest.raises(BufferUnderflowException):
+        buff.read(3)
+    assert buff.read(2).tobytes() == b'ab'
+
+
+def test_save_revert_tell():
+    buff = ZeroCopyBuffer(b'abcdef')
+    buff.read(2)
+    buff.save()
+    assert buff.tell() == 0
+    buff.read(3)
+    assert buff.tell() == 3
+    buff.revert()
+    assert buff.tell() == 0
+    assert buff.read(4).tobytes() == b'cdef'
+
+
+def test_compaction_keeps_views_valid():
+    buff = ZeroCopyBuffer(size=8)
+    buff.write(b'01234567')
+    view = buff.read(6)
+    buff.save()
+    buff.write(b'89abcdef')
+    assert view.tobytes() == b'012345'
+    assert buff.flush().tobytes() == b'6789abcdef'
+    assert len(buff.buff) == 2 * 10
+
+
+def test_datautils_compat():
+    data = datautils.pack(MC_VARINT, 1000000000)
+    data += datautils.pack(MC_STRING, u'caf\xe9')
+    buff = ZeroCopyBuffer(data)
+    assert datautils.unpack(MC_VARINT, buff) == 1000000000
+    assert datautils.unpack(MC_STRING, buff) == u'caf\xe9'
+
+
+def test_view_buffer():
+    data = bytearray(b'abcdef')
+    buff = ViewBuffer(data)
+    out = buff.read(2)
+    data[0:1] = b'z'
+    assert out.tobytes() == b'zb'
+    assert buff.tell() == 2 and len(buff) == 4
+    with pytest.raises(BufferUnderflowException):
+        buff.read(5)
+    assert buff.flush().tobytes() == b'cdef'
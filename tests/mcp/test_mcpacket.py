@@ -0,0 +1,99 @@
+import zlib
+
+import pytest
+
+from spockbot.mcp import datautils, mcdata
+from spockbot.mcp.bbuff import BoundBuffer, ZeroCopyBuffer
+from spockbot.mcp.mcdata import MC_VARINT
+from spockbot.mcp.mcpacket import InflateError, Inflater, Packet, \
+    PacketDecodeFailure
+
+chat = {'json_data': {'text': 'hello ' * 20}, 'position': 1}
+
+
+def roundtrip(packet, comp_state, threshold=-1, lazy=False):
+    encoded = packet.encode(comp_state, threshold)
+    return Packet((mcdata.PLAY_STATE, mcdata.SERVER_TO_CLIENT)).decode(
+        BoundBuffer(encoded), comp_state, lazy)
+
+
+def test_lazy_decode():
+    packet = roundtrip(Packet('PLAY<Chat Message', chat),
+                       mcdata.PROTO_COMP_OFF, lazy=True)
+    assert packet.str_ident == 'PLAY<Chat Message'
+    assert not packet.decoded
+    assert packet.data == chat
+    assert packet.decoded
+
+
+def test_lazy_decode_compressed():
+    packet = roundtrip(Packet('PLAY<Chat Message', chat),
+                       mcdata.PROTO_COMP_ON, threshold=16, lazy=True)
+    assert packet.str_ident == 'PLAY<Chat Message'
+    assert not packet.decoded
+    assert packet.data == chat
+
+
+def test_lazy_clone():
+    packet = roundtrip(Packet('PLAY<Chat Message', chat),
+                       mcdata.PROTO_COMP_OFF, lazy=True)
+    clone = packet.clone()
+    assert not clone.decoded
+    clone.data['position'] = 2
+    assert not packet.decoded
+    assert packet.data == chat
+
+
+def test_decode_compressed_from_zero_copy_buffer():
+    packet = Packet('PLAY<Chat Message', chat)
+    encoded = packet.encode(mcdata.PROTO_COMP_ON, 16)
+    for lazy in (False, True):
+        bbuff = ZeroCopyBuffer(encoded * 2)
+        packets = [Packet((mcdata.PLAY_STATE, mcdata.SERVER_TO_CLIENT)).decode(
+            bbuff, mcdata.PROTO_COMP_ON, lazy) for _ in range(2)]
+        assert len(bbuff) == 0
+        # Lazy payloads don't depend on the reused receive buffer
+        bbuff.save()
+        bbuff.append(b'\0' * len(encoded) * 2)
+        for decoded in packets:
+            assert decoded.data == chat
+
+
+def test_inflater_limits():
+    body = b'x' * 1000
+    data = zlib.compress(body)
+    inflater = Inflater(max_size=1000)
+    assert inflater.inflate(data, 1000) == body
+    assert inflater.inflate(memoryview(data), 1000) == body
+    with pytest.raises(InflateError):
+        Inflater(max_size=999).inflate(data, 1000)
+    with pytest.raises(InflateError):
+        inflater.inflate(data, 10)
+    with pytest.raises(InflateError):
+        inflater.inflate(data, 1001)
+    with pytest.raises(InflateError):
+        inflater.inflate(b'not zlib', 10)
+
+
+def test_decode_oversized_packet():
+    packet = Packet('PLAY<Chat Message', chat)
+    encoded = packet.encode(mcdata.PROTO_COMP_ON, 16)
+    for lazy in (False, True):
+        with pytest.raises(PacketDecodeFailure):
+            decoded = Packet(
+                (mcdata.PLAY_STATE, mcdata.SERVER_TO_CLIENT)
+            ).decode(BoundBuffer(encoded), mcdata.PROTO_COMP_ON, lazy,
+                     Inflater(max_size=64))
+            decoded.data
+
+
+def test_decode_lying_body_length():
+    bbuff = BoundBuffer(Packet('PLAY<Chat Message', chat).encode(
+        mcdata.PROTO_COMP_OFF, -1))
+    datautils.unpack(MC_VARINT, bbuff)
+    body = bbuff.flush()
+    data = datautils.pack(MC_VARINT, len(body) - 10) + zlib.compress(body)
+    encoded = datautils.pack(MC_VARINT, len(data)) + data
+    with pytest.raises(PacketDecodeFailure):
+        Packet((mcdata.PLAY_STATE, mcdata.SERVER_TO_CLIENT)).decode(
+            BoundBuffer(encoded), mcdata.PROTO_COMP_ON)
@@ -0,0 +1,71 @@
+import pytest
+
+from spockbot.mcp import datautils, mcdata
+from spockbot.mcp.bbuff import BoundBuffer, BufferUnderflowException
+from spockbot.mcp.mcpacket import Packet
+from spockbot.mcp.mcpacket_codec import get_codec
+
+sample_values = {
+    mcdata.MC_BOOL: True,
+    mcdata.MC_UBYTE: 200,
+    mcdata.MC_BYTE: -100,
+    mcdata.MC_USHORT: 60000,
+    mcdata.MC_SHORT: -30000,
+    mcdata.MC_UINT: 4000000000,
+    mcdata.MC_INT: -2000000000,
+    mcdata.MC_ULONG: 1 << 63,
+    mcdata.MC_LONG: -(1 << 62),
+    mcdata.MC_FLOAT: 1.5,
+    mcdata.MC_DOUBLE: -12345.678,
+    mcdata.MC_VARINT: -300,
+    mcdata.MC_VARLONG: 10000000000,
+    mcdata.MC_FP_INT: -12.5,
+    mcdata.MC_FP_BYTE: 2.25,
+    mcdata.MC_UUID: (0x0123456789ABCDEF << 64) | 0xFEDCBA9876543210,
+    mcdata.MC_POSITION: {'x': -1234, 'y': 64, 'z': 5678},
+    mcdata.MC_STRING: u'caf\xe9 bot',
+    mcdata.MC_CHAT: {'text': 'hi'},
+    mcdata.MC_SLOT: {'id': 1, 'amount': 3, 'damage': 0},
+    mcdata.MC_META: {0: (0, 1), 6: (3, 20.0)},
+}
+
+
+def reference_encode(structs, data):
+    return b''.join(datautils.pack(t, data[name]) for t, name in structs)
+
+
+def reference_decode(structs, bbuff):
+    return dict((name, datautils.unpack(t, bbuff)) for t, name in structs)
+
+
+@pytest.mark.parametrize('ident', sorted(mcdata.hashed_structs))
+def test_codec_matches_datautils(ident):
+    structs = mcdata.hashed_structs[ident]
+    data = dict((name, sample_values[t]) for t, name in structs)
+    encoded = reference_encode(structs, data)
+    codec = get_codec(ident)
+    assert codec.encode(data) == encoded
+
+    bbuff = BoundBuffer(encoded + b'extra')
+    assert codec.decode(bbuff) == \
+        reference_decode(structs, BoundBuffer(encoded))
+    assert bbuff.flush() == b'extra'
+
+
+def test_codec_underflow():
+    ident = mcdata.packet_str2ident['PLAY<Entity Look and Relative Move']
+    codec = get_codec(ident)
+    with pytest.raises(BufferUnderflowException):
+        codec.decode(BoundBuffer(b'\x81'))
+    with pytest.raises(BufferUnderflowException):
+        codec.decode(BoundBuffer(b'\x01\x02'))
+
+
+def test_packet_roundtrip():
+    packet = Packet('PLAY<Chat Message', {'json_data': {'text': 'hi'},
+                                          'position': 0})
+    encoded = packet.encode(mcdata.PROTO_COMP_OFF, -1)
+    decoded = Packet((mcdata.PLAY_STATE, mcdata.SERVER_TO_CLIENT)).decode(
+        BoundBuffer(encoded), mcdata.PROTO_COMP_OFF)
+    assert decoded.str_ident == 'PLAY<Chat Message'
+    assert decoded.data == packet.data
@@ -0,0 +1,114 @@
+import pytest
+
+from spockbot.mcp import mcdata
+from spockbot.mcp.bbuff import BoundBuffer, BufferUnderflowException
+from spockbot.mcp.mcpacket import Packet
+from spockbot.plugins.core.timer import TimerPlugin
+from spockbot.plugins.loader import PluginLoader
+
+asyncio = pytest.importorskip('asyncio')
+aio = pytest.importorskip('spockbot.plugins.core.aio')
+
+
+class FakeServer(asyncio.Protocol):
+    """Sends a keep alive to every client and collects what they send"""
+    def __init__(self, received):
+        self.received = received
+
+    def connection_made(self, transport):
+        transport.write(Packet('PLAY<Keep Alive', {'keep_alive': 42})
+                        .encode(mcdata.PROTO_COMP_OFF, -1))
+
+    def data_received(self, data):
+        self.received.append(data)
+
+
+def decode_all(data):
+    bbuff = BoundBuffer(data)
+    packets = []
+    while True:
+        try:
+            packets.append(Packet(
+                (mcdata.PLAY_STATE, mcdata.CLIENT_TO_SERVER)
+            ).decode(bbuff, mcdata.PROTO_COMP_OFF))
+        except BufferUnderflowException:
+            return packets
+
+
+def make_client(loop):
+    plugins = [('event', aio.AsyncioEventPlugin),
+               ('net', aio.AsyncioNetPlugin),
+               ('timers', TimerPlugin)]
+    client = PluginLoader(plugins=plugins, event={'loop': loop})
+    client.event = client.requires('Event')
+    client.net = client.requires('Net')
+    client.timers = client.requires('Timers')
+    return client
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def test_echo_and_timers(loop):
+    received = []
+    server = loop.run_until_complete(loop.create_server(
+        lambda: FakeServer(received), '127.0.0.1', 0))
+    port = server.sockets[0].getsockname()[1]
+    client = make_client(loop)
+    ticks = []
+
+    def start(name, data):
+        client.net.connect('127.0.0.1', port)
+        client.net.proto_state = mcdata.PLAY_STATE
+
+    def echo(name, packet):
+        client.net.push_packet('PLAY>Keep Alive', packet.data)
+        client.timers.reg_event_timer(0.05, client.event.kill)
+
+    client.event.reg_event_handler('event_start', start)
+    client.event.reg_event_handler('PLAY<Keep Alive', echo)
+    client.event.reg_event_handler(
+        'event_tick', lambda name, data: ticks.append(name))
+    client.event.event_loop()
+
+    assert [p.data for p in decode_all(b''.join(received))] == \
+        [{'keep_alive': 42}]
+    # Ticks follow activity and timers, the loop never spins
+    assert len(ticks) < 10
+    server.close()
+    loop.run_until_complete(server.wait_closed())
+
+
+def test_start_inside_running_loop(loop):
+    client = make_client(loop)
+    kills = []
+    client.event.reg_event_handler(
+        'event_kill', lambda name, data: kills.append(name))
+    client.timers.reg_event_timer(0.01, client.event.kill)
+
+    # event_loop() doesn't block inside a running loop
+    done = asyncio.Future(loop=loop)
+
+    def begin():
+        future = client.event.event_loop()
+        future.add_done_callback(lambda f: done.set_result(f.result()))
+    loop.call_soon(begin)
+    loop.run_until_complete(done)
+    assert kills == ['event_kill']
+
+
+def test_connect_error_kills(loop):
+    client = make_client(loop)
+    disconnects = []
+    client.event.reg_event_handler(
+        'net_disconnect', lambda name, data: disconnects.append(data))
+    client.event.reg_event_handler(
+        'event_start',
+        lambda name, data: client.net.connect('127.0.0.1', 1))
+    client.event.event_loop()
+    assert len(disconnects) == 1
+    assert client.event.kill_event
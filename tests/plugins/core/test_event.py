@@ -0,0 +1,126 @@
+from unittest import TestCase
+
+from spockbot.mcp.mcpacket import Packet
+from spockbot.plugins.core.event import COPY_ON_WRITE, COPY_SHARED, EventCore
+from spockbot.plugins.tools.cow import CowDict
+from spockbot.plugins.tools.event import EVENT_UNREGISTER, readonly, \
+    tick_interval
+
+
+class EventCoreTest(TestCase):
+    def emit(self, policy, data, mutates=None):
+        event = EventCore(policy)
+        received = []
+
+        def handler(name, d):
+            received.append(d)
+        event.reg_event_handler('test', handler, mutates)
+        event.emit('test', data)
+        return received[0]
+
+    def test_deepcopy_is_default(self):
+        data = {'a': [1, 2]}
+        received = self.emit('deepcopy', data)
+        self.assertEqual(received, data)
+        self.assertIsNot(received['a'], data['a'])
+
+    def test_shared(self):
+        data = {'a': [1, 2]}
+        self.assertIs(self.emit(COPY_SHARED, data), data)
+
+    def test_readonly_handlers_get_original(self):
+        data = {'a': [1, 2]}
+        self.assertIs(self.emit('deepcopy', data, mutates=False), data)
+
+        @readonly
+        def handler(name, d):
+            return EVENT_UNREGISTER
+        event = EventCore()
+        event.reg_event_handler('test', handler)
+        self.assertIn(handler, event.readonly_handlers['test'])
+        event.emit('test', data)
+        self.assertNotIn(handler, event.readonly_handlers['test'])
+
+    def test_copies_data(self):
+        def handler(name, d):
+            pass
+        for policy, copies in (('deepcopy', True), (COPY_SHARED, False)):
+            event = EventCore(policy)
+            event.reg_event_handler('a', handler, mutates=False)
+            self.assertFalse(event.copies_data('a', 'b'))
+            event.reg_event_handler('b', handler)
+            self.assertEqual(event.copies_data('a', 'b'), copies)
+
+    def test_copy_on_write(self):
+        data = {'a': [1, 2], 'b': b'chunk'}
+        received = self.emit(COPY_ON_WRITE, data)
+        self.assertIsInstance(received, CowDict)
+        self.assertIs(received['b'], data['b'])
+        received['a'].append(3)
+        received['c'] = 1
+        del received['b']
+        self.assertEqual(dict(received), {'a': [1, 2, 3], 'c': 1})
+        self.assertEqual(data, {'a': [1, 2], 'b': b'chunk'})
+
+    def test_copy_on_write_packet(self):
+        packet = Packet('PLAY>Keep Alive', {'keep_alive': 1})
+        received = self.emit(COPY_ON_WRITE, packet)
+        received.new_ident('PLAY<Keep Alive')
+        received.data['keep_alive'] = 2
+        self.assertEqual(packet.str_ident, 'PLAY>Keep Alive')
+        self.assertEqual(packet.data, {'keep_alive': 1})
+        self.assertEqual(dict(received.data), {'keep_alive': 2})
+
+    def test_copy_on_write_readonly(self):
+        data = {'a': [1, {'b': 2}], 'c': {'d': 3}}
+        received = self.emit(COPY_ON_WRITE, data, mutates=False)
+        self.assertEqual(dict(received), data)
+        self.assertEqual(received['a'][1]['b'], 2)
+        with self.assertRaises(TypeError):
+            received['e'] = 1
+        with self.assertRaises(TypeError):
+            del received['a']
+        with self.assertRaises(TypeError):
+            received['a'][0] = 2
+        with self.assertRaises(TypeError):
+            received['c']['d'] = 4
+        self.assertEqual(data, {'a': [1, {'b': 2}], 'c': {'d': 3}})
+        packet = Packet('PLAY<Keep Alive', {'keep_alive': 1})
+        received = self.emit(COPY_ON_WRITE, packet, mutates=False)
+        with self.assertRaises(TypeError):
+            received.data['keep_alive'] = 2
+        self.assertEqual(received.data['keep_alive'], 1)
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, EventCore, 'nope')
+
+    def test_tick_cadence(self):
+        event = EventCore()
+        calls = []
+
+        @tick_interval(60)
+        def slow(name, data):
+            calls.append('slow')
+
+        def every(name, data):
+            calls.append('every')
+        event.reg_event_handler('event_tick', every)
+        self.assertEqual(event.get_timeout(), -1)
+        self.assertEqual(event.get_timeout(5), 5)
+        event.reg_event_handler('event_tick', slow)
+        self.assertEqual(event.get_timeout(5), 0)
+        event.tick()
+        event.tick()
+        self.assertEqual(calls, ['slow', 'every', 'every'])
+        self.assertTrue(59 < event.get_timeout() <= 60)
+        self.assertEqual(event.get_timeout(5), 5)
+        self.assertEqual(event.iterations, 2)
+
+    def test_tick_cadence_unregister(self):
+        event = EventCore()
+        event.reg_event_handler(
+            'event_tick', lambda name, data: EVENT_UNREGISTER, interval=0)
+        self.assertEqual(event.get_timeout(), 0)
+        event.tick()
+        self.assertEqual(event.get_timeout(), -1)
+        self.assertEqual(event.event_handlers['event_tick'], [])
@@ -0,0 +1,133 @@
+import socket
+from collections import defaultdict
+from unittest import TestCase
+
+from spockbot.mcp import mcdata
+from spockbot.mcp.mcpacket import Packet, PacketDecodeFailure
+from spockbot.plugins.core.event import COPY_DEEPCOPY, COPY_ON_WRITE, \
+    EventCore
+from spockbot.plugins.core.net import NetCore, SendQueue
+
+
+class EventMock(object):
+    def __init__(self):
+        self.handlers = defaultdict(list)
+        self.emitted = []
+
+    def has_handlers(self, *events):
+        return any(self.handlers.get(event) for event in events)
+
+    def copies_data(self, *events):
+        return False
+
+    def emit(self, event, data=None):
+        self.emitted.append((event, data))
+
+
+class NetCoreTest(TestCase):
+    def setUp(self):
+        self.event = EventMock()
+        self.net = NetCore(None, self.event, lazy_decode=True)
+        self.net.proto_state = mcdata.PLAY_STATE
+
+    def read(self, *packets):
+        self.net.read_packet(b''.join(
+            Packet(ident, data).encode(mcdata.PROTO_COMP_OFF, -1)
+            for ident, data in packets
+        ))
+
+    def test_lazy_skips_unhandled_packets(self):
+        self.event.handlers['PLAY<Keep Alive'].append(None)
+        self.read(('PLAY<Time Update', {'world_age': 1, 'time_of_day': 2}),
+                  ('PLAY<Keep Alive', {'keep_alive': 3}))
+        self.assertEqual([e for e, _ in self.event.emitted], [
+            (mcdata.PLAY_STATE, mcdata.SERVER_TO_CLIENT, 0x00),
+            'PLAY<Keep Alive',
+        ])
+        packet = self.event.emitted[0][1]
+        self.assertFalse(packet.decoded)
+        self.assertEqual(packet.data, {'keep_alive': 3})
+
+    def handle(self, copy_policy, handler):
+        self.net.event = EventCore(copy_policy)
+        for event in ('PLAY<Keep Alive', Packet('PLAY<Keep Alive').ident):
+            self.net.event.reg_event_handler(event, handler)
+        errors = []
+        self.net.event.reg_event_handler('PACKET_ERR',
+                                         lambda _, err: errors.append(err))
+        return errors
+
+    def test_lazy_decode_failure(self):
+        for copy_policy in (COPY_DEEPCOPY, COPY_ON_WRITE):
+            errors = self.handle(copy_policy,
+                                 lambda _, packet: packet.data)
+            # A Keep Alive without its payload
+            ident = Packet('PLAY<Keep Alive').ident[2]
+            self.net.read_packet(bytes(bytearray([1, ident])))
+            self.assertEqual(len(errors), 1)
+            self.assertIsInstance(errors[0], PacketDecodeFailure)
+
+    def test_lazy_decodes_once_for_copies(self):
+        for copy_policy in (COPY_DEEPCOPY, COPY_ON_WRITE):
+            packets = []
+            self.handle(copy_policy, lambda _, packet: packets.append(packet))
+            self.read(('PLAY<Keep Alive', {'keep_alive': 3}))
+            # Both handlers got a copy of the decoded packet
+            self.assertEqual(len(packets), 2)
+            for packet in packets:
+                self.assertTrue(packet.decoded)
+                self.assertEqual(packet.data, {'keep_alive': 3})
+
+
+class SlowSocket(object):
+    """Accepts at most limit bytes per call"""
+    def __init__(self, limit):
+        self.limit = limit
+        self.calls = []
+        self.data = b''
+
+    def sendmsg(self, buffers):
+        self.calls.append(len(buffers))
+        data = b''.join(bytes(bytearray(b)) for b in buffers)[:self.limit]
+        self.data += data
+        return len(data)
+
+
+class SendQueueTest(TestCase):
+    def test_partial_sends(self):
+        queue = SendQueue()
+        for data in (b'abc', b'defgh', b'ij'):
+            queue.append(data)
+        self.assertEqual((len(queue), queue.size), (3, 10))
+        sock = SlowSocket(4)
+        self.assertEqual(queue.send(sock), 4)
+        self.assertEqual((len(queue), queue.size), (2, 6))
+        while queue:
+            queue.send(sock)
+        self.assertEqual(sock.data, b'abcdefghij')
+        self.assertEqual(sock.calls, [3, 2, 1])
+        self.assertEqual(queue.size, 0)
+
+    def test_coalesce(self):
+        queue = SendQueue(coalesce=8)
+        for data in (b'ab', b'cd', b'0123456789', b'ef', b'gh', b'ijklmn'):
+            queue.append(data)
+        self.assertEqual([bytes(b) for b in queue.buffers],
+                         [b'abcd', b'0123456789', b'efghijklmn'])
+        sock = SlowSocket(2)
+        queue.send(sock)
+        # The partly sent buffer is never grown
+        queue.append(b'op')
+        self.assertEqual(len(queue), 4)
+        self.assertEqual(queue.flush(), b'cd0123456789efghijklmnop')
+        self.assertEqual((len(queue), queue.size), (0, 0))
+
+    def test_socket(self):
+        a, b = socket.socketpair()
+        queue = SendQueue()
+        queue.append(b'hello ')
+        queue.append(b'world')
+        queue.send(a)
+        self.assertEqual(b.recv(64), b'hello world')
+        a.close()
+        b.close()
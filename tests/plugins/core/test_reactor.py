@@ -0,0 +1,107 @@
+import socket
+from unittest import TestCase
+
+from spockbot.mcp import mcdata
+from spockbot.mcp.bbuff import BoundBuffer, BufferUnderflowException
+from spockbot.mcp.mcpacket import Packet
+from spockbot.plugins.core.event import EventPlugin
+from spockbot.plugins.core.net import NetPlugin, Reactor
+from spockbot.plugins.core.timer import TimerPlugin
+from spockbot.plugins.loader import PluginLoader
+
+
+class FakeServer(object):
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(64)
+        self.port = self.sock.getsockname()[1]
+        self.conns = []
+
+    def accept(self):
+        conn, _ = self.sock.accept()
+        self.conns.append(conn)
+        return conn
+
+    def send(self, conn, ident, data):
+        conn.sendall(Packet(ident, data).encode(mcdata.PROTO_COMP_OFF, -1))
+
+    def read_packets(self, conn):
+        data = b''
+        while True:
+            chunk = conn.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        bbuff = BoundBuffer(data)
+        packets = []
+        while True:
+            try:
+                packets.append(Packet(
+                    (mcdata.PLAY_STATE, mcdata.CLIENT_TO_SERVER)
+                ).decode(bbuff, mcdata.PROTO_COMP_OFF))
+            except BufferUnderflowException:
+                return packets
+
+    def close(self):
+        for conn in self.conns:
+            conn.close()
+        self.sock.close()
+
+
+def make_client(reactor):
+    plugins = [('event', EventPlugin), ('net', NetPlugin),
+               ('timers', TimerPlugin)]
+    client = PluginLoader(plugins=plugins, net={'reactor': reactor})
+    client.net = client.requires('Net')
+    client.event = client.requires('Event')
+    return client
+
+
+class ReactorTest(TestCase):
+    def setUp(self):
+        self.server = FakeServer()
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_many_clients(self):
+        reactor = Reactor()
+        clients = [make_client(reactor) for _ in range(20)]
+        conns = []
+        answered = set()
+        for client in clients:
+            client.net.connect('127.0.0.1', self.server.port)
+            client.net.proto_state = mcdata.PLAY_STATE
+            conns.append(self.server.accept())
+
+            # Answer the keep alive, then hang up once it has been sent
+            def echo(name, packet, net=client.net):
+                net.push_packet('PLAY>Keep Alive', packet.data)
+                answered.add(net)
+
+            def done(name, data, net=client.net, event=client.event):
+                if net in answered and not net.send_queue:
+                    event.kill()
+            client.event.reg_event_handler('PLAY<Keep Alive', echo)
+            client.event.reg_event_handler('event_tick', done)
+        for i, conn in enumerate(conns):
+            self.server.send(conn, 'PLAY<Keep Alive', {'keep_alive': i})
+
+        reactor.run()
+        self.assertEqual(reactor.clients, [])
+        for i, conn in enumerate(conns):
+            packets = self.server.read_packets(conn)
+            self.assertEqual([p.data for p in packets], [{'keep_alive': i}])
+
+    def test_hang_up(self):
+        reactor = Reactor()
+        client = make_client(reactor)
+        disconnects = []
+        client.event.reg_event_handler(
+            'net_disconnect', lambda name, data: disconnects.append(data))
+        client.net.connect('127.0.0.1', self.server.port)
+        self.server.accept().close()
+        reactor.run()
+        self.assertEqual(disconnects, ['Socket Hung Up'])
+        self.assertFalse(client.net.connected)
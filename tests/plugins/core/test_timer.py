@@ -0,0 +1,80 @@
+import time
+from unittest import TestCase
+
+from spockbot.plugins.core.timer import BaseTimer, TimerCore, WorldTick
+
+
+class TimerCoreTest(TestCase):
+    def setUp(self):
+        self.world = WorldTick()
+        self.timers = TimerCore(self.world)
+        self.fired = []
+
+    def callback(self, name):
+        return lambda: self.fired.append(name)
+
+    def test_no_timers(self):
+        self.assertEqual(self.timers.get_timeout(), -1)
+
+    def test_event_timers_fire_in_deadline_order(self):
+        self.timers.reg_event_timer(0, self.callback('a'), runs=1)
+        self.timers.reg_event_timer(0, self.callback('b'), runs=1)
+        late = self.timers.reg_event_timer(60, self.callback('c'))
+        self.assertEqual(self.timers.get_timeout(), 0)
+        self.timers.update()
+        self.assertEqual(self.fired, ['a', 'b'])
+        self.assertEqual(len(self.timers), 1)
+        self.assertTrue(59 < self.timers.get_timeout() <= 60)
+        self.timers.cancel(late)
+        self.assertEqual(self.timers.get_timeout(), -1)
+
+    def test_repeating_timer_fires_once_per_update(self):
+        self.timers.reg_event_timer(0, self.callback('a'), runs=3)
+        self.timers.update()
+        self.timers.update()
+        self.assertEqual(self.fired, ['a', 'a'])
+        self.timers.update()
+        self.timers.update()
+        self.assertEqual(self.fired, ['a', 'a', 'a'])
+        self.assertEqual(len(self.timers), 0)
+
+    def test_reset_timer_is_rescheduled(self):
+        timer = self.timers.reg_event_timer(0, self.callback('a'))
+        timer.wait_time = 60
+        timer.reset()
+        self.timers.update()
+        self.assertEqual(self.fired, [])
+        self.assertTrue(self.timers.get_timeout() > 59)
+
+    def test_tick_timers(self):
+        self.timers.reg_tick_timer(2, self.callback('a'), runs=1)
+        self.assertEqual(self.timers.get_timeout(), -1)
+        self.world.age = 1
+        self.timers.update()
+        self.assertEqual(self.fired, [])
+        self.world.age = 2
+        self.timers.update()
+        self.assertEqual(self.fired, ['a'])
+
+    def test_polled_timers(self):
+        self.timers.reg_timer(BaseTimer(self.callback('a'), runs=2))
+        self.timers.update()
+        self.timers.update()
+        self.timers.update()
+        self.assertEqual(self.fired, ['a', 'a'])
+
+    def test_clear_keeps_persistent_timers(self):
+        self.timers.reg_event_timer(1, self.callback('a'))
+        self.timers.reg_event_timer(1, self.callback('b'), persist=True)
+        self.timers.reg_tick_timer(1, self.callback('c'))
+        self.timers.clear()
+        self.assertEqual(len(self.timers), 1)
+
+    def test_mass_cancel_compacts(self):
+        timers = [self.timers.reg_event_timer(60 + i, self.callback(i))
+                  for i in range(200)]
+        for timer in timers[:150]:
+            self.timers.cancel(timer)
+        self.assertTrue(len(self.timers) < 200)
+        deadline = time.time() + 60
+        self.assertTrue(self.timers.get_timeout() >= deadline - time.time())
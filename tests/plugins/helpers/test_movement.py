@@ -0,0 +1,142 @@
+import array
+
+from spockbot.plugins.helpers.movement import MovementPlugin, leg_distance
+from spockbot.plugins.helpers.pathfinding import PathfindingPlugin
+from spockbot.vector import Vector3
+
+from tests.plugins.helpers.test_pathfinding import PluginLoaderMock, \
+    STONE, flat_world, node
+
+
+class ClientInfoMock(object):
+    def __init__(self, position):
+        self.position = position
+
+
+class PhysicsMock(object):
+    def __init__(self):
+        self.targets = []
+
+    def move_target(self, target):
+        self.targets.append(target)
+        return False
+
+
+class EventMock(object):
+    def __init__(self):
+        self.emitted = []
+
+    def emit(self, event, data=None):
+        self.emitted.append(event)
+
+    def reg_event_handler(self, event, handler):
+        pass
+
+
+def movement_plugin(world):
+    loader = PluginLoaderMock(world)
+    pathfinding = PathfindingPlugin(loader, {})
+    loader.provided.update({
+        'ClientInfo': ClientInfoMock(Vector3(0.5, 1, 0.5)),
+        'Event': EventMock(),
+        'Net': None,
+        'Physics': PhysicsMock(),
+    })
+    movement = MovementPlugin(loader, {})
+    found = []
+    pathfinding.start_path(Vector3(0, 1, 0), Vector3(20, 1, 0),
+                           found.append)
+    movement.path_cb(found[0])
+    return movement, pathfinding
+
+
+def blocks_update(blocks):
+    return {
+        'positions': array.array('i', [c for pos in blocks for c in pos]),
+        'block_data': array.array('H', [STONE << 4] * len(blocks)),
+    }
+
+
+def place(world, pathfinding, movement, blocks):
+    for x, y, z in blocks:
+        world.set_block(x, y, z, STONE, 0)
+    data = blocks_update(blocks)
+    pathfinding.handle_blocks_update('world_blocks_update', data)
+    movement.handle_blocks_update('world_blocks_update', data)
+
+
+def test_leg_distance():
+    a, b = Vector3(0.5, 1, 0.5), Vector3(10.5, 1, 0.5)
+    assert leg_distance(a, b, 5.5, 2.5) == 2
+    assert leg_distance(a, b, -2.5, 4.5) == 5
+    assert leg_distance(a, a, 3.5, 4.5) == 5
+
+
+def test_path_affected():
+    world = flat_world()
+    movement, _ = movement_plugin(world)
+    assert movement.path_affected([10, 1, 0])
+    assert movement.path_affected([10, 0, 0])
+    assert not movement.path_affected([10, 1, 5])
+    assert not movement.path_affected([10, 5, 0])
+
+
+def test_replan_in_place():
+    world = flat_world()
+    movement, pathfinding = movement_plugin(world)
+    path = movement.movement.current_path
+    place(world, pathfinding, movement, [(10, 1, 3), (10, 3, 6)])
+    assert not movement.flag_replan
+    wall = [(10, y, z) for y in range(1, 4) for z in range(-16, 32)
+            if z != 6]
+    place(world, pathfinding, movement, wall)
+    assert movement.flag_replan
+
+    movement.follow_path(None, None)
+    assert movement.movement.current_path is path
+    assert node(10, 1, 6) in path
+    assert path[-1] == node(20, 1, 0)
+    assert not movement.flag_replan
+    planner = pathfinding.planner
+
+    # Only repairs the plan after that
+    place(world, pathfinding, movement, [(10, 1, 6)])
+    assert movement.flag_replan
+    movement.follow_path(None, None)
+    assert pathfinding.planner is planner
+    assert movement.movement.current_path is None
+    assert movement.event.emitted[-1] == 'movement_path_failed'
+
+
+def test_replan_in_slices():
+    world = flat_world()
+    movement, pathfinding = movement_plugin(world)
+    path = movement.movement.current_path
+    pathfinding.timers.timeout = 0
+    wall = [(10, y, z) for y in range(1, 4) for z in range(-16, 32)
+            if z != 6]
+    place(world, pathfinding, movement, wall)
+    movement.follow_path(None, None)
+    assert movement.replanning is path
+    # Holds still until the new path is in
+    movement.follow_path(None, None)
+    assert not movement.physics.targets
+    (_, do_replan), = pathfinding.event.handlers
+    pathfinding.timers.timeout = -1
+    do_replan()
+    assert movement.replanning is None
+    assert movement.movement.current_path is path
+    assert node(10, 1, 6) in path
+    movement.follow_path(None, None)
+    assert movement.physics.targets == [path[0]]
+
+    # A path that was stopped in the meantime stays stopped
+    place(world, pathfinding, movement, [(10, 1, 6)])
+    pathfinding.timers.timeout = 0
+    movement.follow_path(None, None)
+    movement.movement.stop()
+    pathfinding.timers.timeout = -1
+    pathfinding.event.handlers[-1][1]()
+    assert movement.replanning is None
+    assert movement.movement.current_path is None
+    assert 'movement_path_failed' not in movement.event.emitted
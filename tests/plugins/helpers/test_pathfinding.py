@@ -0,0 +1,313 @@
+import array
+
+import pytest
+
+from spockbot.plugins.helpers.pathfinding import FOUND_VALID_PATH, \
+    NO_VALID_PATH, Path, PathNode, PathfindingPlugin, TIMEOUT_REACHED, \
+    Walkability, solid_table
+from spockbot.plugins.helpers.world import WorldData
+from spockbot.plugins.tools import hpa, smpmap
+from spockbot.plugins.tools.event import EVENT_UNREGISTER
+from spockbot.vector import Vector3
+
+STONE = 1
+
+
+class EventMock(object):
+    def __init__(self):
+        self.handlers = []
+
+    def reg_event_handler(self, event, handler, interval=None):
+        self.handlers.append((event, handler))
+
+
+class TimersMock(object):
+    def __init__(self, timeout=-1):
+        self.timeout = timeout
+
+    def get_timeout(self):
+        return self.timeout
+
+
+class PluginLoaderMock(object):
+    def __init__(self, world, timeout=-1):
+        self.provided = {
+            'Event': EventMock(),
+            'World': world,
+            'Physics': None,
+            'ClientInfo': None,
+            'Timers': TimersMock(timeout),
+        }
+
+    def requires(self, requirement):
+        return self.provided[requirement]
+
+    def provides(self, ident, obj):
+        self.provided[ident] = obj
+
+    def reg_event_handler(self, event, handler):
+        pass
+
+
+def flat_world(walls=()):
+    world = WorldData()
+    for x in range(-16, 64):
+        for z in range(-16, 32):
+            world.set_block(x, 0, z, STONE, 0)
+    for x, z in walls:
+        for y in range(1, 4):
+            world.set_block(x, y, z, STONE, 0)
+    return world
+
+
+def plugin(world, timeout=-1):
+    return PathfindingPlugin(PluginLoaderMock(world, timeout), {})
+
+
+def node(x, y, z):
+    return PathNode(x + 0.5, y, z + 0.5)
+
+
+def test_straight_path():
+    pathfinding = plugin(flat_world())
+    path = Path(node(0, 1, 0), node(40, 1, 0))
+    assert pathfinding.pathfind(path) == FOUND_VALID_PATH
+    nodes = pathfinding.build_list_from_node(path.result)
+    assert nodes[0] == node(0, 1, 0) and nodes[-1] == node(40, 1, 0)
+    # Lazy Theta* cuts straight across open ground
+    assert len(nodes) < 10
+    assert len(path.closed_set) < 100
+
+
+def test_path_through_gap():
+    walls = [(10, z) for z in range(-16, 32) if z != 6]
+    pathfinding = plugin(flat_world(walls))
+    path = Path(node(0, 1, 0), node(20, 1, 0))
+    assert pathfinding.pathfind(path) == FOUND_VALID_PATH
+    nodes = pathfinding.build_list_from_node(path.result)
+    assert all(n.z == 6.5 for n in nodes if 9 < n.x < 12)
+    assert any(9 < n.x < 12 for n in nodes)
+
+
+def test_g_scores_improve():
+    path = Path(node(0, 1, 0), node(5, 1, 0))
+    assert path.pop() == node(0, 1, 0)
+    far = node(1, 1, 0)
+    far.node_dist = 10
+    path.push(far)
+    near = node(1, 1, 0)
+    near.node_dist = 1
+    path.push(near)
+    worse = node(1, 1, 0)
+    worse.node_dist = 5
+    path.push(worse)
+    assert path.pop() is near
+    assert path.pop() is None
+    path.close(near)
+    path.push(node(1, 1, 0))
+    assert not path.open_nodes
+
+
+def test_no_path():
+    walls = [(x, z) for x in range(-1, 2) for z in range(-1, 2)
+             if (x, z) != (0, 0)]
+    pathfinding = plugin(flat_world(walls))
+    failed = []
+    pathfinding.start_path(Vector3(0, 1, 0), Vector3(20, 1, 0),
+                           None, failed.append)
+    assert failed == [None]
+    assert pathfinding.path_job is None
+    assert not pathfinding.event.handlers
+
+
+def test_no_path_without_callback():
+    walls = [(x, z) for x in range(-1, 2) for z in range(-1, 2)
+             if (x, z) != (0, 0)]
+    pathfinding = plugin(flat_world(walls), timeout=0)
+    pathfinding.start_path(Vector3(0, 1, 0), Vector3(20, 1, 0), None)
+    (_, do_job), = pathfinding.event.handlers
+    pathfinding.timers.timeout = -1
+    assert pathfinding.pathfind(pathfinding.path_job[0]) == NO_VALID_PATH
+    # Searching an exhausted path again doesn't crash
+    assert do_job() == EVENT_UNREGISTER
+    assert pathfinding.path_job is None
+
+
+def test_timeslices():
+    pathfinding = plugin(flat_world(), timeout=0)
+    found = []
+    pathfinding.start_path(Vector3(0, 1, 0), Vector3(30, 1, 0), found.append)
+    path = pathfinding.path_job[0]
+    assert pathfinding.pathfind(path) == TIMEOUT_REACHED
+    (_, do_job), = pathfinding.event.handlers
+    pathfinding.timers.timeout = -1
+    assert do_job() == EVENT_UNREGISTER
+    assert found[0][-1] == node(30, 1, 0)
+
+
+def test_solid_table():
+    table = solid_table()
+    assert table[STONE << 4] and not table[0]
+    # Closed and open fence gates
+    assert table[107 << 4] and not table[107 << 4 | 0x04]
+
+
+@pytest.mark.parametrize('use_numpy', [True, False])
+def test_walkability(monkeypatch, use_numpy):
+    if not use_numpy:
+        monkeypatch.setattr(smpmap, 'numpy', None)
+    elif smpmap.numpy is None:
+        pytest.skip('numpy is not installed')
+    world = flat_world([(3, -4)])
+    walkability = Walkability(world)
+    assert walkability.solid(3, 0, 5) and walkability.solid(3, 3, -4)
+    assert not walkability.solid(3, 4, -4) and not walkability.solid(0, 1, 0)
+    assert not walkability.solid(0, -1, 0) and not walkability.solid(0, 300, 0)
+    assert not walkability.solid(200, 0, 0)
+    assert walkability.near_solid(2, 1, -3)
+    assert not walkability.near_solid(0, 1, 0)
+
+
+def test_walkability_follows_world():
+    world = flat_world()
+    pathfinding = plugin(world)
+    walkability = pathfinding.walkability
+    assert not walkability.solid(5, 1, 5) and not walkability.solid(5, 40, 5)
+    world.set_blocks(array.array('i', [5, 1, 5, 5, 40, 5, 5, 0, 5]),
+                     array.array('H', [STONE << 4, STONE << 4, 0]))
+    pathfinding.handle_blocks_update('world_blocks_update', {
+        'positions': array.array('i', [5, 1, 5, 5, 40, 5, 5, 0, 5]),
+        'block_data': array.array('H', [STONE << 4, STONE << 4, 0]),
+    })
+    assert walkability.solid(5, 1, 5) and walkability.solid(5, 40, 5)
+    assert not walkability.solid(5, 0, 5)
+    world.unload_column(0, 0)
+    pathfinding.handle_chunk_change('world_chunk_unload',
+                                    {'chunk_x': 0, 'chunk_z': 0})
+    assert not walkability.solid(5, 1, 5)
+
+
+def test_world_reset():
+    for event in ('world_new_dimension', 'world_reset'):
+        world = flat_world()
+        pathfinding = plugin(world)
+        pathfinding.replan(Vector3(0, 1, 0), Vector3(20, 1, 0),
+                           lambda nodes: None)
+        pathfinding.clusters.edges((0, 1, 0), (20, 1, 0))
+        assert pathfinding.walkability.solid(0, 0, 0)
+        # The new world has none of the old columns
+        world.new_dimension(-1)
+        pathfinding.handle_world_reset(event, None)
+        assert not pathfinding.walkability.solid(0, 0, 0)
+        assert not pathfinding.clusters.clusters
+        assert pathfinding.planner is None
+
+
+def test_keep_walkability():
+    world = flat_world()
+    for keep in (True, False):
+        pathfinding = PathfindingPlugin(PluginLoaderMock(world),
+                                        {'keep_walkability': keep})
+        pathfinding.walkability.solid(0, 0, 0)
+        pathfinding.start_path(Vector3(0, 1, 0), Vector3(1, 1, 0),
+                               lambda nodes: None)
+        assert (0, 0, 0) in pathfinding.walkability.sections
+        pathfinding.walkability.solid(0, 100, 0)
+        pathfinding.start_path(Vector3(0, 1, 0), Vector3(1, 1, 0),
+                               lambda nodes: None)
+        assert ((0, 6, 0) in pathfinding.walkability.sections) == keep
+
+
+def test_hierarchical_path():
+    walls = [(x, z) for x in (20, 40) for z in range(-16, 32) if z != x - 16]
+    pathfinding = PathfindingPlugin(PluginLoaderMock(flat_world(walls)), {
+        'hierarchical_distance': 16})
+    found = []
+    pathfinding.start_path(Vector3(0, 1, 0), Vector3(50, 1, 0), found.append)
+    assert isinstance(pathfinding.clusters, hpa.ClusterGraph)
+    nodes = found[0]
+    assert nodes[0] == node(0, 1, 0) and nodes[-1] == node(50, 1, 0)
+    assert any(n.z == 4.5 for n in nodes if 19 < n.x < 22)
+    assert any(n.z == 24.5 for n in nodes if 39 < n.x < 42)
+    for a, b in zip(nodes, list(nodes)[1:]):
+        assert pathfinding.raycast_bbox(a, b) or a.dist(b) < 2
+
+
+def test_hierarchical_fallback():
+    walls = [(x, z) for x in range(-1, 2) for z in range(-1, 2)
+             if (x, z) != (0, 0)]
+    pathfinding = PathfindingPlugin(PluginLoaderMock(flat_world(walls)), {
+        'hierarchical_distance': 16})
+    failed = []
+    pathfinding.start_path(Vector3(0, 1, 0), Vector3(30, 1, 0), None,
+                           failed.append)
+    assert failed == [None]
+    assert not pathfinding.event.handlers
+
+
+def test_hierarchical_follows_world():
+    world = flat_world()
+    pathfinding = plugin(world)
+    assert pathfinding.clusters.edges((0, 1, 0), (40, 1, 0))
+    assert (0, 0, 0) in pathfinding.clusters.clusters
+    pathfinding.handle_blocks_update('world_blocks_update', {
+        'positions': array.array('i', [5, 0, 5]),
+        'block_data': array.array('H', [0]),
+    })
+    assert (0, 0, 0) not in pathfinding.clusters.clusters
+    pathfinding.clusters.edges((0, 1, 0), (40, 1, 0))
+    pathfinding.handle_chunk_change('world_chunk_loaded',
+                                    {'chunk_x': 1, 'chunk_z': 1})
+    assert not pathfinding.clusters.clusters
+
+
+def replan(pathfinding, pos, target):
+    """Returns the nodes of the path, or False if there is no route"""
+    found = []
+    pathfinding.replan(pos, target, found.append,
+                       lambda _: found.append(False))
+    return found[0]
+
+
+def test_replan():
+    walls = [(10, z) for z in range(-16, 32) if z != 6]
+    pathfinding = plugin(flat_world(walls))
+    nodes = replan(pathfinding, Vector3(0.5, 2.3, 0.5), Vector3(20, 1, 0))
+    assert nodes[0] == node(0, 1, 0) and nodes[-1] == node(20, 1, 0)
+    assert node(10, 1, 6) in nodes
+    planner = pathfinding.planner
+    assert replan(pathfinding, Vector3(2, 1, 0), Vector3(20, 1, 0))
+    assert pathfinding.planner is planner
+    replan(pathfinding, Vector3(2, 1, 0), Vector3(20, 1, 5))
+    assert pathfinding.planner is not planner
+    pathfinding.handle_chunk_change('world_chunk_unload',
+                                    {'chunk_x': 0, 'chunk_z': 0})
+    assert pathfinding.planner is None
+    pathfinding = plugin(flat_world(walls + [(10, 6)]))
+    assert replan(pathfinding, Vector3(0, 1, 0), Vector3(20, 1, 0)) is False
+    assert not pathfinding.event.handlers
+
+
+def test_replan_timeslices():
+    pathfinding = plugin(flat_world(), timeout=0)
+    found = []
+    pathfinding.replan(Vector3(0, 1, 0), Vector3(30, 1, 0), found.append)
+    assert not found and pathfinding.replan_job
+    (_, do_replan), = pathfinding.event.handlers
+    assert do_replan() is None
+    pathfinding.timers.timeout = -1
+    assert do_replan() == EVENT_UNREGISTER
+    assert found[0][-1] == node(30, 1, 0)
+    assert pathfinding.replan_job is None
+
+
+def test_replan_limit():
+    walls = [(10, z) for z in range(-16, 32) if z != 6]
+    pathfinding = PathfindingPlugin(PluginLoaderMock(flat_world(walls)), {
+        'replan_limit': 50})
+    found = []
+    pathfinding.replan(Vector3(0, 1, 0), Vector3(20, 1, 0), found.append)
+    # Handed over to the regular search instead of failing
+    assert pathfinding.planner.expanded == 50
+    assert pathfinding.replan_job is None
+    assert found[0][-1] == node(20, 1, 0)
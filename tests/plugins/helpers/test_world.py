@@ -0,0 +1,401 @@
+import random
+import struct
+
+import pytest
+
+from spockbot.mcp.bbuff import BufferUnderflowException
+from spockbot.mcp.mcpacket import Packet
+from spockbot.plugins.helpers import world as world_module
+from spockbot.plugins.helpers.world import WorldData, WorldPlugin
+from spockbot.plugins.tools import smpmap, workers
+from spockbot.plugins.tools.event import EVENT_UNREGISTER
+from spockbot.plugins.tools.smpmap import BACKEND_ARRAY, BACKEND_NUMPY, \
+    BACKEND_PALETTE
+from spockbot.vector import Vector3
+
+ORE = 56
+
+backends = [BACKEND_ARRAY, BACKEND_PALETTE]
+try:
+    import numpy  # noqa
+    backends.append(BACKEND_NUMPY)
+except ImportError:
+    pass
+
+
+def column_packet(x, z, rand, mask=0b11):
+    count = bin(mask).count('1')
+    ids = [1 if rand.random() < 0.98 else ORE for _ in range(4096 * count)]
+    return {
+        'chunk_x': x, 'chunk_z': z, 'primary_bitmap': mask,
+        'continuous': True,
+        'data': (struct.pack('<%dH' % len(ids), *[i << 4 for i in ids]) +
+                 b'\x00' * 4096 * count + b'\x01' * 256),
+    }
+
+
+def load(backend, columns=2):
+    rand = random.Random(5)
+    world = WorldData(backend=backend)
+    for x in range(columns):
+        for z in range(columns):
+            world.unpack_column(column_packet(x, z, rand))
+    return world
+
+
+def brute_force(world, pos, block_id):
+    found = [Vector3(x, y, z)
+             for x in range(32) for y in range(32) for z in range(32)
+             if world.get_block(x, y, z)[0] == block_id]
+    return sorted(found, key=lambda p: (p - Vector3(*pos)).dist_sq())
+
+
+@pytest.fixture(params=backends)
+def backend(request):
+    return request.param
+
+
+@pytest.fixture(params=['numpy', 'python'])
+def scan(request, monkeypatch, backend):
+    if request.param == 'python':
+        if backend == BACKEND_NUMPY:
+            pytest.skip('the numpy backend needs numpy')
+        monkeypatch.setattr(smpmap, 'numpy', None)
+    elif smpmap.numpy is None:
+        pytest.skip('numpy is not installed')
+
+
+def test_nearest_blocks(backend, scan):
+    world = load(backend)
+    pos = (10, 12, 20)
+    expected = brute_force(world, pos, ORE)
+    nearest = world.nearest_blocks(pos, {ORE}, count=5)
+    assert len(nearest) == 5
+    dist = [(p - Vector3(*pos)).dist_sq() for p in nearest]
+    assert dist == [(p - Vector3(*pos)).dist_sq() for p in expected[:5]]
+    for p in nearest:
+        assert world.get_block(*p)[0] == ORE
+
+
+def test_blocks_within(backend, scan):
+    world = load(backend)
+    pos = (16, 16, 16)
+    found = world.blocks_within(pos, 8, {ORE})
+    expected = [p for p in brute_force(world, pos, ORE)
+                if (p - Vector3(*pos)).dist_sq() <= 64]
+    assert sorted(found) == sorted(expected)
+    assert world.blocks_within(pos, 8, {1234}) == []
+
+
+def test_max_distance(backend):
+    world = load(backend)
+    nearest = world.nearest_blocks((0, 0, 0), {ORE}, count=1000,
+                                   max_distance=10)
+    assert nearest
+    assert all(p.dist_sq() <= 100 for p in nearest)
+
+
+def test_index_follows_block_changes(backend):
+    world = load(backend)
+    world.nearest_blocks((0, 0, 0), {ORE})
+    world.set_block(4, 1, 3, ORE, 0)
+    world.set_block(5, 200, 5, ORE, 0)  # No section loaded there
+    assert Vector3(4, 1, 3) in world.blocks_within((4, 1, 3), 0, {ORE})
+    assert world.nearest_blocks((5, 200, 5), {ORE}) == [Vector3(5, 200, 5)]
+    world.set_block(4, 1, 3, 1, 0)
+    assert world.blocks_within((4, 1, 3), 0, {ORE}) == []
+
+
+def test_index_follows_chunk_loads(backend):
+    world = load(backend, columns=1)
+    assert world.blocks_within((0, 0, 0), 100, {ORE})
+    world.unpack_column({
+        'chunk_x': 0, 'chunk_z': 0, 'primary_bitmap': 0b11,
+        'continuous': True,
+        'data': struct.pack('<8192H', *[1 << 4] * 8192) +
+        b'\x00' * 8192 + b'\x01' * 256,
+    })
+    assert world.blocks_within((0, 0, 0), 100, {ORE}) == []
+    world.unpack_column(column_packet(1, 0, random.Random(1)))
+    assert world.nearest_blocks((0, 0, 0), {ORE})[0].x >= 16
+
+
+def test_reset_keeps_tracked_ids(backend):
+    world = load(backend)
+    world.nearest_blocks((0, 0, 0), {ORE})
+    world.reset()
+    assert ORE in world.block_index.index
+    assert world.nearest_blocks((0, 0, 0), {ORE}) == []
+    assert world.backend == backend
+
+
+class EventMock(object):
+    def __init__(self):
+        self.emitted = []
+
+    def emit(self, event, data=None):
+        self.emitted.append((event, data))
+
+    def reg_event_handler(self, event, handler, interval=None):
+        self.ticks = handler, interval
+
+
+class PluginLoaderMock(object):
+    def __init__(self):
+        self.event = EventMock()
+
+    def requires(self, requirement):
+        assert requirement == 'Event'
+        return self.event
+
+    def provides(self, ident, obj):
+        self.world = obj
+
+    def reg_event_handler(self, event, handler):
+        pass
+
+
+class PacketMock(object):
+    def __init__(self, data):
+        self.data = data
+
+
+def unloaded(event, name='world_chunk_unload'):
+    return [(d['chunk_x'], d['chunk_z'])
+            for e, d in event.emitted if e == name]
+
+
+def test_server_unload(backend):
+    world = load(backend)
+    world.nearest_blocks((0, 0, 0), {ORE})
+    world.unpack_column({'chunk_x': 0, 'chunk_z': 1, 'primary_bitmap': 0,
+                         'continuous': True, 'data': b''})
+    assert (0, 1) not in world.columns and len(world.columns) == 3
+    assert all(p.z < 16 or p.x >= 16
+               for p in world.blocks_within((0, 0, 0), 100, {ORE}))
+    biome = b'\x01' * 256
+    world.unpack_bulk({'sky_light': True, 'data': biome, 'metadata': [
+        {'chunk_x': 1, 'chunk_z': 1, 'primary_bitmap': 0},
+    ]})
+    assert sorted(world.columns) == [(0, 0), (1, 0)]
+
+
+def test_plugin_unload_events():
+    ploader = PluginLoaderMock()
+    plugin = WorldPlugin(ploader, {})
+    plugin.handle_chunk_data(None, PacketMock(
+        column_packet(0, 0, random.Random(1))))
+    unload = {'chunk_x': 0, 'chunk_z': 0, 'primary_bitmap': 0,
+              'continuous': True, 'data': b''}
+    plugin.handle_chunk_data(None, PacketMock(unload))
+    plugin.handle_chunk_data(None, PacketMock(unload))
+    assert unloaded(ploader.event) == [(0, 0)]
+    assert not ploader.world.columns
+
+
+def test_evict_lru():
+    ploader = PluginLoaderMock()
+    plugin = WorldPlugin(ploader, {'eviction': 'lru', 'max_columns': 2})
+    rand = random.Random(1)
+    for x in range(2):
+        plugin.handle_chunk_data(None, PacketMock(column_packet(x, 0, rand)))
+    # Single block reads aren't uses
+    ploader.world.get_block(0, 0, 0)
+    plugin.handle_position_update(None, Vector3(24, 64, 8))
+    plugin.handle_chunk_data(None, PacketMock(column_packet(2, 0, rand)))
+    assert unloaded(ploader.event) == [(0, 0)]
+    assert sorted(ploader.world.columns) == [(1, 0), (2, 0)]
+
+
+def test_evict_lru_get_blocks():
+    pytest.importorskip('numpy')
+    ploader = PluginLoaderMock()
+    plugin = WorldPlugin(ploader, {'eviction': 'lru', 'max_columns': 2})
+    rand = random.Random(1)
+    for x in range(2):
+        plugin.handle_chunk_data(None, PacketMock(column_packet(x, 0, rand)))
+    ploader.world.get_blocks((0, 0, 0), (16, 16, 16))
+    plugin.handle_chunk_data(None, PacketMock(column_packet(2, 0, rand)))
+    assert unloaded(ploader.event) == [(1, 0)]
+
+
+def test_evict_distance():
+    ploader = PluginLoaderMock()
+    plugin = WorldPlugin(ploader, {'eviction': 'distance', 'max_columns': 3,
+                                   'max_distance': 2})
+    plugin.handle_position_update(None, Vector3(8, 64, 8))
+    rand = random.Random(1)
+    for x in range(4):
+        plugin.handle_chunk_data(None, PacketMock(column_packet(x, 0, rand)))
+    assert unloaded(ploader.event) == [(3, 0)]
+    plugin.handle_position_update(None, Vector3(-20, 64, 8))
+    assert unloaded(ploader.event) == [(3, 0), (2, 0), (1, 0)]
+    assert list(ploader.world.columns) == [(0, 0)]
+
+
+def test_unknown_eviction_policy():
+    with pytest.raises(ValueError):
+        WorldData(eviction='random')
+
+
+def test_unknown_light_mode():
+    with pytest.raises(ValueError):
+        WorldData(light='some')
+
+
+def test_lazy_light_survives_reset():
+    world = WorldData(light=smpmap.LIGHT_LAZY)
+    world.reset()
+    world.unpack_column(column_packet(0, 0, random.Random(1)))
+    chunk = world.columns[(0, 0)].chunks[0]
+    assert isinstance(chunk.light_sky, smpmap.LazyNibble)
+    assert world.get_light(3, 3, 3) == (0, 0)
+
+
+def test_cache(backend, tmpdir):
+    path = str(tmpdir)
+    world = WorldData(backend=backend, cache_path=path)
+    rand = random.Random(3)
+    world.unpack_column(column_packet(0, 0, rand))
+    world.set_block(3, 3, 3, 7, 0)
+    blocks = [world.get_block(x, y, 0) for x in range(16) for y in range(32)]
+    world.unload_column(0, 0)
+    world.reset()
+    assert not world.columns
+
+    # Loaded from the cache on demand
+    assert world.get_block(3, 3, 3) == (7, 0)
+    assert (0, 0) in world.cached
+    assert [world.get_block(x, y, 0)
+            for x in range(16) for y in range(32)] == blocks
+    assert world.get_block(100, 0, 100) == (0, 0)
+    assert (6, 6) in world.cache_misses
+
+    # Data from the server replaces the cached column
+    world.unpack_column({
+        'chunk_x': 0, 'chunk_z': 0, 'primary_bitmap': 0b10,
+        'continuous': True,
+        'data': struct.pack('<4096H', *[2 << 4] * 4096) +
+        b'\x00' * 4096 + b'\x01' * 256,
+    })
+    assert world.get_block(3, 3, 3) == (0, 0)
+    assert world.get_block(3, 20, 3) == (2, 0)
+    world.close()
+
+    world = WorldData(backend=backend, cache_path=path)
+    assert world.get_block(3, 20, 3) == (2, 0)
+    world.close()
+
+
+def multi_block_change(blocks):
+    return PacketMock({'chunk_x': -1, 'chunk_z': 2, 'blocks': [
+        {'x': x, 'y': y, 'z': z, 'block_data': d} for x, y, z, d in blocks]})
+
+
+def test_multi_block_change():
+    ploader = PluginLoaderMock()
+    plugin = WorldPlugin(ploader, {})
+    plugin.world.nearest_blocks((0, 0, 0), {ORE})
+    plugin.handle_multi_block_change(None, multi_block_change([
+        (0, 10, 0, ORE << 4), (15, 11, 3, 1 << 4 | 2)]))
+    assert plugin.world.get_block(-16, 10, 32) == (ORE, 0)
+    assert plugin.world.get_block(-1, 11, 35) == (1, 2)
+    assert plugin.world.nearest_blocks((0, 0, 0), {ORE}) == [
+        Vector3(-16, 10, 32)]
+    assert [e for e, _ in ploader.event.emitted] == ['world_blocks_update']
+    data = ploader.event.emitted[0][1]
+    assert list(data['positions']) == [-16, 10, 32, -1, 11, 35]
+    assert list(data['block_data']) == [ORE << 4, 1 << 4 | 2]
+
+
+def test_compact_columns():
+    ploader = PluginLoaderMock()
+    plugin = WorldPlugin(ploader, {})
+    rand = random.Random(1)
+    for x in range(2):
+        plugin.handle_chunk_data(None, PacketMock(column_packet(x, 0, rand)))
+    assert ploader.event.ticks == (plugin.compact_columns, 0.05)
+    sections = [section.block_data
+                for column in plugin.world.columns.values()
+                for section in column.chunks if section]
+    assert all(data.bits == 16 for data in sections)
+    assert plugin.compact_columns() is None
+    assert plugin.compact_columns() == EVENT_UNREGISTER
+    assert all(data.bits == 4 for data in sections)
+    assert not plugin.compacting
+
+
+def test_block_update_events():
+    ploader = PluginLoaderMock()
+    plugin = WorldPlugin(ploader, {'block_update_events': True})
+    plugin.handle_multi_block_change(None, multi_block_change([
+        (0, 10, 0, ORE << 4), (15, 11, 3, 1 << 4 | 2)]))
+    assert [e for e, _ in ploader.event.emitted] == [
+        'world_blocks_update', 'world_block_update', 'world_block_update']
+    assert ploader.event.emitted[2][1] == {
+        'location': {'x': -1, 'y': 11, 'z': 35}, 'block_data': 1 << 4 | 2}
+
+
+def test_decode_workers():
+    ploader = PluginLoaderMock()
+    plugin = WorldPlugin(ploader, {'decode_workers': 2})
+    rand = random.Random(1)
+    packets = [column_packet(x, 0, rand) for x in range(4)]
+    for data in packets:
+        plugin.handle_chunk_data(None, Packet('PLAY<Chunk Data', data))
+    plugin.handle_block_change(None, Packet('PLAY<Block Change', {
+        'location': {'x': 1, 'y': 1, 'z': 1}, 'block_data': 7 << 4}))
+    assert ploader.event.ticks == (plugin.commit_ready, 0.005)
+    plugin.pool.close()
+    assert plugin.commit_ready() == EVENT_UNREGISTER
+    assert unloaded(ploader.event, 'world_chunk_loaded') == [
+        (x, 0) for x in range(4)]
+    assert ploader.event.emitted[-1][0] == 'world_block_update'
+    assert plugin.world.get_block(1, 1, 1) == (7, 0)
+    assert sorted(plugin.world.columns) == [(x, 0) for x in range(4)]
+    world = WorldData()
+    world.unpack_column(packets[3])
+    for y in range(32):
+        assert plugin.world.get_block(50, y, 3) == world.get_block(50, y, 3)
+
+
+def test_decode_workers_error(monkeypatch):
+    errors = []
+    monkeypatch.setattr(world_module.logger, 'error',
+                        lambda *args: errors.append(args))
+    monkeypatch.setattr(workers.logger, 'exception', lambda *args: None)
+    ploader = PluginLoaderMock()
+    plugin = WorldPlugin(ploader, {'decode_workers': 1})
+    rand = random.Random(1)
+    data = column_packet(0, 0, rand)
+    data['data'] = data['data'][:100]
+    plugin.handle_chunk_data(None, Packet('PLAY<Chunk Data', data))
+    plugin.handle_chunk_data(None, Packet('PLAY<Chunk Data',
+                                          column_packet(1, 0, rand)))
+    plugin.pool.close()
+    assert plugin.commit_ready() == EVENT_UNREGISTER
+    (_, ident, error), = errors
+    assert ident == 'PLAY<Chunk Data'
+    assert isinstance(error, BufferUnderflowException)
+    assert sorted(plugin.world.columns) == [(1, 0)]
+
+
+def test_decode_workers_respawn():
+    ploader = PluginLoaderMock()
+    plugin = WorldPlugin(ploader, {'decode_workers': 1})
+    rand = random.Random(1)
+    plugin.handle_chunk_data(None, Packet('PLAY<Chunk Data',
+                                          column_packet(0, 0, rand)))
+    plugin.handle_new_dimension(None, PacketMock({
+        'dimension': smpmap.DIMENSION_NETHER}))
+    # Still being decoded, or waiting to be committed, before the Respawn
+    assert plugin.world.dimension == smpmap.DIMENSION_OVERWOLD
+    data = column_packet(1, 0, rand, mask=0b1)
+    # No sky light in the nether
+    data['data'] = data['data'][:4096 * 2 + 2048] + b'\x01' * 256
+    plugin.handle_chunk_data(None, Packet('PLAY<Chunk Data', data))
+    plugin.pool.close()
+    assert plugin.commit_ready() == EVENT_UNREGISTER
+    assert plugin.world.dimension == smpmap.DIMENSION_NETHER
+    assert sorted(plugin.world.columns) == [(1, 0)]
+    assert plugin.world.get_block(16, 0, 0)[0] in (1, ORE)
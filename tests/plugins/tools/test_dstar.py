@@ -0,0 +1,67 @@
+from spockbot.plugins.tools import dstar, hpa
+
+from tests.plugins.tools.test_hpa import Terrain
+
+
+def cost(route):
+    return sum(dstar.distance(a, b) for a, b in zip(route, route[1:]))
+
+
+def plan(terrain, start, goal):
+    planner = dstar.DStarLite(hpa.ClusterGraph(terrain.solid), start, goal)
+    assert planner.compute()
+    return planner
+
+
+def test_plan():
+    terrain = Terrain(32)
+    terrain.wall(10, gap=20)
+    planner = plan(terrain, (0, 1, 0), (20, 1, 0))
+    route = planner.route()
+    assert route[0] == (0, 1, 0) and route[-1] == (20, 1, 0)
+    assert (10, 1, 20) in route
+    assert abs(cost(route) - planner.g[(0, 1, 0)]) < 1e-9
+    for a, b in zip(route, route[1:]):
+        assert b in dict(planner.graph.moves(*a))
+
+
+def test_no_route():
+    terrain = Terrain(32)
+    terrain.wall(10)
+    planner = plan(terrain, (0, 1, 0), (20, 1, 0))
+    assert planner.route() is None
+
+
+def test_replan():
+    terrain = Terrain(32)
+    terrain.wall(10, gap=20)
+    planner = plan(terrain, (0, 1, 0), (20, 1, 0))
+    route = planner.route()
+    planner.move_start(route[5])
+    # Move the gap closer
+    walls = [(10, y, 20) for y in range(1, 4)]
+    terrain.blocks.update(walls)
+    terrain.blocks.difference_update((10, y, 8) for y in range(1, 4))
+    planner.blocks_changed([c for pos in walls + [(10, 1, 8)] for c in pos])
+    expanded = planner.expanded
+    assert planner.compute()
+    route = planner.route()
+    assert (10, 1, 8) in route and route[-1] == (20, 1, 0)
+
+    fresh = plan(terrain, route[0], (20, 1, 0))
+    assert abs(planner.g[route[0]] - fresh.g[route[0]]) < 1e-9
+    assert planner.expanded - expanded < fresh.expanded
+
+
+def test_compute_limit():
+    terrain = Terrain(32)
+    planner = dstar.DStarLite(hpa.ClusterGraph(terrain.solid),
+                              (0, 1, 0), (30, 1, 30))
+    assert not planner.compute(10)
+    assert planner.route() is None
+    assert planner.expanded == 10
+    assert not planner.compute(keep_going=lambda: False)
+    assert planner.expanded == 10
+    while not planner.compute(10):
+        pass
+    assert planner.route()[-1] == (30, 1, 30)
@@ -0,0 +1,104 @@
+from spockbot.plugins.tools import hpa
+
+
+class Terrain(object):
+    """A stone floor at y = 0 over 0 <= x, z < size, with extra blocks"""
+    def __init__(self, size, blocks=()):
+        self.size = size
+        self.blocks = set(blocks)
+
+    def solid(self, x, y, z):
+        if (x, y, z) in self.blocks:
+            return True
+        return y == 0 and 0 <= x < self.size and 0 <= z < self.size
+
+    def wall(self, x, gap=None):
+        for z in range(self.size):
+            if z != gap:
+                self.blocks.update((x, y, z) for y in range(1, 4))
+
+
+def route_length(route):
+    return sum(sum((a - b) ** 2 for a, b in zip(p, q)) ** 0.5
+               for p, q in zip(route, route[1:]))
+
+
+def search(graph, start, goal):
+    abstract = hpa.AbstractSearch(graph, start, goal)
+    assert abstract.run(lambda: True)
+    return abstract.route
+
+
+def test_moves():
+    terrain = Terrain(8, [(2, 1, 1), (1, 1, 3), (1, 2, 3)])
+    graph = hpa.ClusterGraph(terrain.solid)
+    moves = dict(graph.moves(1, 1, 1))
+    # Jump onto the block in +x, the wall in +z blocks both diagonals
+    assert (2, 2, 1) in moves and (2, 1, 1) not in moves
+    assert (1, 1, 2) in moves and (1, 1, 0) in moves
+    assert (2, 1, 2) not in moves and (0, 1, 2) in moves
+    # Walking off the edge falls onto the floor below
+    terrain.blocks.update([(x, 3, z) for x in range(3) for z in range(3)])
+    moves = dict(graph.moves(1, 4, 1))
+    assert (3, 1, 1) not in moves
+    assert (2, 4, 1) in moves
+    moves = dict(graph.moves(2, 4, 1))
+    assert moves[(3, 1, 1)] == 10 ** 0.5
+
+
+def test_transitions_are_grouped():
+    terrain = Terrain(48)
+    graph = hpa.ClusterGraph(terrain.solid)
+    transitions = graph.cluster((1, 0, 1)).transitions
+    # One run per side and corner
+    assert len(transitions) == 8
+    starts = [start for start, _, _ in transitions]
+    assert (16, 1, 24) in starts and (31, 1, 24) in starts
+
+
+def test_route():
+    terrain = Terrain(64)
+    terrain.wall(20, gap=50)
+    graph = hpa.ClusterGraph(terrain.solid)
+    route = search(graph, (0, 1, 0), (40, 1, 0))
+    assert route[0] == (0, 1, 0) and route[-1] == (40, 1, 0)
+    # Around through the gap, the wall is inside a cluster
+    assert 100 < route_length(route) < 120
+
+
+def test_no_route():
+    terrain = Terrain(64)
+    terrain.wall(20)
+    graph = hpa.ClusterGraph(terrain.solid)
+    assert search(graph, (0, 1, 0), (40, 1, 0)) is None
+
+
+def test_invalidate():
+    terrain = Terrain(64)
+    terrain.wall(20, gap=50)
+    graph = hpa.ClusterGraph(terrain.solid)
+    assert search(graph, (0, 1, 0), (40, 1, 0)) is not None
+    terrain.blocks.update((20, y, 50) for y in range(1, 4))
+    # Still cached
+    assert search(graph, (0, 1, 0), (40, 1, 0)) is not None
+    graph.invalidate(20, 1, 50)
+    assert search(graph, (0, 1, 0), (40, 1, 0)) is None
+    terrain.blocks.difference_update((20, y, 5) for y in range(1, 4))
+    graph.invalidate_column(1, 0)
+    assert route_length(search(graph, (0, 1, 0), (40, 1, 0))) < 60
+
+
+def test_run_in_slices():
+    terrain = Terrain(64)
+    graph = hpa.ClusterGraph(terrain.solid)
+    abstract = hpa.AbstractSearch(graph, (0, 1, 0), (60, 1, 60))
+    steps = [0]
+
+    def keep_going():
+        steps[0] += 1
+        return steps[0] % 2
+
+    slices = 1
+    while not abstract.run(keep_going):
+        slices += 1
+    assert slices > 1 and abstract.route[-1] == (60, 1, 60)
@@ -0,0 +1,43 @@
+import os
+
+from spockbot.plugins.tools.region import RegionCache, RegionFile, \
+    SECTOR_SIZE
+
+
+def test_region_file_roundtrip(tmpdir):
+    path = str(tmpdir.join('r.0.0.smp'))
+    region = RegionFile(path)
+    assert region.read(3, 4) is None
+    region.write(3, 4, b'a' * 10)
+    region.write(-1, 4, b'b' * 5000)
+    assert region.read(3, 4) == b'a' * 10
+    assert region.read(31, 4) == b'b' * 5000
+    # Grows past its sectors, so it moves to the end of the file
+    region.write(3, 4, b'c' * 9000)
+    assert region.read(3, 4) == b'c' * 9000
+    assert region.read(31, 4) == b'b' * 5000
+    region.close()
+    assert os.path.getsize(path) % SECTOR_SIZE == 0
+    region = RegionFile(path)
+    assert region.read(3, 4) == b'c' * 9000
+    assert region.read(35, 4) == b'c' * 9000
+    region.close()
+
+
+def test_region_cache(tmpdir):
+    cache = RegionCache(str(tmpdir.join('cache')))
+    assert cache.read(0, 0) is None
+    cache.write(0, 0, b'zero')
+    cache.write(-40, 70, b'far' * 1000)
+    cache.write(0, 0, b'new zero')
+    assert cache.read(0, 0) == b'new zero'
+    cache.flush()
+    assert not cache.pending
+    assert cache.read(-40, 70) == b'far' * 1000
+    cache.close()
+    assert sorted(os.listdir(str(tmpdir.join('cache')))) == [
+        'r.-2.2.smp', 'r.0.0.smp']
+    cache = RegionCache(str(tmpdir.join('cache')))
+    assert cache.read(0, 0) == b'new zero'
+    assert cache.read(1, 0) is None
+    cache.close()
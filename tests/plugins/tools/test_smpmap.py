@@ -0,0 +1,301 @@
+import struct
+
+import pytest
+
+from spockbot.mcp.bbuff import BoundBuffer, ViewBuffer
+from spockbot.plugins.tools import smpmap
+from spockbot.plugins.tools.smpmap import BACKEND_ARRAY, BACKEND_NUMPY, \
+    BACKEND_PALETTE
+
+numpy = pytest.importorskip('numpy')
+
+backends = [BACKEND_ARRAY, BACKEND_NUMPY, BACKEND_PALETTE]
+
+
+def section_blocks(i):
+    # Every block gets a distinct id, meta is the section index
+    return struct.pack('<4096H', *[((n % 4000) << 4) | i
+                                   for n in range(4096)])
+
+
+def column_data(mask):
+    sections = [i for i in range(16) if mask & (1 << i)]
+    data = b''.join(section_blocks(i) for i in sections)
+    data += b'\x21' * 2048 * len(sections)  # block light
+    data += b'\xF0' * 2048 * len(sections)  # sky light
+    return data + b'\x02' * 256
+
+
+def load(backend, mask=0b101, x=0, z=0):
+    dimension = smpmap.Dimension(smpmap.DIMENSION_OVERWOLD, backend)
+    dimension.unpack_column({
+        'chunk_x': x, 'chunk_z': z, 'primary_bitmap': mask,
+        'continuous': True, 'data': column_data(mask),
+    })
+    return dimension
+
+
+@pytest.mark.parametrize('backend', backends)
+def test_unpack_column(backend):
+    dimension = load(backend)
+    assert dimension.get_block(0, 0, 0) == (0, 0)
+    assert dimension.get_block(1, 0, 0) == (1, 0)
+    assert dimension.get_block(3, 2 + 32, 1) == ((3 + 16 + 512) % 4000, 2)
+    assert dimension.get_block(0, 16, 0) == (0, 0)  # Section not sent
+    # Low nibble first
+    assert dimension.get_light(0, 0, 0) == (1, 0)
+    assert dimension.get_light(1, 40, 15) == (2, 15)
+    assert dimension.get_biome(5, 5) == 2
+
+
+@pytest.mark.parametrize('backend', backends)
+def test_set_block_and_light(backend):
+    dimension = load(backend)
+    dimension.set_block(-1, 200, -1, 7, 3)
+    assert dimension.get_block(-1, 200, -1) == (7, 3)
+    dimension.set_light(-1, 200, -1, 5, 9)
+    assert dimension.get_light(-1, 200, -1) == (5, 9)
+    assert dimension.get_light(-2, 200, -1) == (0, 0)
+    chunk = dimension.columns[(0, 0)].chunks[0]
+    chunk.light_block.set(1, 15, 15, 6)
+    assert chunk.light_block.get(1, 15, 15) == 6
+    assert chunk.light_block.get(0, 15, 15) == 1
+
+
+@pytest.mark.parametrize('backend', backends)
+def test_lazy_light(backend):
+    dimension = smpmap.Dimension(smpmap.DIMENSION_OVERWOLD, backend,
+                                 smpmap.LIGHT_LAZY)
+    dimension.unpack_column({
+        'chunk_x': 0, 'chunk_z': 0, 'primary_bitmap': 0b101,
+        'continuous': True, 'data': column_data(0b101),
+    })
+    chunk = dimension.columns[(0, 0)].chunks[2]
+    assert chunk.light_block.nibble is None
+    assert chunk.light_block.raw == b'\x21' * 2048
+    assert chunk.light_block.pack() == b'\x21' * 2048
+    assert dimension.get_light(1, 40, 15) == (2, 15)
+    assert chunk.light_block.nibble is not None
+    dimension.set_light(0, 32, 0, 7)
+    assert dimension.get_light(0, 32, 0) == (7, 0)
+    assert dimension.get_block(3, 2 + 32, 1) == ((3 + 16 + 512) % 4000, 2)
+
+
+@pytest.mark.parametrize('backend', backends)
+def test_lazy_light_bound_buffer(backend):
+    # BoundBuffer.read() returns bytes rather than memoryview slices
+    column = smpmap.Dimension(smpmap.DIMENSION_OVERWOLD, backend,
+                              smpmap.LIGHT_LAZY).column_type()
+    column.unpack(BoundBuffer(column_data(0b101)), 0b101,
+                  light=smpmap.LIGHT_LAZY)
+    chunk = column.chunks[2]
+    assert chunk.light_block.raw == b'\x21' * 2048
+    assert chunk.light_sky.get(1, 8, 15) == 15
+    assert chunk.block_data.get(3, 2, 1) >> 4 == (3 + 16 + 512) % 4000
+
+
+@pytest.mark.parametrize('backend', backends)
+def test_no_light(backend):
+    dimension = smpmap.Dimension(smpmap.DIMENSION_OVERWOLD, backend,
+                                 smpmap.LIGHT_NONE)
+    dimension.unpack_column({
+        'chunk_x': 0, 'chunk_z': 0, 'primary_bitmap': 0b101,
+        'continuous': True, 'data': column_data(0b101),
+    })
+    dimension.set_light(1, 40, 15, 5, 5)
+    assert dimension.get_light(1, 40, 15) == (0, 0)
+    assert dimension.get_block(3, 2 + 32, 1) == ((3 + 16 + 512) % 4000, 2)
+    assert dimension.get_biome(5, 5) == 2
+    mask, data = dimension.columns[(0, 0)].pack()
+    assert len(data) == len(column_data(0b101))
+    # Light is decoded again when the column is unpacked with light
+    column = dimension.column_type()
+    column.unpack(ViewBuffer(column_data(mask)), mask)
+    assert column.chunks[2].light_sky.get(1, 8, 15) == 15
+
+
+def test_array_from():
+    data = struct.pack('<4H', 1, 2, 3, 4)
+    assert list(smpmap.array_from('H', data)) == [1, 2, 3, 4]
+    assert list(smpmap.array_from('H', memoryview(data)[2:6])) == [2, 3]
+
+
+def test_numpy_pack_roundtrip():
+    chunk = load(BACKEND_NUMPY).columns[(0, 0)].chunks[2]
+    assert chunk.block_data.pack() == section_blocks(2)
+    assert chunk.light_block.pack() == b'\x21' * 2048
+
+
+@pytest.mark.parametrize('backend', backends)
+def test_get_blocks(backend):
+    dimension = load(backend, x=0)
+    dimension.set_block(16, 1, 0, 9, 0)
+    blocks = dimension.get_blocks((14, 0, 0), (18, 3, 2))
+    assert blocks.shape == (3, 2, 4)
+    for y in range(3):
+        for z in range(2):
+            for x in range(14, 18):
+                block_id, meta = dimension.get_block(x, y, z)
+                assert blocks[y, z, x - 14] == (block_id << 4) | meta
+
+
+@pytest.mark.parametrize('backend', backends)
+def test_find_blocks(backend):
+    dimension = load(backend, x=-1)
+    dimension.set_block(3, 100, 4, 56, 0)
+    found = dimension.find_blocks({56})
+    expected = [(3, 100, 4)]
+    for y in (0, 32):
+        for n in range(4096):
+            if n % 4000 == 56:
+                expected.append((n % 16 - 16, y + n // 256, n // 16 % 16))
+    assert sorted(map(tuple, found.tolist())) == sorted(expected)
+    assert len(dimension.find_blocks({4095})) == 0
+
+
+@pytest.fixture(params=['numpy', 'python'])
+def palette_numpy(request, monkeypatch):
+    if request.param == 'python':
+        monkeypatch.setattr(smpmap, 'numpy', None)
+
+
+def test_palette_upgrades(palette_numpy):
+    data = smpmap.PaletteChunkData()
+    assert data.bits == 0 and data.get(5, 5, 5) == 0
+    data.set(0, 0, 0, 0)
+    assert data.bits == 0
+    for n in range(300):
+        data.set(n % 16, n // 256, n // 16 % 16, (n + 1) << 4)
+        assert data.get(n % 16, n // 256, n // 16 % 16) == (n + 1) << 4
+        if n == 0:
+            assert data.bits == 4
+        elif n == 15:
+            assert data.bits == 8
+        elif n == 255:
+            assert data.bits == 16
+    for n in range(300):
+        assert data.get(n % 16, n // 256, n // 16 % 16) == (n + 1) << 4
+    assert data.get(15, 15, 15) == 0
+
+
+@pytest.mark.parametrize('count, bits', [(1, 0), (3, 4), (16, 4),
+                                         (17, 8), (256, 8), (257, 16)])
+def test_palette_roundtrip(palette_numpy, count, bits):
+    raw = struct.pack('<4096H', *[(n % count) << 4 for n in range(4096)])
+    data = smpmap.PaletteChunkData()
+    data.unpack(ViewBuffer(raw))
+    # Decoding only spots uniform sections, compact() packs the rest
+    assert data.bits == (0 if count == 1 else 16)
+    assert data.pack() == raw
+    data.compact()
+    assert data.bits == bits
+    assert data.pack() == raw
+    assert data.get(5, 1, 2) == (((5 + 2 * 16 + 256) % count) << 4)
+
+
+def test_palette_light(palette_numpy):
+    light = smpmap.PaletteChunkDataNibble()
+    light.unpack(ViewBuffer(b'\xFF' * 2048))
+    assert light.data is None and light.get(3, 3, 3) == 15
+    light.set(3, 3, 3, 15)
+    assert light.data is None
+    light.set(3, 3, 3, 4)
+    assert light.get(3, 3, 3) == 4 and light.get(2, 3, 3) == 15
+    light.unpack(ViewBuffer(b'\x21' * 2048))
+    assert light.data is not None
+    assert light.pack() == b'\x21' * 2048
+
+
+@pytest.mark.parametrize('backend', backends)
+def test_set_blocks(backend):
+    dimension = load(backend)
+    positions = [0, 0, 0, 15, 15, 15, -1, 300, 0, -20, 100, 5, 1, 0, 0]
+    dimension.set_blocks(positions, [1 << 4, 2 << 4, 3 << 4, 4 << 4, 5 << 4])
+    assert dimension.get_block(0, 0, 0) == (1, 0)
+    assert dimension.get_block(15, 15, 15) == (2, 0)
+    assert dimension.get_block(-1, 300, 0) == (0, 0)
+    assert dimension.get_block(-20, 100, 5) == (4, 0)
+    assert dimension.get_block(1, 0, 0) == (5, 0)
+
+
+def terrain_column(x=0, z=0):
+    # Stone up to y 20 with a water pool, a torch on top of the stone and
+    # nothing but air in section 2
+    blocks = []
+    for y in range(48):
+        for bz in range(16):
+            for bx in range(16):
+                if y < 20:
+                    blocks.append(1)
+                elif y < 22 and bx < 4:
+                    blocks.append(9)
+                elif y == 20 and bx == 8:
+                    blocks.append(50)
+                else:
+                    blocks.append(0)
+    data = struct.pack('<%dH' % len(blocks), *[b << 4 for b in blocks])
+    return {'chunk_x': x, 'chunk_z': z, 'primary_bitmap': 0b111,
+            'continuous': True,
+            'data': data + b'\x00' * 4096 * 3 + b'\x01' * 256}
+
+
+@pytest.fixture(params=backends)
+def heights(request, palette_numpy):
+    if request.param == BACKEND_NUMPY and smpmap.numpy is None:
+        pytest.skip('the numpy backend needs numpy')
+    dimension = smpmap.Dimension(smpmap.DIMENSION_OVERWOLD, request.param)
+    dimension.unpack_column(terrain_column())
+    return dimension
+
+
+def test_heightmaps(heights):
+    # Only computed when first needed
+    column = heights.columns[0, 0]
+    assert column._heightmaps is None
+    assert heights.get_height(5, 5) == 20
+    assert column._heightmaps is not None
+    assert heights.get_height(5, 5, smpmap.HEIGHT_SURFACE) == 20
+    assert heights.get_height(1, 5, smpmap.HEIGHT_SURFACE) == 22
+    assert heights.get_height(1, 5, smpmap.HEIGHT_MOTION_BLOCKING) == 22
+    assert heights.get_height(1, 5, smpmap.HEIGHT_SOLID) == 20
+    assert heights.get_height(8, 0, smpmap.HEIGHT_SURFACE) == 21
+    assert heights.get_height(8, 0, smpmap.HEIGHT_MOTION_BLOCKING) == 20
+    assert heights.get_height(16, 0) is None
+
+
+def test_heightmaps_uniform_sections(palette_numpy):
+    # Stone in section 0, air in section 1
+    blocks = struct.pack('<4096H', *[1 << 4] * 4096) + b'\0' * 8192
+    for backend in backends:
+        if backend == BACKEND_NUMPY and smpmap.numpy is None:
+            continue
+        dimension = smpmap.Dimension(smpmap.DIMENSION_OVERWOLD, backend)
+        dimension.unpack_column({
+            'chunk_x': 0, 'chunk_z': 0, 'primary_bitmap': 0b11,
+            'continuous': True,
+            'data': blocks + b'\0' * 2048 * 4 + b'\x01' * 256,
+        })
+        assert dimension.get_height(3, 7) == 16
+        assert dimension.get_height(3, 7, smpmap.HEIGHT_SURFACE) == 16
+
+
+def test_heightmaps_follow_set_block(heights):
+    heights.set_block(5, 40, 5, 1, 0)
+    assert heights.get_height(5, 5) == 41
+    heights.set_block(5, 100, 5, 1, 0)  # Creates a section
+    assert heights.get_height(5, 5) == 101
+    heights.set_block(5, 100, 5, 0, 0)
+    assert heights.get_height(5, 5) == 41
+    heights.set_blocks([5, 40, 5, 5, 19, 5], [0, 0])
+    assert heights.get_height(5, 5) == 19
+    assert heights.get_height(5, 5, smpmap.HEIGHT_SURFACE) == 19
+    heights.set_block(5, 30, 5, 9, 0)
+    assert heights.get_height(5, 5) == 19
+    assert heights.get_height(5, 5, smpmap.HEIGHT_MOTION_BLOCKING) == 31
+
+
+def test_get_heights(heights):
+    heights.set_block(-1, 7, 2, 1, 0)
+    rows = heights.get_heights((-2, 1), (3, 3))
+    assert rows == [[0, 0, 20, 20, 20], [0, 8, 20, 20, 20]]
+    assert heights.get_heights((-20, 0), (-17, 1)) == [[None] * 3]
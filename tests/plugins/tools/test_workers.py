@@ -0,0 +1,22 @@
+import threading
+
+from spockbot.plugins.tools.workers import WorkerPool
+
+
+def test_worker_pool():
+    pool = WorkerPool(3)
+    threads = set()
+
+    def work(n):
+        threads.add(threading.current_thread().name)
+        if n == 5:
+            raise ValueError(n)
+        return n * 2
+
+    jobs = [pool.submit(work, n) for n in range(10)]
+    pool.close()
+    assert all(job.done for job in jobs)
+    assert [job.result for job in jobs if job.error is None] == [
+        n * 2 for n in range(10) if n != 5]
+    assert isinstance(jobs[5].error, ValueError)
+    assert threading.current_thread().name not in threads